@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""Measure download throughput and server CPU of the /download body paths.
+
+Each case starts a real WSGI server in its own process, serving one file
+through a minimal Flask app, and fetches it over loopback HTTP:
+
+  send_file, werkzeug          Flask's send_file under the dev server, what
+                               download_file() used before DownloadEngine
+  engine, werkzeug             DownloadEngine.serve under the dev server: no
+                               wsgi.file_wrapper, so 1 MB reads with fadvise
+                               read-ahead
+  engine, gunicorn             DownloadEngine.serve under gunicorn's threaded
+                               worker, which sends wsgi.file_wrapper bodies
+                               with os.sendfile (skipped without gunicorn)
+
+Reported CPU is the user+system time of the server process tree over the
+run, which is what caps throughput on the ARM board.
+
+    python3 benchmarks/download_bench.py --file /media/necris-user/sda1/big.mp4 --streams 4
+"""
+
+import os
+import sys
+import time
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+
+import psutil
+from flask import Flask, send_file
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from download_engine import DownloadEngine  # noqa: E402
+
+try:
+    import gunicorn  # noqa: F401
+    HAVE_GUNICORN = True
+except ImportError:
+    HAVE_GUNICORN = False
+
+
+def create_app(path=None, body=None):
+    """The app a benchmark server runs, settings come from the environment for gunicorn"""
+    path = path or os.environ['BENCH_FILE']
+    body = body or os.environ['BENCH_BODY']
+    app = Flask(__name__)
+    engine = DownloadEngine(base_path=os.path.dirname(path))
+
+    @app.route('/download')
+    def download():
+        if body == 'send_file':
+            return send_file(path, as_attachment=True)
+        return engine.serve(path)
+
+    return app
+
+
+CASES = {
+    'send_file, werkzeug': ('werkzeug', 'send_file'),
+    'engine, werkzeug': ('werkzeug', 'engine'),
+    'engine, gunicorn': ('gunicorn', 'engine'),
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(server, body, path, port, streams):
+    env = dict(os.environ, BENCH_FILE=path, BENCH_BODY=body, PYTHONPATH=ROOT)
+    if server == 'gunicorn':
+        command = [sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{port}', '--workers', '1',
+                   '--worker-class', 'gthread', '--threads', str(streams), '--chdir', os.path.dirname(__file__),
+                   'download_bench:create_app()']
+    else:
+        command = [sys.executable, os.path.abspath(__file__), '--serve', '--port', str(port)]
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except OSError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f'{server} did not start')
+
+
+def cpu_time(process):
+    total = 0.0
+    for p in [process] + process.children(recursive=True):
+        try:
+            times = p.cpu_times()
+            total += times.user + times.system
+        except psutil.NoSuchProcess:
+            pass
+    return total
+
+
+def fetch(port, received):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    conn.request('GET', '/download')
+    response = conn.getresponse()
+    buf = bytearray(1024 * 1024)
+    total = 0
+    while True:
+        n = response.readinto(buf)
+        if not n:
+            break
+        total += n
+    conn.close()
+    received.append(total)
+
+
+def run(case, path, streams):
+    server, body = CASES[case]
+    port = free_port()
+    process = start_server(server, body, path, port, streams)
+    try:
+        tree = psutil.Process(process.pid)
+        received = []
+        threads = [threading.Thread(target=fetch, args=(port, received)) for _ in range(streams)]
+        cpu_before = cpu_time(tree)
+        started = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - started
+        cpu = cpu_time(tree) - cpu_before
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    return elapsed, cpu, sum(received)
+
+
+def drop_caches(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        os.close(fd)
+    except (AttributeError, OSError):
+        pass
+
+
+def serve(port):
+    from werkzeug.serving import make_server
+    make_server('127.0.0.1', port, create_app(), threaded=True).serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--file', help='file to serve (default: a temporary file of --size MB)')
+    parser.add_argument('--size', type=int, default=256, help='size in MB of the temporary file')
+    parser.add_argument('--streams', type=int, default=1, help='concurrent downloads')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        return serve(args.port)
+
+    path = args.file
+    tmp = None
+    if path is None:
+        tmp = tempfile.NamedTemporaryFile(delete=False)
+        block = os.urandom(1024 * 1024)
+        for _ in range(args.size):
+            tmp.write(block)
+        tmp.close()
+        path = tmp.name
+
+    try:
+        print(f"{'case':<24} {'MB/s':>10} {'CPU s':>8} {'CPU s/GB':>10}")
+        for case, (server, _) in CASES.items():
+            if server == 'gunicorn' and not HAVE_GUNICORN:
+                print(f"{case:<24} skipped, gunicorn is not installed")
+                continue
+            best = None
+            for _ in range(args.repeat):
+                drop_caches(path)
+                elapsed, cpu, total = run(case, path, args.streams)
+                if best is None or elapsed < best[0]:
+                    best = (elapsed, cpu, total)
+            elapsed, cpu, total = best
+            gigabytes = total / 1024 ** 3
+            print(f"{case:<24} {total / 1024 ** 2 / elapsed:>10.1f} {cpu:>8.2f} {cpu / gigabytes:>10.2f}")
+    finally:
+        if tmp:
+            os.unlink(tmp.name)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
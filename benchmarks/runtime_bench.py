@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""Compare startup time and memory of the two orchestrator layouts.
+
+multi-process starts usb_monitor.py and smb_share_manager.py as their own
+interpreters, the way the orchestrator does by default. shared-runtime starts
+one interpreter hosting both as threads, like `orchestrator.py
+--shared-runtime`. Startup is the time from spawning to every service having
+sent READY=1. Memory is the resident and proportional set size of the
+processes once ready; PSS splits shared library pages between processes, so
+it is the better measure of what the layout costs the board.
+
+Both layouts run the real services, so this needs root and the board's
+udev, Samba and the necris user:
+
+    sudo python3 benchmarks/runtime_bench.py --repeat 5
+"""
+
+import os
+import sys
+import time
+import socket
+import argparse
+import tempfile
+import subprocess
+
+import psutil
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICES = ('usb_monitor', 'smb_share_manager')
+
+SHARED_RUNTIME = '''
+import threading
+from shared_runtime import SharedRuntime
+from service_control import notify_ready
+
+runtime = SharedRuntime()
+pending = set(SharedRuntime.services)
+lock = threading.Lock()
+
+def ready(name):
+    with lock:
+        pending.discard(name)
+        if not pending:
+            notify_ready()
+
+for name in SharedRuntime.services:
+    runtime.spawn(name, on_ready=lambda name=name: ready(name), on_exit=lambda: None)
+threading.Event().wait()
+'''
+
+
+def memory(pids):
+    rss = pss = 0
+    for pid in pids:
+        info = psutil.Process(pid).memory_full_info()
+        rss += info.rss
+        pss += getattr(info, 'pss', info.rss)
+    return rss, pss
+
+
+def measure(commands, timeout):
+    """Start the commands, wait for READY=1 from each and return (seconds, rss, pss)"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'notify.sock')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+        sock.settimeout(timeout)
+        env = dict(os.environ, NECRIS_NOTIFY_SOCKET=path)
+
+        started = time.perf_counter()
+        processes = [subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL)
+                     for command in commands]
+        try:
+            waiting = {p.pid for p in processes}
+            while waiting:
+                fields = dict(line.split('=', 1) for line in sock.recv(4096).decode().splitlines() if '=' in line)
+                waiting.discard(int(fields.get('MAINPID', 0)))
+            elapsed = time.perf_counter() - started
+            # Let startup garbage settle before reading memory
+            time.sleep(1)
+            rss, pss = memory(p.pid for p in processes)
+        finally:
+            for p in processes:
+                p.terminate()
+            for p in processes:
+                try:
+                    p.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    p.kill()
+            sock.close()
+    return elapsed, rss, pss
+
+
+LAYOUTS = {
+    'multi-process': [[sys.executable, os.path.join(ROOT, f'{name}.py')] for name in SERVICES],
+    'shared-runtime': [[sys.executable, '-c', SHARED_RUNTIME]],
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--timeout', type=float, default=60, help='seconds to wait for READY=1')
+    args = parser.parse_args()
+
+    print(f"{'layout':<16} {'ready s':>8} {'RSS MB':>8} {'PSS MB':>8}")
+    for layout, commands in LAYOUTS.items():
+        runs = [measure(commands, args.timeout) for _ in range(args.repeat)]
+        elapsed = min(r[0] for r in runs)
+        rss = min(r[1] for r in runs)
+        pss = min(r[2] for r in runs)
+        print(f"{layout:<16} {elapsed:>8.2f} {rss / 1024 ** 2:>8.1f} {pss / 1024 ** 2:>8.1f}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
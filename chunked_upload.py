@@ -0,0 +1,301 @@
+import os
+import json
+import time
+import uuid
+import zlib
+import hashlib
+import logging
+import threading
+from collections import deque
+from dataclasses import dataclass, field, asdict
+from typing import Dict, List, Optional
+
+
+class UploadError(Exception):
+    """Raised for requests that don't match the state of an upload session"""
+    pass
+
+
+@dataclass
+class UploadSession:
+    upload_id: str
+    filename: str
+    directory: str
+    size: int
+    chunk_size: int
+    received: List[int] = field(default_factory=list)
+    created_at: float = field(default_factory=time.time)
+    updated_at: float = field(default_factory=time.time)
+
+    @property
+    def total_chunks(self) -> int:
+        return max(1, -(-self.size // self.chunk_size))
+
+    @property
+    def part_path(self) -> str:
+        return os.path.join(self.directory, f'.{self.filename}.{self.upload_id}.part')
+
+    @property
+    def target_path(self) -> str:
+        return os.path.join(self.directory, self.filename)
+
+    def chunk_length(self, index: int) -> int:
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+
+class ChunkedUploadManager:
+    """Resumable, chunked uploads written straight into the destination drive.
+
+    Creating a session preallocates a hidden part file next to the target.
+    Chunks may arrive in any order and in parallel; each one is pwrite()n at
+    its offset and checked against the length and checksum the client sent.
+    Session state is persisted after every chunk so an upload can resume after
+    a dropped connection or a server restart, and completing the upload is a
+    single atomic rename onto the final name.
+    """
+
+    BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self, state_dir: str = '/etc/necris/uploads', default_chunk_size: int = 8 * 1024 * 1024,
+                 max_chunk_size: int = 64 * 1024 * 1024, expire_after: float = 7 * 24 * 60 * 60):
+        self.logger = logging.getLogger(__name__)
+        self.state_dir = state_dir
+        self.default_chunk_size = default_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.expire_after = expire_after
+        self.sessions: Dict[str, UploadSession] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._progress: Dict[str, deque] = {}
+        # Chunk indexes being written, per upload
+        self._writing: Dict[str, set] = {}
+        self._lock = threading.Lock()
+
+        os.makedirs(state_dir, exist_ok=True)
+        self._load_sessions()
+
+    def _state_path(self, upload_id: str) -> str:
+        return os.path.join(self.state_dir, f'{upload_id}.json')
+
+    def _save(self, session: UploadSession):
+        tmp_path = self._state_path(session.upload_id) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(asdict(session), f)
+        os.replace(tmp_path, self._state_path(session.upload_id))
+
+    def _load_sessions(self):
+        for name in os.listdir(self.state_dir):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.state_dir, name), 'r') as f:
+                    session = UploadSession(**json.load(f))
+            except Exception as e:
+                self.logger.warning(f"Discarding unreadable upload state {name}: {e}")
+                os.remove(os.path.join(self.state_dir, name))
+                continue
+            if self._expired(session) or not os.path.exists(session.part_path):
+                self._discard(session)
+                continue
+            self._register(session)
+
+    def _expired(self, session: UploadSession) -> bool:
+        return time.time() - session.updated_at > self.expire_after
+
+    def _sweep(self):
+        """Drop abandoned sessions and their part files"""
+        with self._lock:
+            expired = [session for session in self.sessions.values() if self._expired(session)]
+        for session in expired:
+            self.logger.info(f"Removing abandoned upload {session.upload_id} for {session.target_path}")
+            self._discard(session)
+
+    def _register(self, session: UploadSession):
+        with self._lock:
+            self.sessions[session.upload_id] = session
+            self._locks[session.upload_id] = threading.Lock()
+            self._progress[session.upload_id] = deque(maxlen=64)
+            self._writing[session.upload_id] = set()
+
+    def _discard(self, session: UploadSession):
+        for path in (session.part_path, self._state_path(session.upload_id)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        with self._lock:
+            self.sessions.pop(session.upload_id, None)
+            self._locks.pop(session.upload_id, None)
+            self._progress.pop(session.upload_id, None)
+            self._writing.pop(session.upload_id, None)
+
+    def get(self, upload_id: str) -> UploadSession:
+        session = self.sessions.get(upload_id)
+        if session is None:
+            raise KeyError(upload_id)
+        return session
+
+    def create(self, directory: str, filename: str, size: int, chunk_size: Optional[int] = None) -> UploadSession:
+        """Start an upload session and preallocate its part file"""
+        if chunk_size is not None and (not isinstance(chunk_size, int) or isinstance(chunk_size, bool)):
+            raise UploadError('Chunk size must be an integer')
+        chunk_size = chunk_size or self.default_chunk_size
+        if size < 0 or not 0 < chunk_size <= self.max_chunk_size:
+            raise UploadError('Invalid size or chunk size')
+        self._sweep()
+
+        session = UploadSession(
+            upload_id=uuid.uuid4().hex,
+            filename=filename,
+            directory=directory,
+            size=size,
+            chunk_size=chunk_size
+        )
+        fd = os.open(session.part_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            if size:
+                try:
+                    os.posix_fallocate(fd, 0, size)
+                except OSError:
+                    # FUSE filesystems (ntfs-3g, exfat-fuse) often lack fallocate
+                    os.ftruncate(fd, size)
+        except OSError:
+            os.close(fd)
+            os.remove(session.part_path)
+            raise
+        os.close(fd)
+
+        self._save(session)
+        self._register(session)
+        self.logger.info(f"Started upload {session.upload_id} for {session.target_path} ({size} bytes)")
+        return session
+
+    def write_chunk(self, upload_id: str, index: int, stream, crc32: Optional[str] = None,
+                    sha256: Optional[str] = None) -> UploadSession:
+        """Write one chunk from a file-like stream and verify it before marking it received"""
+        session = self.get(upload_id)
+        if not 0 <= index < session.total_chunks:
+            raise UploadError(f'Chunk index {index} out of range')
+
+        lock, writing = self._locks[upload_id], self._writing[upload_id]
+        with lock:
+            if index in writing:
+                raise UploadError(f'Chunk {index} is already being written')
+            writing.add(index)
+            # The bytes on disk stop being the verified chunk as soon as a retry writes over them
+            if index in session.received:
+                session.received.remove(index)
+                self._save(session)
+        try:
+            written = self._write_chunk(session, index, stream, crc32, sha256)
+        finally:
+            with lock:
+                writing.discard(index)
+
+        with lock:
+            if index not in session.received:
+                session.received.append(index)
+                session.received.sort()
+            session.updated_at = time.time()
+            self._progress[upload_id].append((session.updated_at, written))
+            self._save(session)
+        return session
+
+    def _write_chunk(self, session: UploadSession, index: int, stream, crc32: Optional[str],
+                     sha256: Optional[str]) -> int:
+        expected_length = session.chunk_length(index)
+        offset = index * session.chunk_size
+        crc = 0
+        digest = hashlib.sha256() if sha256 else None
+        written = 0
+
+        fd = os.open(session.part_path, os.O_WRONLY)
+        try:
+            while True:
+                block = stream.read(min(self.BLOCK_SIZE, expected_length - written + 1))
+                if not block:
+                    break
+                written += len(block)
+                if written > expected_length:
+                    raise UploadError(f'Chunk {index} is larger than {expected_length} bytes')
+                crc = zlib.crc32(block, crc)
+                if digest:
+                    digest.update(block)
+                view = memoryview(block)
+                while view:
+                    n = os.pwrite(fd, view, offset)
+                    view = view[n:]
+                    offset += n
+        finally:
+            os.close(fd)
+
+        if written != expected_length:
+            raise UploadError(f'Chunk {index} has {written} bytes, expected {expected_length}')
+        if crc32 is not None and int(crc32, 16) != crc:
+            raise UploadError(f'Chunk {index} failed CRC32 check')
+        if digest and digest.hexdigest() != sha256.lower():
+            raise UploadError(f'Chunk {index} failed SHA-256 check')
+        return written
+
+    def status(self, upload_id: str) -> Dict:
+        """Progress of an upload, including which chunks are still missing"""
+        session = self.get(upload_id)
+        received = set(session.received)
+        bytes_received = sum(session.chunk_length(i) for i in received)
+
+        # Throughput over the recent chunks, falling back to the session average
+        samples = list(self._progress.get(upload_id, ()))
+        recent = [s for s in samples if time.time() - s[0] <= 10]
+        if len(recent) >= 2:
+            throughput = sum(n for _, n in recent[1:]) / max(recent[-1][0] - recent[0][0], 1e-6)
+        else:
+            throughput = bytes_received / max(session.updated_at - session.created_at, 1e-6) if received else 0
+
+        return {
+            'upload_id': session.upload_id,
+            'filename': session.filename,
+            'size': session.size,
+            'chunk_size': session.chunk_size,
+            'total_chunks': session.total_chunks,
+            'received': session.received,
+            'missing': [i for i in range(session.total_chunks) if i not in received],
+            'bytes_received': bytes_received,
+            'throughput': throughput,
+            'complete': len(received) == session.total_chunks
+        }
+
+    def complete(self, upload_id: str) -> str:
+        """Flush the part file and atomically rename it onto the target name"""
+        session = self.get(upload_id)
+        with self._locks[upload_id]:
+            if len(session.received) != session.total_chunks:
+                raise UploadError(f'{session.total_chunks - len(session.received)} chunks are still missing')
+            fd = os.open(session.part_path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            os.rename(session.part_path, session.target_path)
+            self._fsync_directory(session.directory)
+        self._discard(session)
+        self.logger.info(f"Completed upload {upload_id} to {session.target_path}")
+        return session.target_path
+
+    def _fsync_directory(self, directory: str):
+        """Persist the rename, or a power cut can leave only the part file on the drive"""
+        try:
+            fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        except OSError as e:
+            self.logger.warning(f"Could not open {directory} to sync it: {e}")
+            return
+        try:
+            os.fsync(fd)
+        except OSError as e:
+            # Some FUSE filesystems don't support fsync on directories
+            self.logger.debug(f"Could not sync directory {directory}: {e}")
+        finally:
+            os.close(fd)
+
+    def abort(self, upload_id: str):
+        """Cancel an upload and remove its part file"""
+        self._discard(self.get(upload_id))
+        self.logger.info(f"Aborted upload {upload_id}")
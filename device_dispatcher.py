@@ -0,0 +1,82 @@
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict
+
+
+class DeviceDispatcher:
+    """Runs device events on a bounded pool, in order per device and in
+    parallel across devices.
+
+    Each device has a queue of events that have not started yet, drained by
+    at most one worker at a time. New events are coalesced against that
+    queue: a repeat of the last queued action is dropped, and a remove that
+    follows a queued add replaces it, since the device is gone before it was
+    ever mounted. A flapping device therefore never has more than a remove
+    and an add waiting, however many events it sends.
+    """
+
+    def __init__(self, handler: Callable, workers: int = 4):
+        self.logger = logging.getLogger(__name__)
+        self.handler = handler
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='device-worker')
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._pending: Dict[str, deque] = {}
+        self._active = set()
+        self.coalesced = 0
+
+    def submit(self, key: str, action: str, device):
+        with self._lock:
+            pending = self._pending.setdefault(key, deque())
+            if pending and pending[-1][0] == action:
+                # Same transition already waiting, run it with the newest device info
+                pending[-1] = (action, device)
+                self.coalesced += 1
+            elif pending and pending[-1][0] == 'add' and action == 'remove':
+                pending.pop()
+                self.coalesced += 1
+                # A remove queued before the add already covers this one
+                if not pending:
+                    pending.append((action, device))
+                else:
+                    pending[-1] = (action, device)
+                    self.coalesced += 1
+            else:
+                pending.append((action, device))
+            if key in self._active:
+                return
+            self._active.add(key)
+        self._executor.submit(self._drain, key)
+
+    def _drain(self, key: str):
+        while True:
+            with self._lock:
+                pending = self._pending.get(key)
+                if not pending:
+                    self._pending.pop(key, None)
+                    self._active.discard(key)
+                    self._idle.notify_all()
+                    return
+                action, device = pending.popleft()
+            try:
+                self.handler(action, device)
+            except Exception as e:
+                self.logger.error(f"Error handling {action} for {key}: {e}")
+
+    def wait_idle(self, timeout=None) -> bool:
+        """Wait until every queued event has been handled"""
+        with self._idle:
+            return self._idle.wait_for(lambda: not self._active, timeout)
+
+    def status(self) -> Dict:
+        with self._lock:
+            return {
+                'active': sorted(self._active),
+                'pending': {key: [action for action, _ in events] for key, events in self._pending.items()},
+                'coalesced': self.coalesced
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
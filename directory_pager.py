@@ -0,0 +1,147 @@
+import os
+import json
+import heapq
+import base64
+from bisect import bisect_left, bisect_right
+from typing import Iterator, List, Optional, Tuple
+
+from listing_cache import ListingCache, ListingEntry
+
+SORT_KEYS = ('name', 'size', 'mtime', 'type')
+
+
+# Element types of sort_key() for each sort, checked on cursors from clients
+_KEY_TYPES = {
+    'name': (bool, str, str),
+    'size': (bool, int, str, str),
+    'mtime': (bool, (int, float), str, str),
+    'type': (bool, str, str, str),
+}
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def _extension(name: str) -> str:
+    return name.rsplit('.', 1)[1].lower() if '.' in name[1:] else ''
+
+
+def sort_key(sort: str, name: str, is_dir: bool, size: int = 0, mtime: float = 0.0) -> tuple:
+    """Total ordering used for pagination. Directories sort before files and the
+    raw name is the final tie-breaker, so every entry has a unique key."""
+    if sort == 'size':
+        return (not is_dir, size, name.lower(), name)
+    if sort == 'mtime':
+        return (not is_dir, mtime, name.lower(), name)
+    if sort == 'type':
+        return (not is_dir, _extension(name), name.lower(), name)
+    return (not is_dir, name.lower(), name)
+
+
+def encode_cursor(sort: str, order: str, key: tuple) -> str:
+    raw = json.dumps([sort, order, list(key)], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, sort: str, order: str) -> tuple:
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        cursor_sort, cursor_order, key = json.loads(base64.urlsafe_b64decode(padded))
+    except Exception:
+        raise InvalidCursor('Malformed cursor')
+    if cursor_sort != sort or cursor_order != order:
+        raise InvalidCursor('Cursor was issued for a different sort order')
+    types = _KEY_TYPES.get(sort, _KEY_TYPES['name'])
+    if not isinstance(key, list) or len(key) != len(types):
+        raise InvalidCursor('Malformed cursor')
+    for value, expected in zip(key, types):
+        # bool is an int, but never a valid size or mtime
+        if not isinstance(value, expected) or (expected is not bool and isinstance(value, bool)):
+            raise InvalidCursor('Malformed cursor')
+    return tuple(key)
+
+
+class DirectoryPager:
+    """Cursor-based pages over a directory listing.
+
+    Directories already held by the listing cache are paged with a binary
+    search over a sorted key list. Anything else is paged straight from
+    os.scandir with a bounded heap, so memory stays proportional to the page
+    size no matter how big the directory is, and name/type sorted pages only
+    stat() the entries they return.
+    """
+
+    def __init__(self, listing_cache: ListingCache):
+        self.listing_cache = listing_cache
+
+    def page(self, path: str, sort: str = 'name', order: str = 'asc',
+             cursor: Optional[str] = None, limit: int = 200) -> Tuple[List[ListingEntry], Optional[str]]:
+        """Return one page of entries and the cursor for the next page (None at the end)"""
+        after = decode_cursor(cursor, sort, order) if cursor else None
+        reverse = order == 'desc'
+
+        listing = self.listing_cache.peek(path)
+        if listing is not None:
+            entries, last_key = self._page_cached(listing, sort, reverse, after, limit)
+        else:
+            entries, last_key = self._page_scan(path, sort, reverse, after, limit)
+
+        next_cursor = encode_cursor(sort, order, last_key) if last_key is not None else None
+        return entries, next_cursor
+
+    def _page_cached(self, listing, sort, reverse, after, limit):
+        view = listing.views.get(sort)
+        if view is None:
+            view = sorted(
+                (sort_key(sort, e.name, e.is_dir, e.size, e.mtime), i)
+                for i, e in enumerate(listing.entries)
+            )
+            listing.views[sort] = view
+
+        if not reverse:
+            start = bisect_right(view, (after, float('inf'))) if after is not None else 0
+            selected = view[start:start + limit + 1]
+        else:
+            end = bisect_left(view, (after, -1)) if after is not None else len(view)
+            selected = view[max(0, end - limit - 1):end][::-1]
+
+        has_more = len(selected) > limit
+        selected = selected[:limit]
+        entries = [listing.entries[i] for _, i in selected]
+        last_key = selected[-1][0] if has_more else None
+        return entries, last_key
+
+    def _scan_keys(self, path, sort, reverse, after) -> Iterator[tuple]:
+        needs_stat = sort in ('size', 'mtime')
+        with os.scandir(path) as it:
+            for item in it:
+                try:
+                    is_dir = item.is_dir()
+                    if needs_stat:
+                        st = item.stat()
+                        key = sort_key(sort, item.name, is_dir, 0 if is_dir else st.st_size, st.st_mtime)
+                    else:
+                        key = sort_key(sort, item.name, is_dir)
+                except OSError:
+                    continue
+                if after is not None and (key <= after if not reverse else key >= after):
+                    continue
+                yield key, item
+
+    def _page_scan(self, path, sort, reverse, after, limit):
+        select = heapq.nlargest if reverse else heapq.nsmallest
+        selected = select(limit + 1, self._scan_keys(path, sort, reverse, after), key=lambda pair: pair[0])
+
+        has_more = len(selected) > limit
+        selected = selected[:limit]
+        entries = []
+        for key, item in selected:
+            try:
+                is_dir = item.is_dir()
+                st = item.stat()
+            except OSError:
+                continue
+            entries.append(ListingEntry(item.name, is_dir, 0 if is_dir else st.st_size, st.st_mtime))
+        last_key = selected[-1][0] if has_more else None
+        return entries, last_key
@@ -0,0 +1,143 @@
+import os
+import json
+import time
+import logging
+import threading
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+# (bucket seconds, buckets kept): a day of minutes, a month of hours, a year of days
+DEFAULT_RESOLUTIONS = ((60, 1440), (3600, 720), (86400, 365))
+
+
+class DiskHistory:
+    """Per-drive used/free history in fixed-size ring buffers at several resolutions.
+
+    Every sample lands in the current bucket of each resolution (the last
+    sample in a bucket wins), so memory and file size stay constant no matter
+    how long the history runs. The buffers are persisted as JSON.
+    """
+
+    def __init__(self, path: str, resolutions: Tuple[Tuple[int, int], ...] = DEFAULT_RESOLUTIONS):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.resolutions = tuple(sorted(resolutions))
+        self._lock = threading.Lock()
+        # drive -> resolution -> deque of [bucket_start, used, free]
+        self._series: Dict[str, Dict[int, deque]] = {}
+        self._load()
+
+    def _new_drive(self) -> Dict[int, deque]:
+        return {resolution: deque(maxlen=length) for resolution, length in self.resolutions}
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            self.logger.warning(f"Ignoring unreadable disk history {self.path}: {e}")
+            return
+        for drive, series in data.get('drives', {}).items():
+            buffers = self._new_drive()
+            for resolution, points in series.items():
+                if int(resolution) in buffers:
+                    buffers[int(resolution)].extend(points)
+            self._series[drive] = buffers
+
+    def save(self):
+        with self._lock:
+            data = {
+                'version': 1,
+                'drives': {
+                    drive: {str(resolution): list(points) for resolution, points in buffers.items()}
+                    for drive, buffers in self._series.items()
+                }
+            }
+        tmp_path = f'{self.path}.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f, separators=(',', ':'))
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            self.logger.error(f"Failed to save disk history: {e}")
+
+    def record(self, drive: str, used: int, free: int, timestamp: Optional[float] = None):
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            buffers = self._series.setdefault(drive, self._new_drive())
+            for resolution, points in buffers.items():
+                bucket = int(timestamp // resolution * resolution)
+                if points and points[-1][0] == bucket:
+                    points[-1] = [bucket, used, free]
+                else:
+                    points.append([bucket, used, free])
+
+    def drives(self) -> List[str]:
+        with self._lock:
+            return sorted(self._series)
+
+    def pick_resolution(self, since: Optional[float]) -> int:
+        """Finest resolution whose buffer reaches back to since"""
+        if since is None:
+            return self.resolutions[0][0]
+        span = time.time() - since
+        for resolution, length in self.resolutions:
+            if resolution * length >= span:
+                return resolution
+        return self.resolutions[-1][0]
+
+    def series(self, drive: str, resolution: int, since: Optional[float] = None,
+               max_points: Optional[int] = None) -> List[List[int]]:
+        with self._lock:
+            points = list(self._series.get(drive, {}).get(resolution, ()))
+        if since is not None:
+            points = [p for p in points if p[0] >= since]
+        if max_points and len(points) > max_points:
+            step = len(points) / max_points
+            # Keep the newest point, it is what the projection starts from
+            points = [points[int(i * step)] for i in range(max_points - 1)] + [points[-1]]
+        return points
+
+    def projection(self, drive: str, critical_percent: float) -> Optional[Dict]:
+        """Least-squares fill rate over the last week of hours (or day of minutes
+        for a young history), with the time left until critical and until full"""
+        with self._lock:
+            buffers = self._series.get(drive)
+            if not buffers:
+                return None
+            candidates = [list(buffers[r]) for r, _ in reversed(self.resolutions) if r <= 3600]
+        now = time.time()
+        points = None
+        for candidate in candidates:
+            window = candidate[-168:] if len(candidate) >= 3 else []
+            if window and window[-1][0] - window[0][0] > 0:
+                points = window
+                break
+        if points is None:
+            return None
+
+        n = len(points)
+        mean_t = sum(p[0] for p in points) / n
+        mean_used = sum(p[1] for p in points) / n
+        variance = sum((p[0] - mean_t) ** 2 for p in points)
+        rate = sum((p[0] - mean_t) * (p[1] - mean_used) for p in points) / variance
+
+        _, used, free = points[-1]
+        capacity = used + free
+        critical_used = capacity * critical_percent / 100
+        result = {
+            'bytes_per_day': rate * 86400,
+            'window_seconds': points[-1][0] - points[0][0],
+            'seconds_to_critical': None,
+            'seconds_to_full': None
+        }
+        if rate > 0:
+            result['seconds_to_full'] = max(0.0, free / rate - (now - points[-1][0]))
+            if used < critical_used:
+                result['seconds_to_critical'] = max(0.0, (critical_used - used) / rate - (now - points[-1][0]))
+            else:
+                result['seconds_to_critical'] = 0.0
+        return result
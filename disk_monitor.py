@@ -1,20 +1,67 @@
 import os
 import json
+import time
+import queue
 import psutil
+import logging
+import threading
 from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 from typing import Dict, List, Optional
 
+from disk_history import DiskHistory
+from io_stats import IOStats
+from mount_table import get_mount_table
+
 @dataclass
 class DiskThresholds:
     warning: int = 75  # Default warning at 75% usage
     critical: int = 90 # Default critical at 90% usage
 
 class DiskMonitor:
-    def __init__(self, base_path: str, config_path: str = '/etc/necris/disk_config.json'):
+    """Samples drive usage in a background thread and serves it from a snapshot.
+
+    Each drive's statvfs runs in a small pool with a timeout, so a stalled USB
+    drive keeps its last known values (flagged as stalled) instead of blocking
+    the sampler or a request. Subscribers get the snapshot pushed whenever a
+    drive appears, disappears, stalls, changes status or moves by push_delta
+    percentage points. I/O rates from /proc/diskstats are pushed as separate
+    'io' events on every sample while any drive is busy.
+    """
+
+    def __init__(self, base_path: str, config_path: str = '/etc/necris/disk_config.json',
+                 sample_interval: float = 10.0, drive_timeout: float = 2.0, push_delta: float = 1.0,
+                 history_save_interval: float = 300.0):
+        self.logger = logging.getLogger(__name__)
         self.base_path = base_path
         self.config_path = config_path
+        self.sample_interval = sample_interval
+        self.drive_timeout = drive_timeout
+        self.push_delta = push_delta
         self.thresholds = self._load_thresholds()
-    
+        self.history = DiskHistory(os.path.join(os.path.dirname(config_path), 'disk_history.json'))
+        self.history_save_interval = history_save_interval
+        self._history_saved_at = time.monotonic()
+        self.io_stats = IOStats()
+        self._devices: Dict[str, tuple] = {}
+        self._io_active = False
+
+        self._lock = threading.Lock()
+        self._drives: Dict[str, Dict] = {}
+        self._pushed: Dict[str, Dict] = {}
+        self._pending = {}
+        self._subscribers: List[queue.Queue] = []
+        self.sampled_at: Optional[float] = None
+        # At most one statvfs per drive is ever in flight, so a hung drive pins one worker
+        self._executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='disk-monitor')
+        self._stop = threading.Event()
+        # Set by the mount table so a plugged or removed drive is sampled right away
+        self._wakeup = threading.Event()
+        self.mount_table = get_mount_table()
+        self.mount_table.add_listener(self._on_mounts_changed)
+        self._start_lock = threading.Lock()
+        self._thread = None
+
     def _load_thresholds(self) -> DiskThresholds:
         try:
             if os.path.exists(self.config_path):
@@ -27,7 +74,7 @@ class DiskMonitor:
         except Exception:
             pass
         return DiskThresholds()
-    
+
     def save_thresholds(self, warning: int, critical: int) -> bool:
         try:
             os.makedirs(os.path.dirname(self.config_path), exist_ok=True)
@@ -37,50 +84,217 @@ class DiskMonitor:
                     'critical_threshold': critical
                 }, f)
             self.thresholds = DiskThresholds(warning=warning, critical=critical)
-            return True
         except Exception:
             return False
-    
+
+        with self._lock:
+            for drive in self._drives.values():
+                drive['status'] = self._status(drive['percent'])
+        self._publish_if_changed(force=True)
+        return True
+
+    def _status(self, used_percent: float) -> str:
+        if used_percent >= self.thresholds.critical:
+            return 'critical'
+        elif used_percent >= self.thresholds.warning:
+            return 'warning'
+        return 'normal'
+
+    def _drive_paths(self) -> Dict[str, str]:
+        return {os.path.basename(entry.mount_point): entry.mount_point
+                for entry in self.mount_table.mounts_under(self.base_path)}
+
+    def _on_mounts_changed(self, added, removed):
+        base_path = os.path.normpath(self.base_path)
+        if any(os.path.dirname(entry.mount_point) == base_path for entry in added + removed):
+            self._wakeup.set()
+
     def get_mounted_drives(self) -> List[Dict]:
-        """Get all mounted drives in the base directory"""
-        drives = []
-        try:
-            for item in os.scandir(self.base_path):
-                if item.is_dir():
-                    drive_path = item.path
-                    try:
-                        usage = psutil.disk_usage(drive_path)
-                        used_percent = usage.percent
-                        status = 'normal'
-                        
-                        if used_percent >= self.thresholds.critical:
-                            status = 'critical'
-                        elif used_percent >= self.thresholds.warning:
-                            status = 'warning'
-                            
-                        drives.append({
-                            'name': item.name,
-                            'path': drive_path,
-                            'total': usage.total,
-                            'used': usage.used,
-                            'free': usage.free,
-                            'percent': used_percent,
-                            'status': status
-                        })
-                    except (PermissionError, OSError):
-                        # Skip drives that can't be accessed
-                        continue
-        except Exception as e:
-            print(f"Error scanning drives: {e}")
-        
-        return drives
-    
-    def get_all_disk_usage(self) -> Dict:
-        """Get usage for all mounted drives and threshold settings"""
+        """Get all mounted drives in the base directory from the latest sample"""
+        self.start()
+        with self._lock:
+            return [dict(drive) for drive in self._drives.values()]
+
+    def sample(self):
+        """Take one usage sample of every drive and notify subscribers if it changed"""
+        paths = self._drive_paths()
+        futures = {}
+        for name, path in paths.items():
+            future = self._pending.get(name)
+            if future is None:
+                future = self._executor.submit(self._probe, path)
+                self._pending[name] = future
+            futures[name] = future
+
+        deadline = time.monotonic() + self.drive_timeout
+        drives = {}
+        for name, future in futures.items():
+            try:
+                usage, st_dev = future.result(timeout=max(0, deadline - time.monotonic()))
+            except FutureTimeout:
+                previous = self._drives.get(name)
+                if previous is not None:
+                    if not previous.get('stalled'):
+                        self.logger.warning(f"Drive {name} did not answer within {self.drive_timeout}s")
+                    drives[name] = dict(previous, stalled=True)
+                continue
+            except (PermissionError, OSError):
+                # Skip drives that can't be accessed
+                self._pending.pop(name, None)
+                continue
+            self._pending.pop(name, None)
+            self._devices[name] = self.io_stats.device_for(paths[name], st_dev)
+            self.history.record(name, usage.used, usage.free)
+            drives[name] = {
+                'name': name,
+                'path': paths[name],
+                'total': usage.total,
+                'used': usage.used,
+                'free': usage.free,
+                'percent': usage.percent,
+                'status': self._status(usage.percent),
+                'stalled': False,
+                'projection': self.history.projection(name, self.thresholds.critical)
+            }
+
+        # A drive that vanished while its call hung keeps the slot until the call returns
+        for name in [n for n, f in self._pending.items() if n not in paths and f.done()]:
+            del self._pending[name]
+        for name in [n for n in self._devices if n not in paths]:
+            del self._devices[name]
+            self.io_stats.forget(os.path.join(self.base_path, name))
+
+        self.io_stats.sample()
+        for name, drive in drives.items():
+            device = self._devices.get(name)
+            drive['io'] = self.io_stats.metrics(device) if device else None
+
+        with self._lock:
+            self._drives = drives
+            self.sampled_at = time.time()
+        if time.monotonic() - self._history_saved_at >= self.history_save_interval:
+            self.history.save()
+            self._history_saved_at = time.monotonic()
+        self._publish_if_changed()
+        self._publish_io(drives)
+
+    @staticmethod
+    def _probe(path: str):
+        return psutil.disk_usage(path), os.stat(path).st_dev
+
+    def _publish_io(self, drives: Dict[str, Dict]):
+        """Push I/O rates while anything is busy, plus one final update once it goes idle"""
+        io = {name: drive['io'] for name, drive in drives.items() if drive.get('io')}
+        active = any(
+            stats['in_flight'] or any(w['utilization'] for w in stats['windows'].values())
+            for stats in io.values()
+        )
+        if active or self._io_active:
+            self._broadcast('io', {'drives': io})
+        self._io_active = active
+
+    def _changed(self) -> bool:
+        if self._drives.keys() != self._pushed.keys():
+            return True
+        for name, drive in self._drives.items():
+            pushed = self._pushed[name]
+            if (drive['status'] != pushed['status'] or drive['stalled'] != pushed['stalled']
+                    or abs(drive['percent'] - pushed['percent']) >= self.push_delta):
+                return True
+        return False
+
+    def _publish_if_changed(self, force: bool = False):
+        with self._lock:
+            if not force and not self._changed():
+                return
+            self._pushed = {name: dict(drive) for name, drive in self._drives.items()}
+        self._broadcast('usage', self._snapshot())
+
+    def _broadcast(self, event: str, data: Dict):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait((event, data))
+            except queue.Full:
+                # Slow client: drop its oldest update, every update carries the full state
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    pass
+                q.put_nowait((event, data))
+
+    def subscribe(self) -> queue.Queue:
+        """Return a queue of (event, data): 'usage' snapshots when usage changes
+        noticeably and 'io' rates while drives are busy"""
+        self.start()
+        q = queue.Queue(maxsize=8)
+        with self._lock:
+            self._subscribers.append(q)
+        return q
+
+    def unsubscribe(self, q: queue.Queue):
+        with self._lock:
+            if q in self._subscribers:
+                self._subscribers.remove(q)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.sample_interval)
+            self._wakeup.clear()
+            if self._stop.is_set():
+                return
+            try:
+                self.sample()
+            except Exception as e:
+                self.logger.error(f"Disk usage sample failed: {e}")
+
+    def start(self):
+        """Take a first sample and keep sampling in the background, does nothing if already running"""
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            self.sample()
+            self._thread = threading.Thread(target=self._run, daemon=True, name='disk-monitor')
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        self.history.save()
+
+    def get_history(self, drive: Optional[str] = None, since: Optional[float] = None,
+                    resolution: Optional[int] = None, max_points: Optional[int] = None) -> Dict:
+        """Downsampled used/free series and fill-rate projections, for one drive or all of them"""
+        if resolution is None:
+            resolution = self.history.pick_resolution(since)
+        drives = [drive] if drive else self.history.drives()
         return {
-            'drives': self.get_mounted_drives(),
+            'resolution': resolution,
+            'drives': {
+                name: {
+                    'points': self.history.series(name, resolution, since, max_points),
+                    'projection': self.history.projection(name, self.thresholds.critical)
+                }
+                for name in drives
+            }
+        }
+
+    def _snapshot(self) -> Dict:
+        with self._lock:
+            drives = [dict(drive) for drive in self._drives.values()]
+        return {
+            'drives': drives,
+            'sampled_at': self.sampled_at,
             'thresholds': {
                 'warning': self.thresholds.warning,
                 'critical': self.thresholds.critical
             }
-        }
\ No newline at end of file
+        }
+
+    def get_all_disk_usage(self) -> Dict:
+        """Get usage for all mounted drives and threshold settings"""
+        self.start()
+        return self._snapshot()
@@ -0,0 +1,198 @@
+import os
+import uuid
+import mimetypes
+from urllib.parse import quote
+from typing import List, Optional, Tuple
+
+from flask import Response, request
+from werkzeug.http import http_date
+
+
+class DownloadEngine:
+    """Serves files with byte ranges and conditional requests.
+
+    ETags are derived from (inode, size, mtime) so they cost a single stat,
+    and both single-range and multi-range (multipart/byteranges) requests
+    are answered with 206 Partial Content.
+
+    File bodies avoid Python-level copies wherever the deployment allows:
+    behind a front proxy the body is handed off with X-Accel-Redirect or
+    X-Sendfile, and under a WSGI server that offers wsgi.file_wrapper
+    (gunicorn) the open file is passed through so the server can use
+    os.sendfile. Only the dev server falls back to reading large blocks,
+    with fadvise read-ahead hints to keep the USB drive streaming.
+    """
+
+    READAHEAD = 8 * 1024 * 1024
+
+    def __init__(self, block_size: int = 1024 * 1024, base_path: Optional[str] = None,
+                 sendfile_header: Optional[str] = None, accel_prefix: str = '/protected/'):
+        self.block_size = block_size
+        self.base_path = base_path
+        # 'X-Accel-Redirect' (nginx) or 'X-Sendfile' (Apache, lighttpd)
+        self.sendfile_header = sendfile_header
+        self.accel_prefix = accel_prefix
+
+    @staticmethod
+    def etag_for(st: os.stat_result) -> str:
+        return f'{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}'
+
+    @staticmethod
+    def content_disposition(filename: str, inline: bool) -> str:
+        kind = 'inline' if inline else 'attachment'
+        try:
+            filename.encode('ascii')
+            return f'{kind}; filename="{filename}"'
+        except UnicodeEncodeError:
+            return f"{kind}; filename*=UTF-8''{quote(filename)}"
+
+    def _not_modified(self, etag: str, st: os.stat_result) -> bool:
+        if request.method not in ('GET', 'HEAD'):
+            return False
+        if request.if_none_match:
+            return request.if_none_match.contains_weak(etag) or request.if_none_match.star_tag
+        if request.if_modified_since:
+            return int(st.st_mtime) <= request.if_modified_since.timestamp()
+        return False
+
+    def _range_applies(self, etag: str, st: os.stat_result) -> bool:
+        if_range = request.if_range
+        if not if_range or (if_range.etag is None and if_range.date is None):
+            return True
+        if if_range.etag is not None:
+            # If-Range requires a strong comparison
+            return not if_range.etag.startswith('W/') and if_range.etag.strip('"') == etag
+        return int(st.st_mtime) == int(if_range.date.timestamp())
+
+    @staticmethod
+    def _resolve_ranges(size: int) -> Optional[List[Tuple[int, int]]]:
+        """Satisfiable [start, stop) ranges, sorted with overlaps merged,
+        or None when the header is absent or not in bytes"""
+        header = request.range
+        if header is None or header.units != 'bytes':
+            return None
+        ranges = []
+        for start, stop in header.ranges:
+            if start < 0:
+                start, stop = max(size + start, 0), size
+            else:
+                stop = size if stop is None else min(stop, size)
+            if start < stop:
+                ranges.append((start, stop))
+
+        merged = []
+        for start, stop in sorted(ranges):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+            else:
+                merged.append((start, stop))
+        return merged
+
+    @staticmethod
+    def _advise(fd: int, offset: int, length: int, advice: int):
+        try:
+            os.posix_fadvise(fd, offset, length, advice)
+        except (AttributeError, OSError):
+            pass
+
+    def _read_range(self, path: str, start: int, stop: int):
+        with open(path, 'rb', buffering=0) as f:
+            fd = f.fileno()
+            self._advise(fd, start, stop - start, os.POSIX_FADV_SEQUENTIAL)
+            f.seek(start)
+            position = start
+            readahead_until = start
+            while position < stop:
+                if readahead_until < stop and position >= readahead_until - self.READAHEAD // 2:
+                    # Keep the next window in flight while this block goes out
+                    window = min(self.READAHEAD, stop - readahead_until)
+                    self._advise(fd, readahead_until, window, os.POSIX_FADV_WILLNEED)
+                    readahead_until += window
+                block = f.read(min(self.block_size, stop - position))
+                if not block:
+                    break
+                position += len(block)
+                yield block
+
+    def _file_body(self, path: str, start: int, stop: int):
+        """Body for a contiguous byte range, zero-copy when the WSGI server supports it"""
+        file_wrapper = request.environ.get('wsgi.file_wrapper')
+        if file_wrapper is None:
+            return self._read_range(path, start, stop)
+        f = open(path, 'rb')
+        self._advise(f.fileno(), start, stop - start, os.POSIX_FADV_SEQUENTIAL)
+        self._advise(f.fileno(), start, min(self.READAHEAD, stop - start), os.POSIX_FADV_WILLNEED)
+        # The server sends Content-Length bytes from the current offset
+        f.seek(start)
+        return file_wrapper(f, self.block_size)
+
+    def _proxy_handoff(self, path: str, headers: dict, mimetype: str) -> Response:
+        """Let the front proxy send the body, it handles ranges and conditionals itself"""
+        if self.sendfile_header.lower() == 'x-accel-redirect':
+            relative = os.path.relpath(path, self.base_path) if self.base_path else path.lstrip('/')
+            headers[self.sendfile_header] = quote(self.accel_prefix.rstrip('/') + '/' + relative)
+        else:
+            headers[self.sendfile_header] = path
+        return Response(status=200, mimetype=mimetype, headers=headers)
+
+    def _multipart(self, path: str, ranges: List[Tuple[int, int]], size: int, mimetype: str, boundary: str):
+        parts = []
+        for start, stop in ranges:
+            header = (f'\r\n--{boundary}\r\n'
+                      f'Content-Type: {mimetype}\r\n'
+                      f'Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n').encode()
+            parts.append((header, start, stop))
+        trailer = f'\r\n--{boundary}--\r\n'.encode()
+        length = sum(len(h) + stop - start for h, start, stop in parts) + len(trailer)
+
+        def generate():
+            for header, start, stop in parts:
+                yield header
+                yield from self._read_range(path, start, stop)
+            yield trailer
+
+        return generate(), length
+
+    def serve(self, path: str, inline: bool = False) -> Response:
+        """Build the response for a GET/HEAD of a regular file"""
+        st = os.stat(path)
+        size = st.st_size
+        etag = self.etag_for(st)
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+        headers = {
+            'ETag': f'"{etag}"',
+            'Last-Modified': http_date(st.st_mtime),
+            'Accept-Ranges': 'bytes',
+            'Content-Disposition': self.content_disposition(os.path.basename(path), inline),
+            'Cache-Control': 'private, no-cache'
+        }
+
+        if self._not_modified(etag, st):
+            return Response(status=304, headers=headers)
+
+        if self.sendfile_header:
+            return self._proxy_handoff(path, headers, mimetype)
+
+        ranges = self._resolve_ranges(size) if self._range_applies(etag, st) else None
+        if ranges is not None and not ranges:
+            headers['Content-Range'] = f'bytes */{size}'
+            return Response(status=416, headers=headers)
+
+        if not ranges:
+            headers['Content-Length'] = str(size)
+            return Response(self._file_body(path, 0, size), status=200, mimetype=mimetype,
+                            headers=headers, direct_passthrough=True)
+
+        if len(ranges) == 1:
+            start, stop = ranges[0]
+            headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+            headers['Content-Length'] = str(stop - start)
+            return Response(self._file_body(path, start, stop), status=206, mimetype=mimetype,
+                            headers=headers, direct_passthrough=True)
+
+        boundary = uuid.uuid4().hex
+        body, length = self._multipart(path, ranges, size, mimetype, boundary)
+        headers['Content-Length'] = str(length)
+        return Response(body, status=206, content_type=f'multipart/byteranges; boundary={boundary}',
+                        headers=headers, direct_passthrough=True)
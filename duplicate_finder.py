@@ -0,0 +1,222 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+PARTIAL_BYTES = 64 * 1024
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS hashes (
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    partial TEXT,
+    full TEXT,
+    last_seen REAL NOT NULL,
+    PRIMARY KEY (dev, ino, size, mtime_ns)
+);
+'''
+
+
+def hash_file(task: Tuple[str, bool]) -> Optional[str]:
+    """Hash a file in a worker process. Partial hashes cover the first and last
+    64 KB, which separates almost all same-size files without reading them."""
+    path, partial = task
+    digest = hashlib.blake2b(digest_size=20)
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if partial and size > 2 * PARTIAL_BYTES:
+                digest.update(f.read(PARTIAL_BYTES))
+                f.seek(size - PARTIAL_BYTES)
+                digest.update(f.read(PARTIAL_BYTES))
+            else:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(block)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+class DuplicateFinder:
+    """Finds duplicate files under the upload folder.
+
+    Candidates come from the file index, so only same-size files are ever
+    opened. They then go through a partial hash and finally a full hash in a
+    process pool. Hashes are cached by (device, inode, size, mtime), so a rescan
+    only reads files that changed since the last one.
+    """
+
+    def __init__(self, file_index, db_path: str = '/etc/necris/hash_cache.db', workers: int = 2,
+                 min_size: int = 1, forget_after: float = 30 * 24 * 60 * 60):
+        self.logger = logging.getLogger(__name__)
+        self.file_index = file_index
+        self.db_path = db_path
+        self.workers = workers
+        self.min_size = min_size
+        self.forget_after = forget_after
+
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+        self.state = 'idle'
+        self.progress = {}
+        self.result = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def start_scan(self) -> bool:
+        """Start a scan in the background, returns False if one is already running"""
+        with self._lock:
+            if self.state == 'scanning':
+                return False
+            self.state = 'scanning'
+        threading.Thread(target=self._run_scan, daemon=True).start()
+        return True
+
+    def _run_scan(self):
+        try:
+            self.result = self.scan()
+        except Exception as e:
+            self.logger.error(f"Duplicate scan failed: {e}")
+        finally:
+            self.state = 'idle'
+
+    def _hash_stage(self, conn, pool, candidates: Dict[tuple, str], column: str) -> Dict[tuple, str]:
+        """Look up or compute one hash column for {(dev, ino, size, mtime_ns): path}"""
+        hashes = {}
+        missing = []
+        for key, path in candidates.items():
+            row = conn.execute(
+                f'SELECT {column} FROM hashes WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ?', key
+            ).fetchone()
+            if row and row[0]:
+                hashes[key] = row[0]
+            else:
+                missing.append(key)
+
+        self.progress[f'{column}_cached'] = len(hashes)
+        self.progress[f'{column}_hashed'] = 0
+        tasks = [(candidates[key], column == 'partial') for key in missing]
+        for key, digest in zip(missing, pool.map(hash_file, tasks, chunksize=16)):
+            self.progress[f'{column}_hashed'] += 1
+            if digest is None:
+                continue
+            hashes[key] = digest
+            conn.execute(
+                'INSERT INTO hashes (dev, ino, size, mtime_ns, last_seen) VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT (dev, ino, size, mtime_ns) DO NOTHING',
+                (*key, time.time())
+            )
+            conn.execute(
+                f'UPDATE hashes SET {column} = ? WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ?',
+                (digest, *key)
+            )
+        conn.commit()
+        return hashes
+
+    @staticmethod
+    def _group(hashes: Dict[tuple, str]) -> List[List[tuple]]:
+        groups = defaultdict(list)
+        for key, digest in hashes.items():
+            groups[(key[2], digest)].append(key)
+        return [keys for keys in groups.values() if len(keys) > 1]
+
+    def scan(self) -> Dict:
+        """Run the size -> partial hash -> full hash pipeline and return duplicate groups"""
+        started = time.time()
+        self.progress = {'started_at': started}
+
+        # Size buckets straight from the index. Hard links share an inode and
+        # are collapsed here since deleting one frees nothing.
+        candidates = {}
+        paths_by_inode = defaultdict(list)
+        for size, paths in self.file_index.size_collisions(self.min_size):
+            for rel in paths:
+                path = os.path.join(self.file_index.base_path, rel)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if st.st_size != size:
+                    continue
+                key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+                paths_by_inode[key].append(rel)
+                candidates.setdefault(key, path)
+        self.progress['candidates'] = len(candidates)
+
+        # Forking this threaded process could copy a lock some other thread
+        # holds (logging, sqlite, the index writer) into a worker. Workers are
+        # forked from a single-threaded fork server instead; they only run
+        # hash_file and re-import the main module, which is serve.py in
+        # production and keeps its startup under __main__.
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['duplicate_finder'])
+        with self._connect() as conn, ProcessPoolExecutor(self.workers, mp_context=context) as pool:
+            by_size = defaultdict(list)
+            for key in candidates:
+                by_size[key[2]].append(key)
+            partial_candidates = {k: candidates[k] for keys in by_size.values() if len(keys) > 1 for k in keys}
+
+            partial = self._hash_stage(conn, pool, partial_candidates, 'partial')
+            full_candidates = {k: candidates[k] for keys in self._group(partial) for k in keys}
+            full = self._hash_stage(conn, pool, full_candidates, 'full')
+
+            now = time.time()
+            conn.executemany(
+                'UPDATE hashes SET last_seen = ? WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ?',
+                [(now, *key) for key in candidates]
+            )
+            conn.execute('DELETE FROM hashes WHERE last_seen < ?', (now - self.forget_after,))
+            conn.commit()
+
+        groups = []
+        reclaimable_by_drive = defaultdict(int)
+        for keys in self._group(full):
+            files = sorted(rel for key in keys for rel in paths_by_inode[key])
+            size = keys[0][2]
+            # The first copy is the one kept, every other inode is reclaimable
+            kept_inode = next(key for key in keys if files[0] in paths_by_inode[key])
+            for key in keys:
+                if key != kept_inode:
+                    reclaimable_by_drive[paths_by_inode[key][0].split(os.sep, 1)[0]] += size
+            groups.append({
+                'size': size,
+                'hash': full[keys[0]],
+                'files': [{'path': rel, 'drive': rel.split(os.sep, 1)[0]} for rel in files],
+                'reclaimable': size * (len(keys) - 1)
+            })
+        groups.sort(key=lambda g: g['reclaimable'], reverse=True)
+
+        self.logger.info(f"Duplicate scan found {len(groups)} groups in {time.time() - started:.1f}s")
+        return {
+            'finished_at': time.time(),
+            'duration': time.time() - started,
+            'groups': groups,
+            'reclaimable_by_drive': dict(reclaimable_by_drive),
+            'total_reclaimable': sum(reclaimable_by_drive.values())
+        }
+
+    def status(self, limit: int = 100) -> Dict:
+        result = self.result or {}
+        return {
+            'state': self.state,
+            'progress': self.progress,
+            'finished_at': result.get('finished_at'),
+            'groups': result.get('groups', [])[:limit],
+            'group_count': len(result.get('groups', [])),
+            'reclaimable_by_drive': result.get('reclaimable_by_drive', {}),
+            'total_reclaimable': result.get('total_reclaimable', 0)
+        }
@@ -0,0 +1,363 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from watchdog.observers import Observer
+from watchdog.events import FileSystemEventHandler
+
+from mount_table import get_mount_table
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    drive TEXT NOT NULL,
+    name TEXT NOT NULL,
+    name_lower TEXT NOT NULL,
+    ext TEXT NOT NULL,
+    is_dir INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    scan_id INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS files_name ON files(name_lower);
+CREATE INDEX IF NOT EXISTS files_ext ON files(ext);
+CREATE INDEX IF NOT EXISTS files_size ON files(size);
+CREATE INDEX IF NOT EXISTS files_mtime ON files(mtime);
+CREATE INDEX IF NOT EXISTS files_drive ON files(drive, scan_id);
+'''
+
+# Trigram index over the names for substring search, kept in step with files by triggers
+FTS_SCHEMA = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5(
+    name_lower, content='files', content_rowid='rowid', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS files_fts_insert AFTER INSERT ON files BEGIN
+    INSERT INTO files_fts(rowid, name_lower) VALUES (new.rowid, new.name_lower);
+END;
+CREATE TRIGGER IF NOT EXISTS files_fts_delete AFTER DELETE ON files BEGIN
+    INSERT INTO files_fts(files_fts, rowid, name_lower) VALUES ('delete', old.rowid, old.name_lower);
+END;
+DROP TRIGGER IF EXISTS files_fts_update;
+CREATE TRIGGER files_fts_update AFTER UPDATE OF name_lower ON files
+WHEN old.name_lower IS NOT new.name_lower BEGIN
+    INSERT INTO files_fts(files_fts, rowid, name_lower) VALUES ('delete', old.rowid, old.name_lower);
+    INSERT INTO files_fts(rowid, name_lower) VALUES (new.rowid, new.name_lower);
+END;
+'''
+
+# Trigrams can't match anything shorter, those searches scan the names instead
+MIN_TRIGRAM_LENGTH = 3
+
+
+def _like_escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+class FileIndex:
+    """SQLite catalog of every path under the upload folder.
+
+    Each mounted drive is seeded by its own walk (drives are walked in
+    parallel) and then kept current from inotify events. Drives appearing or
+    disappearing under the base path are picked up the same way the SMB share
+    manager notices mounts, so searches never have to touch the disks.
+    """
+
+    BATCH_SIZE = 2000
+
+    def __init__(self, base_path: str, db_path: str = '/etc/necris/file_index.db', max_workers: int = 4):
+        self.logger = logging.getLogger(__name__)
+        self.base_path = base_path
+        self.db_path = db_path
+        self.max_workers = max_workers
+
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._write_lock = threading.Lock()
+        self._local = threading.local()
+        self._writer = self._connect()
+        self._writer.executescript(SCHEMA)
+        self.trigram_search = self._create_fts()
+        self._writer.commit()
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='file-index')
+        self.observer = Observer()
+        self.observer.daemon = True
+        self.drive_watches = {}
+        self.indexing = set()
+        # Latest seed walk per drive, rows written by inotify events join it
+        # so the end-of-walk cleanup doesn't drop them
+        self.scan_ids = {}
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _create_fts(self) -> bool:
+        """Add the trigram index, filling it from an existing catalog the first time"""
+        exists = self._writer.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'files_fts'"
+        ).fetchone() is not None
+        try:
+            self._writer.executescript(FTS_SCHEMA)
+        except sqlite3.OperationalError as e:
+            # SQLite before 3.34 has no trigram tokenizer
+            self.logger.warning(f"Trigram search unavailable, substring searches scan every name: {e}")
+            return False
+        if not exists:
+            self._writer.execute("INSERT INTO files_fts(files_fts) VALUES ('rebuild')")
+        return True
+
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+        return conn
+
+    def _relative(self, path: str) -> str:
+        return os.path.relpath(path, self.base_path)
+
+    def _row(self, path: str, st: os.stat_result, is_dir: bool) -> tuple:
+        rel = self._relative(path)
+        drive = rel.split(os.sep, 1)[0]
+        name = os.path.basename(path)
+        ext = name.rsplit('.', 1)[1].lower() if '.' in name[1:] and not is_dir else ''
+        return (rel, drive, name, name.lower(), ext,
+                int(is_dir), 0 if is_dir else st.st_size, st.st_mtime, self.scan_ids.get(drive, 0))
+
+    def _write_rows(self, rows: List[tuple]):
+        if not rows:
+            return
+        with self._write_lock:
+            # An upsert keeps the rowid, so the trigram index is only touched on renames
+            self._writer.executemany(
+                'INSERT INTO files (path, drive, name, name_lower, ext, is_dir, size, mtime, scan_id) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT(path) DO UPDATE SET drive = excluded.drive, name = excluded.name, '
+                'name_lower = excluded.name_lower, ext = excluded.ext, is_dir = excluded.is_dir, '
+                'size = excluded.size, mtime = excluded.mtime, scan_id = excluded.scan_id',
+                rows
+            )
+            self._writer.commit()
+
+    def _delete_path(self, path: str):
+        rel = self._relative(path)
+        with self._write_lock:
+            # '0' follows '/', so the range is everything below rel on the primary key
+            self._writer.execute(
+                'DELETE FROM files WHERE path = ? OR (path >= ? AND path < ?)',
+                (rel, rel + '/', rel + '0')
+            )
+            self._writer.commit()
+
+    def _walk(self, root: str) -> Iterable[tuple]:
+        """Yield index rows for everything below root (root itself excluded)"""
+        stack = [root]
+        while stack:
+            current = stack.pop()
+            try:
+                with os.scandir(current) as it:
+                    for item in it:
+                        try:
+                            is_dir = item.is_dir(follow_symlinks=False)
+                            st = item.stat(follow_symlinks=False)
+                        except OSError:
+                            continue
+                        if is_dir:
+                            stack.append(item.path)
+                        yield self._row(item.path, st, is_dir)
+            except OSError as e:
+                self.logger.debug(f"Skipping unreadable directory {current}: {e}")
+
+    def _index_tree(self, root: str):
+        batch = []
+        for row in self._walk(root):
+            batch.append(row)
+            if len(batch) >= self.BATCH_SIZE:
+                self._write_rows(batch)
+                batch = []
+        self._write_rows(batch)
+
+    def index_drive(self, drive_path: str):
+        """Walk a drive and replace its rows, dropping anything that no longer exists"""
+        drive = os.path.basename(drive_path)
+        self.indexing.add(drive)
+        started = time.time()
+        scan_id = int(started * 1000)
+        self.scan_ids[drive] = scan_id
+        try:
+            self._watch_drive(drive_path)
+            self._index_tree(drive_path)
+            with self._write_lock:
+                self._writer.execute('DELETE FROM files WHERE drive = ? AND scan_id < ?', (drive, scan_id))
+                self._writer.commit()
+            self.logger.info(f"Indexed drive {drive} in {time.time() - started:.1f}s")
+        except Exception as e:
+            self.logger.error(f"Failed to index drive {drive}: {e}")
+        finally:
+            self.indexing.discard(drive)
+
+    def remove_drive(self, drive_path: str):
+        """Forget a drive that has been unmounted"""
+        drive = os.path.basename(drive_path)
+        watch = self.drive_watches.pop(drive, None)
+        if watch:
+            try:
+                self.observer.unschedule(watch)
+            except Exception:
+                pass
+        with self._write_lock:
+            self._writer.execute('DELETE FROM files WHERE drive = ?', (drive,))
+            self._writer.commit()
+        self.logger.info(f"Removed drive {drive} from index")
+
+    def _watch_drive(self, drive_path: str):
+        drive = os.path.basename(drive_path)
+        if drive in self.drive_watches:
+            return
+        try:
+            self.drive_watches[drive] = self.observer.schedule(
+                self.DriveChangeHandler(self), drive_path, recursive=True
+            )
+        except OSError as e:
+            # Usually fs.inotify.max_user_watches being too low for the drive
+            self.logger.warning(f"Could not watch {drive_path} for changes: {e}")
+
+    def update_path(self, path: str):
+        """Re-stat a single path after an inotify event"""
+        try:
+            st = os.stat(path, follow_symlinks=False)
+        except OSError:
+            self._delete_path(path)
+            return
+        is_dir = os.path.isdir(path) and not os.path.islink(path)
+        self._write_rows([self._row(path, st, is_dir)])
+
+    class DriveChangeHandler(FileSystemEventHandler):
+        def __init__(self, index):
+            self.index = index
+
+        def on_created(self, event):
+            self.index.update_path(event.src_path)
+            if event.is_directory:
+                # Files can land in a new directory before its watch exists
+                self.index.executor.submit(self.index._index_tree, event.src_path)
+
+        def on_modified(self, event):
+            if not event.is_directory:
+                self.index.update_path(event.src_path)
+
+        def on_deleted(self, event):
+            self.index._delete_path(event.src_path)
+
+        def on_moved(self, event):
+            self.index._delete_path(event.src_path)
+            self.index.update_path(event.dest_path)
+            if event.is_directory:
+                self.index.executor.submit(self.index._index_tree, event.dest_path)
+
+    def _on_mounts_changed(self, added, removed):
+        """Mount table listener for drives appearing in and leaving base_path"""
+        for entry in removed:
+            if os.path.dirname(entry.mount_point) == os.path.normpath(self.base_path):
+                self.remove_drive(entry.mount_point)
+        for entry in added:
+            if os.path.dirname(entry.mount_point) == os.path.normpath(self.base_path):
+                self.executor.submit(self.index_drive, entry.mount_point)
+
+    def start(self):
+        """Seed the index from every mounted drive and start following changes"""
+        self.observer.start()
+        mount_table = get_mount_table()
+        mount_table.add_listener(self._on_mounts_changed)
+
+        drives = [entry.mount_point for entry in mount_table.mounts_under(self.base_path)]
+        mounted = {os.path.basename(path) for path in drives}
+        with self._write_lock:
+            stale = [row[0] for row in self._writer.execute('SELECT DISTINCT drive FROM files')
+                     if row[0] not in mounted]
+            for drive in stale:
+                self._writer.execute('DELETE FROM files WHERE drive = ?', (drive,))
+            self._writer.commit()
+
+        for drive_path in drives:
+            self.executor.submit(self.index_drive, drive_path)
+
+    def stop(self):
+        self.observer.stop()
+        self.observer.join()
+        self.executor.shutdown(wait=False)
+
+    def size_collisions(self, min_size: int = 1) -> Iterable[Tuple[int, List[str]]]:
+        """Yield (size, paths) for every file size shared by more than one file"""
+        rows = self._reader().execute(
+            'SELECT size, path FROM files WHERE is_dir = 0 AND size IN '
+            '(SELECT size FROM files WHERE is_dir = 0 AND size >= ? GROUP BY size HAVING COUNT(*) > 1) '
+            'ORDER BY size',
+            (min_size,)
+        )
+        current_size, paths = None, []
+        for size, path in rows:
+            if size != current_size and paths:
+                yield current_size, paths
+                paths = []
+            current_size = size
+            paths.append(path)
+        if paths:
+            yield current_size, paths
+
+    def search(self, contains: Optional[str] = None, prefix: Optional[str] = None,
+               extensions: Optional[List[str]] = None, min_size: Optional[int] = None,
+               max_size: Optional[int] = None, modified_after: Optional[float] = None,
+               modified_before: Optional[float] = None, drive: Optional[str] = None,
+               kind: Optional[str] = None, limit: int = 100) -> List[Dict]:
+        """Search the catalog. All filters are optional and combined with AND"""
+        clauses, params = [], []
+        if prefix:
+            clauses.append('name_lower >= ? AND name_lower < ?')
+            params.extend([prefix.lower(), prefix.lower() + '\U0010ffff'])
+        if contains and self.trigram_search and len(contains) >= MIN_TRIGRAM_LENGTH:
+            clauses.append('rowid IN (SELECT rowid FROM files_fts WHERE files_fts MATCH ?)')
+            # A quoted phrase matches as a plain substring, whatever characters it holds
+            params.append('"' + contains.lower().replace('"', '""') + '"')
+        elif contains:
+            clauses.append("name_lower LIKE ? ESCAPE '\\'")
+            params.append('%' + _like_escape(contains.lower()) + '%')
+        if extensions:
+            clauses.append(f"ext IN ({','.join('?' * len(extensions))})")
+            params.extend(ext.lower().lstrip('.') for ext in extensions)
+        if min_size is not None:
+            clauses.append('size >= ?')
+            params.append(min_size)
+        if max_size is not None:
+            clauses.append('size <= ?')
+            params.append(max_size)
+        if modified_after is not None:
+            clauses.append('mtime >= ?')
+            params.append(modified_after)
+        if modified_before is not None:
+            clauses.append('mtime <= ?')
+            params.append(modified_before)
+        if drive:
+            clauses.append('drive = ?')
+            params.append(drive)
+        if kind in ('file', 'dir'):
+            clauses.append('is_dir = ?')
+            params.append(int(kind == 'dir'))
+
+        query = 'SELECT path, drive, name, is_dir, size, mtime FROM files'
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+        query += ' ORDER BY name_lower LIMIT ?'
+        params.append(limit)
+
+        return [
+            {'path': path, 'drive': drive, 'name': name, 'type': 'dir' if is_dir else 'file',
+             'size': size, 'mtime': mtime}
+            for path, drive, name, is_dir, size, mtime in self._reader().execute(query, params)
+        ]
@@ -0,0 +1,102 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+from typing import Dict, Optional, Tuple
+
+from mount_table import get_mount_table
+
+# Columns of /proc/diskstats after major, minor and name
+# (Documentation/admin-guide/iostats.rst). Sectors are always 512 bytes.
+FIELDS = ('reads', 'reads_merged', 'sectors_read', 'read_ms',
+          'writes', 'writes_merged', 'sectors_written', 'write_ms',
+          'in_flight', 'busy_ms', 'weighted_ms')
+SECTOR_SIZE = 512
+
+
+def read_diskstats(path: str = '/proc/diskstats') -> Dict[Tuple[int, int], Tuple[str, Tuple[int, ...]]]:
+    """Map (major, minor) to (device name, counters in FIELDS order)"""
+    stats = {}
+    with open(path, 'r') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) < 3 + len(FIELDS):
+                continue
+            stats[(int(parts[0]), int(parts[1]))] = (parts[2], tuple(int(v) for v in parts[3:3 + len(FIELDS)]))
+    return stats
+
+
+class IOStats:
+    """Per-device I/O rates from /proc/diskstats over sliding windows.
+
+    Each sample() keeps the raw counters in a short ring, and rates are the
+    difference between the newest sample and the one closest to `window`
+    seconds earlier. Drives are matched to devices by the st_dev of their
+    mount point; FUSE mounts (ntfs-3g, exfat-fuse) have an anonymous st_dev
+    and are matched through the source device in mountinfo instead.
+    """
+
+    def __init__(self, windows: Tuple[int, ...] = (10, 60, 300), max_samples: int = 64):
+        self.logger = logging.getLogger(__name__)
+        self.windows = windows
+        self._lock = threading.Lock()
+        self._samples: deque = deque(maxlen=max_samples)
+        self._fuse_devices: Dict[str, Tuple[int, int]] = {}
+
+    def sample(self):
+        try:
+            stats = read_diskstats()
+        except OSError as e:
+            self.logger.warning(f"Could not read /proc/diskstats: {e}")
+            return
+        with self._lock:
+            self._samples.append((time.monotonic(), stats))
+
+    def device_for(self, mount_point: str, st_dev: int) -> Optional[Tuple[int, int]]:
+        """(major, minor) of the block device behind a mount point"""
+        device = (os.major(st_dev), os.minor(st_dev))
+        if device[0] != 0:
+            return device
+        if mount_point not in self._fuse_devices:
+            try:
+                entry = get_mount_table().by_mount_point(mount_point)
+                source = entry.source if entry else None
+                rdev = os.stat(source).st_rdev if source and source.startswith('/dev/') else 0
+            except OSError:
+                rdev = 0
+            self._fuse_devices[mount_point] = (os.major(rdev), os.minor(rdev)) if rdev else None
+        return self._fuse_devices[mount_point]
+
+    def forget(self, mount_point: str):
+        self._fuse_devices.pop(mount_point, None)
+
+    def metrics(self, device: Tuple[int, int]) -> Optional[Dict]:
+        """Rates for one device over each window, None until there are two samples"""
+        with self._lock:
+            samples = list(self._samples)
+        if len(samples) < 2 or device not in samples[-1][1]:
+            return None
+        now, latest = samples[-1]
+        name, current = latest[device]
+
+        result = {'device': name, 'in_flight': current[FIELDS.index('in_flight')], 'windows': {}}
+        for window in self.windows:
+            # Oldest sample still inside the window, or the one just before the newest
+            then, previous = next(((t, s) for t, s in samples[:-1] if now - t <= window), samples[-2])
+            if device not in previous:
+                continue
+            elapsed = now - then
+            delta = dict(zip(FIELDS, (c - p for c, p in zip(current, previous[device][1]))))
+            result['windows'][str(window)] = {
+                'seconds': round(elapsed, 1),
+                'read_bytes_per_second': delta['sectors_read'] * SECTOR_SIZE / elapsed,
+                'write_bytes_per_second': delta['sectors_written'] * SECTOR_SIZE / elapsed,
+                'read_iops': delta['reads'] / elapsed,
+                'write_iops': delta['writes'] / elapsed,
+                'read_latency_ms': delta['read_ms'] / delta['reads'] if delta['reads'] else None,
+                'write_latency_ms': delta['write_ms'] / delta['writes'] if delta['writes'] else None,
+                'utilization': min(1.0, delta['busy_ms'] / (elapsed * 1000)),
+                'queue_depth': delta['weighted_ms'] / (elapsed * 1000)
+            }
+        return result
@@ -0,0 +1,321 @@
+import os
+import time
+import uuid
+import errno
+import shutil
+import sqlite3
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+OPERATIONS = ('delete', 'move', 'copy', 'mkdir')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    op TEXT NOT NULL,
+    destination TEXT,
+    status TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    total_items INTEGER NOT NULL,
+    done_items INTEGER NOT NULL DEFAULT 0,
+    failed_items INTEGER NOT NULL DEFAULT 0,
+    bytes_done INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS job_items (
+    job_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    status TEXT NOT NULL,
+    error TEXT,
+    PRIMARY KEY (job_id, idx)
+);
+'''
+
+# copy_file_range can't be used across filesystems on kernels before 5.3, and
+# FUSE mounts (ntfs-3g, exfat-fuse) may not support it at all
+_FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP}
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def is_within(path: str, directory: str) -> bool:
+    """True if path is directory itself or below it, after resolving symlinks.
+    A symlink as directory is taken as the link itself, that is what moves and copies act on."""
+    directory = directory.rstrip(os.sep)
+    directory = os.path.join(os.path.realpath(os.path.dirname(directory)), os.path.basename(directory))
+    path = os.path.realpath(path)
+    return path == directory or path.startswith(directory + os.sep)
+
+
+class JobManager:
+    """Runs bulk file operations as background jobs on a bounded worker pool.
+
+    Jobs and their per-item outcomes are kept in SQLite so status survives a
+    restart: queued jobs are picked up again and jobs that were mid-flight are
+    marked interrupted. Copies go through copy_file_range so file data stays
+    in the kernel even between drives.
+    """
+
+    COPY_CHUNK = 64 * 1024 * 1024
+
+    def __init__(self, base_path: str, db_path: str = '/etc/necris/jobs.db', workers: int = 2,
+                 on_change: Optional[Callable[[str], None]] = None):
+        self.logger = logging.getLogger(__name__)
+        self.base_path = base_path
+        self.db_path = db_path
+        self.on_change = on_change
+
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._db_lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='jobs')
+        self._cancelled = set()
+        self._bytes = {}
+
+    def start(self):
+        """Recover jobs left behind by the previous run"""
+        with self._db_lock:
+            self._conn.execute("UPDATE jobs SET status = 'interrupted', finished_at = ? WHERE status = 'running'",
+                               (time.time(),))
+            self._conn.commit()
+            queued = [row[0] for row in self._conn.execute("SELECT id FROM jobs WHERE status = 'queued'")]
+        for job_id in queued:
+            self.executor.submit(self._run, job_id)
+
+    def _execute(self, query: str, params=()):
+        with self._db_lock:
+            self._conn.execute(query, params)
+            self._conn.commit()
+
+    def submit(self, op: str, paths: List[str], destination: Optional[str] = None) -> Dict:
+        """Queue a job for a list of absolute paths and return its status"""
+        if op not in OPERATIONS:
+            raise ValueError(f'Unknown operation {op}')
+        if op in ('move', 'copy') and not destination:
+            raise ValueError(f'{op} needs a destination directory')
+        if not paths:
+            raise ValueError('No paths given')
+        if op in ('move', 'copy'):
+            for path in paths:
+                if is_within(destination, path):
+                    raise ValueError(f'Cannot {op} {os.path.basename(path.rstrip("/"))} into itself')
+
+        job_id = uuid.uuid4().hex
+        with self._db_lock:
+            self._conn.execute(
+                'INSERT INTO jobs (id, op, destination, status, created_at, total_items) VALUES (?, ?, ?, ?, ?, ?)',
+                (job_id, op, destination, 'queued', time.time(), len(paths))
+            )
+            self._conn.executemany(
+                'INSERT INTO job_items (job_id, idx, path, status) VALUES (?, ?, ?, ?)',
+                [(job_id, i, path, 'pending') for i, path in enumerate(paths)]
+            )
+            self._conn.commit()
+        self.executor.submit(self._run, job_id)
+        return self.get(job_id)
+
+    def cancel(self, job_id: str) -> bool:
+        job = self.get(job_id)
+        if job is None or job['status'] not in ('queued', 'running'):
+            return False
+        self._cancelled.add(job_id)
+        if job['status'] == 'queued':
+            self._execute("UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE id = ?", (time.time(), job_id))
+        return True
+
+    def _changed(self, path: str):
+        if self.on_change:
+            self.on_change(os.path.dirname(path.rstrip('/')))
+
+    def _check_cancelled(self, job_id: str):
+        if job_id in self._cancelled:
+            raise JobCancelled()
+
+    def _copy_file(self, job_id: str, src: str, dst: str):
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            src_fd, dst_fd = fsrc.fileno(), fdst.fileno()
+            size = os.fstat(src_fd).st_size
+            offset = 0
+            use_copy_file_range = hasattr(os, 'copy_file_range')
+            while offset < size:
+                self._check_cancelled(job_id)
+                count = min(self.COPY_CHUNK, size - offset)
+                copied = 0
+                if use_copy_file_range:
+                    try:
+                        copied = os.copy_file_range(src_fd, dst_fd, count, offset, offset)
+                    except OSError as e:
+                        if e.errno not in _FALLBACK_ERRNOS:
+                            raise
+                        use_copy_file_range = False
+                if not use_copy_file_range:
+                    os.lseek(dst_fd, offset, os.SEEK_SET)
+                    copied = os.sendfile(dst_fd, src_fd, offset, count)
+                if copied == 0 and use_copy_file_range:
+                    # Some filesystems report 0 instead of an error when they can't
+                    use_copy_file_range = False
+                    continue
+                if copied == 0:
+                    # Source truncated under us, a partial file must not pass as a copy
+                    raise OSError(f'short copy at {offset}/{size}')
+                offset += copied
+                self._bytes[job_id] = self._bytes.get(job_id, 0) + copied
+        try:
+            shutil.copystat(src, dst)
+        except OSError:
+            # vfat/exfat can't hold Unix modes
+            pass
+
+    def _copy_link(self, src: str, dst: str):
+        # Copied as a link, following it could pull in files from outside the drive
+        try:
+            os.symlink(os.readlink(src), dst)
+        except OSError as e:
+            # vfat/exfat have no symlinks
+            self.logger.warning(f"Skipping symlink {src}: {e}")
+
+    def _copy(self, job_id: str, src: str, dst: str):
+        if os.path.islink(src):
+            self._copy_link(src, dst)
+        elif os.path.isdir(src):
+            os.makedirs(dst, exist_ok=True)
+            for root, dirs, files in os.walk(src, followlinks=False):
+                target_root = os.path.join(dst, os.path.relpath(root, src))
+                for name in dirs:
+                    if os.path.islink(os.path.join(root, name)):
+                        self._copy_link(os.path.join(root, name), os.path.join(target_root, name))
+                    else:
+                        os.makedirs(os.path.join(target_root, name), exist_ok=True)
+                for name in files:
+                    if os.path.islink(os.path.join(root, name)):
+                        self._copy_link(os.path.join(root, name), os.path.join(target_root, name))
+                    else:
+                        self._copy_file(job_id, os.path.join(root, name), os.path.join(target_root, name))
+        else:
+            self._copy_file(job_id, src, dst)
+
+    def _delete(self, path: str):
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+    def _run_item(self, job_id: str, op: str, path: str, destination: Optional[str]):
+        if op == 'delete':
+            self._delete(path)
+        elif op == 'mkdir':
+            os.makedirs(path)
+        else:
+            # Checked on submit too, this also covers jobs queued before a restart
+            if is_within(destination, path):
+                raise ValueError(f'Cannot {op} {os.path.basename(path.rstrip("/"))} into itself')
+            target = os.path.join(destination, os.path.basename(path.rstrip('/')))
+            if os.path.lexists(target):
+                raise FileExistsError(f'{os.path.basename(target)} already exists at the destination')
+            if op == 'copy':
+                self._copy(job_id, path, target)
+            else:
+                try:
+                    os.rename(path, target)
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        raise
+                    # Moving between drives is a copy followed by a delete
+                    self._copy(job_id, path, target)
+                    self._delete(path)
+            self._changed(target)
+        self._changed(path)
+
+    def _run(self, job_id: str):
+        job = self.get(job_id)
+        if job is None or job['status'] != 'queued':
+            return
+        with self._db_lock:
+            items = self._conn.execute(
+                "SELECT idx, path FROM job_items WHERE job_id = ? AND status = 'pending' ORDER BY idx", (job_id,)
+            ).fetchall()
+            destination = self._conn.execute('SELECT destination FROM jobs WHERE id = ?', (job_id,)).fetchone()[0]
+        self._execute("UPDATE jobs SET status = 'running', started_at = ? WHERE id = ?", (time.time(), job_id))
+        self._bytes[job_id] = 0
+        done = failed = 0
+        status = 'done'
+        try:
+            for index, path in items:
+                try:
+                    self._check_cancelled(job_id)
+                    self._run_item(job_id, job['op'], path, destination)
+                    done += 1
+                    item_status, error = 'done', None
+                except JobCancelled:
+                    raise
+                except Exception as e:
+                    failed += 1
+                    item_status, error = 'failed', str(e)
+                with self._db_lock:
+                    self._conn.execute('UPDATE job_items SET status = ?, error = ? WHERE job_id = ? AND idx = ?',
+                                       (item_status, error, job_id, index))
+                    self._conn.execute('UPDATE jobs SET done_items = ?, failed_items = ?, bytes_done = ? WHERE id = ?',
+                                       (done, failed, self._bytes[job_id], job_id))
+                    self._conn.commit()
+            if failed:
+                status = 'failed' if not done else 'partial'
+        except JobCancelled:
+            status = 'cancelled'
+        finally:
+            self._execute('UPDATE jobs SET status = ?, finished_at = ?, bytes_done = ? WHERE id = ?',
+                          (status, time.time(), self._bytes.pop(job_id, 0), job_id))
+            self._cancelled.discard(job_id)
+            self.logger.info(f"Job {job_id} ({job['op']}) finished: {status}, {done} done, {failed} failed")
+
+    def _job_dict(self, row) -> Dict:
+        (job_id, op, destination, status, created_at, started_at, finished_at,
+         total_items, done_items, failed_items, bytes_done) = row
+        # Live byte count for running jobs, the table is only updated per item
+        bytes_done = self._bytes.get(job_id, bytes_done)
+        end = finished_at or time.time()
+        elapsed = end - started_at if started_at else 0
+        return {
+            'id': job_id,
+            'op': op,
+            'destination': os.path.relpath(destination, self.base_path) if destination else None,
+            'status': status,
+            'created_at': created_at,
+            'started_at': started_at,
+            'finished_at': finished_at,
+            'total_items': total_items,
+            'done_items': done_items,
+            'failed_items': failed_items,
+            'bytes_done': bytes_done,
+            'bytes_per_second': bytes_done / elapsed if elapsed else 0,
+            'items_per_second': (done_items + failed_items) / elapsed if elapsed else 0
+        }
+
+    def get(self, job_id: str, include_items: bool = False) -> Optional[Dict]:
+        with self._db_lock:
+            row = self._conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            items = self._conn.execute(
+                'SELECT idx, path, status, error FROM job_items WHERE job_id = ? ORDER BY idx', (job_id,)
+            ).fetchall() if row and include_items else []
+        if row is None:
+            return None
+        job = self._job_dict(row)
+        if include_items:
+            job['items'] = [{'index': idx, 'path': os.path.relpath(path, self.base_path), 'status': status,
+                             'error': error}
+                            for idx, path, status, error in items]
+        return job
+
+    def list(self, limit: int = 50) -> List[Dict]:
+        with self._db_lock:
+            rows = self._conn.execute('SELECT * FROM jobs ORDER BY created_at DESC LIMIT ?', (limit,)).fetchall()
+        return [self._job_dict(row) for row in rows]
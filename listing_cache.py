@@ -0,0 +1,221 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, NamedTuple, Optional, Tuple
+
+from watchdog.observers import Observer
+from watchdog.events import (
+    FileSystemEventHandler, EVENT_TYPE_CREATED, EVENT_TYPE_DELETED, EVENT_TYPE_MODIFIED, EVENT_TYPE_MOVED
+)
+
+
+class ListingEntry(NamedTuple):
+    """A single directory entry, stored as a plain tuple to keep large listings small"""
+    name: str
+    is_dir: bool
+    size: int
+    mtime: float
+
+
+@dataclass
+class DirectoryListing:
+    key: Tuple[int, int]  # (st_dev, st_ino) of the directory
+    path: str
+    mtime_ns: int
+    scanned_at_ns: int
+    entries: Tuple[ListingEntry, ...]
+    dirty: bool = False
+    watch: Optional[object] = field(default=None, repr=False)
+    # Sorted sort-key lists for /api/list, built lazily per sort order
+    views: Dict[str, list] = field(default_factory=dict, repr=False)
+
+
+class ListingCache:
+    """Per-directory listing cache keyed on the directory's (device, inode).
+
+    A cached listing is reused while the directory's mtime is unchanged and no
+    inotify event has been seen for it. Recently used directories get their own
+    non-recursive watch. watchdog spends an inotify instance and a thread on
+    every watch, and fs.inotify.max_user_instances defaults to 128 for the
+    whole user, so only max_watches directories are watched. The others are
+    trusted on mtime for max_unwatched_age seconds.
+    """
+
+    # FAT only stores mtimes with 2 second granularity, so a directory changed
+    # within this window of a scan cannot be trusted on mtime alone.
+    MTIME_GRANULARITY_NS = 2 * 1_000_000_000
+
+    def __init__(self, max_directories: int = 128, max_entries: int = 50_000,
+                 max_unwatched_age: float = 30.0, max_watches: int = 16):
+        self.logger = logging.getLogger(__name__)
+        self.max_directories = max_directories
+        # Directories bigger than this are listed but never kept in memory
+        self.max_entries = max_entries
+        self.max_unwatched_age = max_unwatched_age
+        self.max_watches = max_watches
+        self._watches = 0
+        self._listings: 'OrderedDict[Tuple[int, int], DirectoryListing]' = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.observer = Observer()
+        self.observer.daemon = True
+        try:
+            self.observer.start()
+        except Exception as e:
+            self.logger.warning(f"inotify unavailable, falling back to mtime checks: {e}")
+            self.observer = None
+
+    class DirectoryChangeHandler(FileSystemEventHandler):
+        # watchdog also reports opened/closed, which every download and
+        # thumbnail read would trigger without changing the listing
+        CHANGE_EVENTS = {EVENT_TYPE_CREATED, EVENT_TYPE_DELETED, EVENT_TYPE_MODIFIED, EVENT_TYPE_MOVED}
+
+        def __init__(self, cache, key):
+            self.cache = cache
+            self.key = key
+
+        def on_any_event(self, event):
+            if event.event_type in self.CHANGE_EVENTS:
+                self.cache._mark_dirty(self.key)
+
+    def _mark_dirty(self, key):
+        with self._lock:
+            listing = self._listings.get(key)
+            if listing:
+                listing.dirty = True
+
+    def _watch(self, key, path):
+        with self._lock:
+            if not self.observer or self._watches >= self.max_watches:
+                return None
+            self._watches += 1
+        try:
+            return self.observer.schedule(self.DirectoryChangeHandler(self, key), path, recursive=False)
+        except Exception as e:
+            self.logger.debug(f"Could not watch {path}: {e}")
+            with self._lock:
+                self._watches -= 1
+            return None
+
+    def _unwatch(self, listing):
+        if self.observer and listing.watch:
+            try:
+                self.observer.unschedule(listing.watch)
+            except Exception:
+                pass
+            listing.watch = None
+            with self._lock:
+                self._watches -= 1
+
+    def _is_fresh(self, listing: DirectoryListing, st: os.stat_result) -> bool:
+        if listing.dirty or listing.mtime_ns != st.st_mtime_ns:
+            return False
+        if listing.mtime_ns >= listing.scanned_at_ns - self.MTIME_GRANULARITY_NS:
+            # Directory was modified right around the scan, mtime may hide a later change
+            return False
+        if not listing.watch:
+            # Without inotify, file size changes don't show up in the directory mtime
+            return time.time_ns() - listing.scanned_at_ns < self.max_unwatched_age * 1_000_000_000
+        return True
+
+    def _scan(self, path: str) -> Tuple[ListingEntry, ...]:
+        entries = []
+        with os.scandir(path) as it:
+            for item in it:
+                try:
+                    is_dir = item.is_dir()
+                    st = item.stat()
+                    entries.append(ListingEntry(
+                        item.name,
+                        is_dir,
+                        0 if is_dir else st.st_size,
+                        st.st_mtime
+                    ))
+                except OSError:
+                    # Broken symlinks and entries removed mid-scan
+                    continue
+        # Sort directories first, then files
+        entries.sort(key=lambda e: (not e.is_dir, e.name.lower()))
+        return tuple(entries)
+
+    def get(self, path: str) -> DirectoryListing:
+        """Return the listing for a directory, rescanning only if it changed"""
+        st = os.stat(path)
+        key = (st.st_dev, st.st_ino)
+
+        with self._lock:
+            listing = self._listings.get(key)
+            if listing and self._is_fresh(listing, st):
+                self._listings.move_to_end(key)
+                return listing
+            watch = listing.watch if listing else None
+            if listing:
+                listing.dirty = False
+
+        # Watch before scanning so changes made during the scan are not lost
+        if watch is None:
+            watch = self._watch(key, path)
+
+        scanned_at_ns = time.time_ns()
+        entries = self._scan(path)
+        listing = DirectoryListing(
+            key=key,
+            path=path,
+            mtime_ns=st.st_mtime_ns,
+            scanned_at_ns=scanned_at_ns,
+            entries=entries,
+            watch=watch
+        )
+
+        if len(entries) > self.max_entries:
+            with self._lock:
+                self._listings.pop(key, None)
+            self._unwatch(listing)
+            return listing
+
+        with self._lock:
+            previous = self._listings.get(key)
+            evicted = []
+            if previous and previous.dirty:
+                listing.dirty = True
+            if previous and previous.watch is not listing.watch:
+                # Rescanned concurrently with its own watch, drop the other one
+                evicted.append(previous)
+            self._listings[key] = listing
+            self._listings.move_to_end(key)
+            while len(self._listings) > self.max_directories:
+                evicted.append(self._listings.popitem(last=False)[1])
+
+        for old in evicted:
+            self._unwatch(old)
+        return listing
+
+    def peek(self, path: str) -> Optional[DirectoryListing]:
+        """Return the cached listing for a directory if it is still fresh, without scanning"""
+        st = os.stat(path)
+        key = (st.st_dev, st.st_ino)
+        with self._lock:
+            listing = self._listings.get(key)
+            if listing and self._is_fresh(listing, st):
+                self._listings.move_to_end(key)
+                return listing
+        return None
+
+    def invalidate(self, path: str):
+        """Mark a directory's listing stale after a write to it"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        with self._lock:
+            listing = self._listings.get((st.st_dev, st.st_ino))
+            if listing:
+                listing.dirty = True
+
+    def stop(self):
+        if self.observer:
+            self.observer.stop()
+            self.observer.join()
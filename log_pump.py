@@ -0,0 +1,168 @@
+import os
+import time
+import logging
+import logging.handlers
+import selectors
+import threading
+from collections import deque
+from typing import Dict, List, Optional
+
+
+class LogPump:
+    """Drains the stdout and stderr of supervised children from one thread.
+
+    Every pipe is non-blocking and sits in a selector, so a child never stalls
+    on a full pipe however much it writes. Complete lines are tagged with the
+    service name, PID and stream, kept in a per-service ring of recent lines
+    and written to a size-rotated aggregate log. Writes are batched per wakeup
+    through a MemoryHandler, which bounds how many lines wait for the disk.
+    """
+
+    READ_SIZE = 65536
+    # A line longer than this is cut, so one runaway write can't grow a buffer forever
+    MAX_LINE = 16384
+
+    def __init__(self, log_path: str = '/var/log/necris/services.log', max_bytes: int = 10 * 1024 * 1024,
+                 backup_count: int = 3, recent_lines: int = 200, buffered_lines: int = 1000):
+        self.logger = logging.getLogger(__name__)
+        self.recent_lines = recent_lines
+        self.recent: Dict[str, deque] = {}
+
+        self.output = logging.getLogger('necris.services')
+        self.output.setLevel(logging.INFO)
+        self.output.propagate = False
+        try:
+            os.makedirs(os.path.dirname(log_path), exist_ok=True)
+            target = logging.handlers.RotatingFileHandler(log_path, maxBytes=max_bytes, backupCount=backup_count)
+            target.setFormatter(logging.Formatter('%(asctime)s %(service)s[%(pid)d] %(stream)s: %(message)s'))
+            # Flushes itself when full, otherwise once per pump iteration
+            self.handler = logging.handlers.MemoryHandler(buffered_lines, flushLevel=logging.CRITICAL + 1,
+                                                          target=target)
+            self.output.addHandler(self.handler)
+        except OSError as e:
+            self.logger.error(f"Cannot write service log {log_path}, keeping recent lines only: {e}")
+            self.handler = None
+
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._pending: List[tuple] = []
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, None)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True, name='log-pump')
+        self._thread.start()
+
+    def add(self, service_name: str, process):
+        """Start draining a freshly spawned child's pipes"""
+        with self._lock:
+            for stream_name in ('stdout', 'stderr'):
+                pipe = getattr(process, stream_name)
+                if pipe is not None:
+                    os.set_blocking(pipe.fileno(), False)
+                    self._pending.append((pipe, {'service': service_name, 'pid': process.pid,
+                                                 'stream': stream_name, 'partial': b''}))
+        self._wake()
+
+    def _wake(self):
+        try:
+            os.write(self._wakeup_w, b'\0')
+        except BlockingIOError:
+            pass
+
+    def get_recent(self, service_name: str, lines: Optional[int] = None) -> List[Dict]:
+        with self._lock:
+            recent = list(self.recent.get(service_name, ()))
+        if lines is not None:
+            recent = recent[-lines:] if lines > 0 else []
+        return [{'time': t, 'pid': pid, 'stream': stream, 'line': line} for t, pid, stream, line in recent]
+
+    def _emit(self, source: Dict, raw: bytes):
+        line = raw.decode('utf-8', errors='replace').rstrip('\r')
+        with self._lock:
+            ring = self.recent.setdefault(source['service'], deque(maxlen=self.recent_lines))
+            ring.append((time.time(), source['pid'], source['stream'], line))
+        if self.handler is not None:
+            self.output.info(line, extra={'service': source['service'], 'pid': source['pid'],
+                                          'stream': source['stream']})
+
+    def _drain(self, pipe, source: Dict) -> Optional[int]:
+        """Read what is available from one pipe: bytes read, 0 if nothing was, None at EOF"""
+        try:
+            data = os.read(pipe.fileno(), self.READ_SIZE)
+        except BlockingIOError:
+            return 0
+        except OSError as e:
+            self.logger.warning(f"Reading {source['service']} {source['stream']} failed: {e}")
+            data = b''
+        if not data:
+            if source['partial']:
+                self._emit(source, source['partial'])
+                source['partial'] = b''
+            return None
+
+        *lines, partial = (source['partial'] + data).split(b'\n')
+        for line in lines:
+            self._emit(source, line)
+        while len(partial) > self.MAX_LINE:
+            self._emit(source, partial[:self.MAX_LINE])
+            partial = partial[self.MAX_LINE:]
+        source['partial'] = partial
+        return len(data)
+
+    def _register_pending(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for pipe, source in pending:
+            self._selector.register(pipe, selectors.EVENT_READ, source)
+
+    def _close(self, pipe):
+        self._selector.unregister(pipe)
+        pipe.close()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._register_pending()
+            try:
+                # Output, a new child or stop() wake it through the self-pipe, idle it sleeps
+                events = self._selector.select()
+            except Exception as e:
+                self.logger.error(f"Log pump select failed: {e}")
+                time.sleep(1)
+                continue
+            for key, _ in events:
+                if key.data is None:
+                    try:
+                        while os.read(self._wakeup_r, 512):
+                            pass
+                    except BlockingIOError:
+                        pass
+                elif self._drain(key.fileobj, key.data) is None:
+                    self._close(key.fileobj)
+            self.flush()
+
+    def flush(self):
+        if self.handler is None:
+            return
+        try:
+            self.handler.flush()
+        except Exception as e:
+            self.logger.error(f"Writing service log failed: {e}")
+
+    def stop(self):
+        """Drain whatever the stopped children left in their pipes, then flush"""
+        self._stop.set()
+        self._wake()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        self._register_pending()
+        for key in list(self._selector.get_map().values()):
+            if key.data is not None:
+                while self._drain(key.fileobj, key.data):
+                    pass
+                self._close(key.fileobj)
+        self.flush()
@@ -0,0 +1,115 @@
+import os
+import logging
+from typing import Dict, Iterable, List, Optional
+
+from mount_table import MountEntry
+
+PROC_PATH = '/proc'
+# Paths reported per holding process, enough to tell what it has open
+MAX_PATHS = 5
+
+
+class MountHolders:
+    """Finds the processes that keep mounts busy, in one pass over /proc.
+
+    A process holds a mount when its cwd, root, executable, an open file or a
+    memory mapping lives on the mount's filesystem. That is decided by device
+    number alone: st_dev of each /proc/<pid>/fd entry (stat follows the magic
+    link to the open file without opening it) and the dev column of
+    /proc/<pid>/maps against the device numbers from the mount table.
+    Nothing is looked up by path under the mounts, only files processes
+    already have open, and mounts that are not asked about cost nothing.
+    Reading other users' processes needs root, like lsof did.
+    """
+
+    def __init__(self, proc_path: str = PROC_PATH):
+        self.logger = logging.getLogger(__name__)
+        self.proc_path = proc_path
+
+    def scan(self, mounts: Iterable[MountEntry]) -> Dict[str, List[Dict]]:
+        """The holders of each mount point, an empty list for the ones that are free"""
+        wanted = {}
+        holders = {}
+        for entry in mounts:
+            wanted[os.makedev(*entry.device)] = entry.mount_point
+            holders[entry.mount_point] = []
+        if not wanted:
+            return holders
+
+        own_pid = os.getpid()
+        with os.scandir(self.proc_path) as it:
+            for entry in it:
+                if not entry.name.isdigit():
+                    continue
+                pid = int(entry.name)
+                try:
+                    found = self._scan_process(entry.path, wanted)
+                except OSError:
+                    # Exited while we looked, or not readable without root
+                    continue
+                for mount_point, uses in found.items():
+                    holders[mount_point].append({
+                        'pid': pid,
+                        'command': self._read(os.path.join(entry.path, 'comm')),
+                        'self': pid == own_pid,
+                        'uses': sorted(uses),
+                        'paths': sorted({path for paths in uses.values() for path in paths if path})[:MAX_PATHS]
+                    })
+        return holders
+
+    def _scan_process(self, proc_dir: str, wanted: Dict[int, str]) -> Dict[str, Dict[str, set]]:
+        """mount point -> {use: paths} for one process"""
+        found: Dict[str, Dict[str, set]] = {}
+
+        def hold(st_dev: int, use: str, link: str):
+            mount_point = wanted.get(st_dev)
+            if mount_point is not None:
+                try:
+                    path = os.readlink(link)
+                except OSError:
+                    path = ''
+                found.setdefault(mount_point, {}).setdefault(use, set()).add(path)
+
+        for use in ('cwd', 'root', 'exe'):
+            link = os.path.join(proc_dir, use)
+            try:
+                hold(os.stat(link).st_dev, use, link)
+            except OSError:
+                pass
+
+        fd_dir = os.path.join(proc_dir, 'fd')
+        # Raises for processes that are gone, the caller skips them
+        for fd in os.listdir(fd_dir):
+            link = os.path.join(fd_dir, fd)
+            try:
+                hold(os.stat(link).st_dev, 'file', link)
+            except OSError:
+                continue
+
+        try:
+            with open(os.path.join(proc_dir, 'maps'), 'r') as f:
+                for line in f:
+                    # address perms offset dev inode path
+                    parts = line.split(None, 5)
+                    if len(parts) < 6 or parts[4] == '0':
+                        continue
+                    major, minor = parts[3].split(':')
+                    mount_point = wanted.get(os.makedev(int(major, 16), int(minor, 16)))
+                    if mount_point is not None:
+                        found.setdefault(mount_point, {}).setdefault('mmap', set()).add(parts[5].strip())
+        except (OSError, ValueError):
+            pass
+        return found
+
+    @staticmethod
+    def _read(path: str) -> Optional[str]:
+        try:
+            with open(path, 'r') as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+
+def describe(holders: List[Dict]) -> str:
+    """Short form for log lines, like 'smbd[812] (file), bash[1020] (cwd)'"""
+    return ', '.join(f"{holder['command']}[{holder['pid']}] ({', '.join(holder['uses'])})" for holder in holders)
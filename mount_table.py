@@ -0,0 +1,194 @@
+import os
+import re
+import select
+import logging
+import threading
+from dataclasses import dataclass, replace
+from typing import Callable, Dict, List, Optional, Tuple
+
+MOUNTINFO_PATH = '/proc/self/mountinfo'
+BY_UUID_PATH = '/dev/disk/by-uuid'
+
+
+def _unescape(field: str) -> str:
+    # mountinfo escapes space, tab, newline and backslash as \ooo
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), field)
+
+
+@dataclass(frozen=True)
+class MountEntry:
+    mount_id: int
+    parent_id: int
+    device: Tuple[int, int]
+    root: str
+    mount_point: str
+    options: str
+    fs_type: str
+    # What was mounted, e.g. /dev/sdb1, also for FUSE mounts like ntfs-3g
+    source: str
+    uuid: Optional[str] = None
+
+
+def parse_mountinfo(text: str) -> List[MountEntry]:
+    """Parse proc_pid_mountinfo(5), one MountEntry per line in mount order"""
+    entries = []
+    for line in text.splitlines():
+        parts = line.split()
+        try:
+            separator = parts.index('-')
+            major, minor = parts[2].split(':')
+            entries.append(MountEntry(
+                mount_id=int(parts[0]),
+                parent_id=int(parts[1]),
+                device=(int(major), int(minor)),
+                root=_unescape(parts[3]),
+                mount_point=_unescape(parts[4]),
+                options=parts[5],
+                fs_type=parts[separator + 1],
+                source=_unescape(parts[separator + 2])
+            ))
+        except (ValueError, IndexError):
+            continue
+    return entries
+
+
+class MountTable:
+    """The mounts of this process, kept current from /proc/self/mountinfo.
+
+    The kernel flags mountinfo with POLLPRI when anything is mounted or
+    unmounted, so a single thread sleeps in poll() and re-reads the file only
+    then. Entries are indexed by mount point, source device, device number and
+    filesystem UUID, and listeners get the mounts that were added and removed
+    by each change.
+    """
+
+    def __init__(self, mountinfo_path: str = MOUNTINFO_PATH):
+        self.logger = logging.getLogger(__name__)
+        self.mountinfo_path = mountinfo_path
+        self._lock = threading.Lock()
+        self._entries: Dict[int, MountEntry] = {}
+        self._by_mount_point: Dict[str, MountEntry] = {}
+        self._by_source: Dict[str, MountEntry] = {}
+        self._by_device: Dict[Tuple[int, int], MountEntry] = {}
+        self._by_uuid: Dict[str, MountEntry] = {}
+        self._listeners: List[Callable] = []
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.refresh()
+
+    def add_listener(self, callback: Callable):
+        """callback(added, removed) with lists of MountEntry, called from the watch thread"""
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback: Callable):
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+
+    def _uuids(self) -> Dict[str, str]:
+        """Device node -> filesystem UUID from udev's by-uuid links"""
+        uuids = {}
+        try:
+            with os.scandir(BY_UUID_PATH) as it:
+                for link in it:
+                    uuids[os.path.realpath(link.path)] = link.name
+        except OSError:
+            pass
+        return uuids
+
+    def refresh(self):
+        """Re-read mountinfo and tell listeners what changed"""
+        try:
+            with open(self.mountinfo_path, 'r') as f:
+                entries = parse_mountinfo(f.read())
+        except OSError as e:
+            self.logger.error(f"Cannot read {self.mountinfo_path}: {e}")
+            return
+        self._apply(entries)
+
+    def _apply(self, entries: List[MountEntry]):
+        with self._lock:
+            current = {entry.mount_id: entry for entry in entries}
+            added_ids = current.keys() - self._entries.keys()
+            removed = [self._entries[mount_id] for mount_id in self._entries.keys() - current.keys()]
+            if not added_ids and not removed:
+                return
+
+            # Only new block device mounts need a UUID, everything else keeps its entry
+            uuids = self._uuids() if any(current[i].source.startswith('/dev/') for i in added_ids) else {}
+            for mount_id in added_ids:
+                entry = current[mount_id]
+                uuid = uuids.get(entry.source)
+                if uuid:
+                    current[mount_id] = replace(entry, uuid=uuid)
+            for mount_id, entry in self._entries.items():
+                if mount_id in current:
+                    current[mount_id] = entry
+            self._entries = current
+
+            # Later mounts cover earlier ones on the same mount point
+            ordered = [current[entry.mount_id] for entry in entries]
+            self._by_mount_point = {entry.mount_point: entry for entry in ordered}
+            self._by_source = {entry.source: entry for entry in ordered if entry.source.startswith('/dev/')}
+            self._by_device = {entry.device: entry for entry in ordered}
+            self._by_uuid = {entry.uuid: entry for entry in ordered if entry.uuid}
+            added = [current[mount_id] for mount_id in added_ids]
+
+        for callback in list(self._listeners):
+            try:
+                callback(added, removed)
+            except Exception as e:
+                self.logger.error(f"Mount table listener failed: {e}")
+
+    def _watch(self):
+        with open(self.mountinfo_path, 'r') as f:
+            poller = select.poll()
+            poller.register(f, select.POLLPRI | select.POLLERR)
+            while True:
+                poller.poll()
+                f.seek(0)
+                try:
+                    self._apply(parse_mountinfo(f.read()))
+                except Exception as e:
+                    self.logger.error(f"Failed to update mount table: {e}")
+
+    def start(self):
+        """Follow mount changes in the background, does nothing if already running"""
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._watch, daemon=True, name='mount-table')
+                self._thread.start()
+        return self
+
+    def by_mount_point(self, path) -> Optional[MountEntry]:
+        return self._by_mount_point.get(os.path.normpath(str(path)))
+
+    def by_source(self, device_node: str) -> Optional[MountEntry]:
+        return self._by_source.get(device_node)
+
+    def by_device(self, device: Tuple[int, int]) -> Optional[MountEntry]:
+        return self._by_device.get(device)
+
+    def by_uuid(self, uuid: str) -> Optional[MountEntry]:
+        return self._by_uuid.get(uuid)
+
+    def is_mounted(self, path) -> bool:
+        return self.by_mount_point(path) is not None
+
+    def mounts_under(self, directory) -> List[MountEntry]:
+        """Mounts directly inside a directory, like the drives in /media/<user>"""
+        directory = os.path.normpath(str(directory))
+        return [entry for mount_point, entry in sorted(self._by_mount_point.items())
+                if os.path.dirname(mount_point) == directory]
+
+
+_shared_table = None
+_shared_lock = threading.Lock()
+
+
+def get_mount_table() -> MountTable:
+    """The process-wide MountTable, started on first use"""
+    global _shared_table
+    with _shared_lock:
+        if _shared_table is None:
+            _shared_table = MountTable().start()
+        return _shared_table
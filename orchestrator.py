@@ -6,11 +6,63 @@ import time
 import logging
 import signal
 import sys
+import argparse
 import os
+import errno
+import random
+import selectors
+import socket
+import socketserver
+import json
+import psutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, asdict, replace
 from pathlib import Path
 
+from service_control import CONTROL_SOCKET, NOTIFY_SOCKET_ENV
+from log_pump import LogPump
+from shared_runtime import SharedRuntime
+
+@dataclass
+class ResourceLimits:
+    """Per-service thresholds that get a process recycled, None disables a check"""
+    max_rss_mb: float = 256
+    max_fds: int = 512
+    max_threads: int = 64
+    max_cpu_percent: float = 90
+    # Consecutive samples over a limit before the service is recycled
+    sustained_samples: int = 3
+
+# The web server runs a thread per request and keeps client sockets open
+DEFAULT_LIMITS = {
+    'server': {'max_rss_mb': 1024, 'max_fds': 4096, 'max_threads': 256}
+}
+
+@dataclass
+class ServiceState:
+    """Supervision bookkeeping for one service"""
+    started_at: float = 0.0
+    restarts: int = 0
+    last_exit_code: int = None
+    recent_crashes: deque = field(default_factory=lambda: deque(maxlen=20))
+    crash_looping: bool = False
+    restart_due: float = None
+    exited_at: float = None
+    # Seconds from noticing an exit to the replacement being spawned
+    restart_latencies: deque = field(default_factory=lambda: deque(maxlen=20))
+    # Set when the process reports READY=1 on the notify socket
+    ready_at: float = None
+    pid: int = None
+    # Resource samples of the running process, see ServiceOrchestrator.sample_resources
+    samples: deque = field(default_factory=lambda: deque(maxlen=120))
+    # Consecutive samples over each limit
+    breaches: dict = field(default_factory=dict)
+    recycled_at: float = None
+    restart_history: deque = field(default_factory=lambda: deque(maxlen=50))
+
 class ServiceOrchestrator:
-    def __init__(self):
+    def __init__(self, shared_runtime=False):
         # Setup logging
         logging.basicConfig(
             level=logging.INFO,
@@ -19,39 +71,114 @@ class ServiceOrchestrator:
         )
         self.logger = logging.getLogger(__name__)
 
-        # Add signal file check interval (5 seconds)
-        self.signal_check_interval = 5
-        self.signal_file = '/tmp/necris_refresh_services'
-        
         # Store process handles
         self.processes = {
             'usb_monitor': None,
             'smb_share_manager': None,
             'server': None
         }
+        self.scripts = {
+            'usb_monitor': 'usb_monitor.py',
+            'smb_share_manager': 'smb_share_manager.py',
+            'server': 'serve.py'
+        }
+        # Seconds a service gets to exit after SIGTERM. The web server finishes
+        # in-flight requests first (serve.py --graceful-timeout, 10s by default).
+        self.stop_timeouts = {'server': 15}
+
+        # Crash handling: the first restart is immediate, repeated crashes back
+        # off exponentially (with jitter) up to restart_backoff_max. A service
+        # that crashes crash_loop_threshold times within crash_loop_window is
+        # flagged as crash looping and only retried every restart_backoff_max.
+        self.restart_backoff_base = 0.5
+        self.restart_backoff_max = 60
+        self.crash_loop_window = 120
+        self.crash_loop_threshold = 5
+        # A service that stayed up this long starts over with no backoff
+        self.stable_after = 60
+        self.service_state = {name: ServiceState() for name in self.processes}
+        # Services being stopped on purpose, their exit must not trigger a restart
+        self.stopping = set()
+        self.processes_lock = threading.RLock()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+
+        # Control channel for the web UI and readiness notifications from children
+        self.control_socket_path = CONTROL_SOCKET
+        self.notify_socket_path = os.path.join(os.path.dirname(CONTROL_SOCKET), 'notify.sock')
+        self.notify_socket = None
+        self.ready_condition = threading.Condition()
+        # Seconds a restart waits for READY=1 before reporting the service as merely started
+        self.ready_timeout = 15
+        self.service_locks = {name: threading.Lock() for name in self.processes}
+
+        # Children's stdout and stderr end up in /var/log/necris/services.log
+        self.log_pump = LogPump()
+
+        # Optionally run usb_monitor and smb_share_manager as threads of this process
+        self.shared_runtime = SharedRuntime() if shared_runtime else None
         
         # Threading control
         self.should_run = threading.Event()
         self.should_run.set()
         
-        # Monitor restart interval (4 hours)
-        self.monitor_restart_interval = 4 * 60 * 60
+        # Processes are sampled every resource_sample_interval seconds and
+        # recycled when they stay over their limits, at most once per recycle_cooldown
+        self.resource_sample_interval = 30
+        self.recycle_cooldown = 600
+        self.limits_path = '/etc/necris/service_limits.json'
+        self.limits = self.load_limits()
         
         # Get script directory
         self.script_dir = Path(__file__).parent.resolve()
         
-    def start_service(self, service_name, script_name):
+    def start_service(self, service_name, script_name, check_config=True):
         """Start a service and return its process handle"""
         try:
+            if self.shared_runtime is not None and service_name in self.shared_runtime.services:
+                state = self.service_state[service_name]
+                state.ready_at = None
+                state.breaches = {}
+                state.pid = None
+                process = self.shared_runtime.spawn(
+                    service_name,
+                    on_ready=lambda: self._mark_ready(service_name),
+                    on_exit=self._wake_supervisor
+                )
+                self.logger.info(f"Started {service_name} as a thread")
+                state.started_at = time.monotonic()
+                self._wake_supervisor()
+                return process
+
             script_path = self.script_dir / script_name
+            if service_name == 'server' and check_config:
+                check = subprocess.run(
+                    ['python3', str(script_path), '--check-config'],
+                    capture_output=True, text=True, timeout=60
+                )
+                if check.returncode != 0:
+                    self.logger.error(f"Not starting {service_name}, config check failed: {check.stderr.strip()}")
+                    return None
+                self.logger.info(check.stdout.strip())
+            env = dict(os.environ)
+            if self.notify_socket is not None:
+                env[NOTIFY_SOCKET_ENV] = self.notify_socket_path
+            self.service_state[service_name].ready_at = None
+            self.service_state[service_name].breaches = {}
             # USB monitor and SMB manager need root privileges
             process = subprocess.Popen(
                 ['python3', str(script_path)],
                 stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
+                stderr=subprocess.PIPE,
+                env=env
             )
             
+            self.service_state[service_name].pid = process.pid
+            self.log_pump.add(service_name, process)
             self.logger.info(f"Started {service_name} (PID: {process.pid})")
+            self.service_state[service_name].started_at = time.monotonic()
+            self._wake_supervisor()
             return process
             
         except Exception as e:
@@ -60,120 +187,449 @@ class ServiceOrchestrator:
             
     def stop_service(self, service_name):
         """Stop a service gracefully"""
+        # An explicit stop also cancels a pending crash restart
+        self.service_state[service_name].restart_due = None
         process = self.processes.get(service_name)
         if process:
+            self.stopping.add(service_name)
             try:
                 self.logger.info(f"Stopping {service_name} (PID: {process.pid})")
                 process.terminate()
                 try:
-                    process.wait(timeout=5)
+                    process.wait(timeout=self.stop_timeouts.get(service_name, 5))
                 except subprocess.TimeoutExpired:
                     self.logger.warning(f"{service_name} didn't terminate, forcing...")
                     process.kill()
                 self.processes[service_name] = None
+                self._wake_supervisor()
                 return True
             except Exception as e:
                 self.logger.error(f"Error stopping {service_name}: {e}")
                 return False
+            finally:
+                self.stopping.discard(service_name)
         return True
     
-    def refresh_handler(self, signum, frame):
-        """Handle refresh signal by restarting USB monitor and SMB share manager"""
-        self.logger.info("Received refresh signal, restarting services...")
+    def wait_ready(self, service_name, process, timeout):
+        """Wait for a process to report READY=1, returns False on timeout or exit"""
+        state = self.service_state[service_name]
+        with self.ready_condition:
+            self.ready_condition.wait_for(
+                lambda: state.ready_at is not None or process.poll() is not None or not self.should_run.is_set(),
+                timeout
+            )
+        return state.ready_at is not None and process.poll() is None
+
+    def start_named_service(self, service_name, wait_ready=True):
+        """Start a service that is not running and report how it went"""
+        started = time.monotonic()
+        with self.service_locks[service_name]:
+            state = self.service_state[service_name]
+            with self.processes_lock:
+                process = self.processes.get(service_name)
+                running = process is not None and process.poll() is None
+                if not running:
+                    # Take the slot from the supervisor: it no longer reaps the old
+                    # process and has no crash restart to run in the meantime
+                    self.processes[service_name] = None
+                    pending, state.restart_due = state.restart_due, None
+            if not running:
+                # The config check can take a while, the supervisor keeps running.
+                # The service lock keeps other starts and stops of this service out.
+                process = self.start_service(service_name, self.scripts[service_name])
+                with self.processes_lock:
+                    self.processes[service_name] = process
+                    if process is None:
+                        state.restart_due = pending
+                self._wake_supervisor()
+            if process is None:
+                return {'result': 'failed', 'seconds': time.monotonic() - started}
+            ready = self.wait_ready(service_name, process, self.ready_timeout) if wait_ready else None
+        if ready is False and process.poll() is not None:
+            result = 'exited'
+        else:
+            result = 'ready' if ready else 'started'
+        return {'result': result, 'pid': process.pid, 'seconds': time.monotonic() - started}
+
+    def restart_service(self, service_name, wait_ready=True, reason='requested', detail=None):
+        """Stop and start one service, waiting for it to report ready"""
+        self.logger.info(f"Restarting {service_name}...")
+        self._record_restart(service_name, reason, detail)
+        with self.service_locks[service_name]:
+            self.stop_service(service_name)
+        return self.start_named_service(service_name, wait_ready)
+
+    def restart_services(self, service_names, wait_ready=True):
+        """Restart independent services in parallel"""
+        with ThreadPoolExecutor(max_workers=len(service_names) or 1) as pool:
+            results = dict(zip(service_names, pool.map(
+                lambda name: self.restart_service(name, wait_ready), service_names
+            )))
+        self.logger.info(f"Restarted {', '.join(service_names)}: "
+                         + ', '.join(f"{n} {r['result']} in {r['seconds']:.2f}s" for n, r in results.items()))
+        return results
+
+    def _record_restart(self, service_name, reason, detail=None):
+        self.service_state[service_name].restart_history.append(
+            {'time': time.time(), 'reason': reason, 'detail': detail}
+        )
+
+    def load_limits(self):
+        """Resource limits per service, defaults overridden by service_limits.json"""
+        limits = {name: ResourceLimits(**DEFAULT_LIMITS.get(name, {})) for name in self.processes}
         try:
-            # Restart USB monitor
-            self.stop_service('usb_monitor')
-            time.sleep(2)  # Give it time to clean up
-            self.processes['usb_monitor'] = self.start_service('usb_monitor', 'usb_monitor.py')
-            
-            # Restart SMB share manager
-            self.stop_service('smb_share_manager')
-            time.sleep(2)  # Give it time to clean up
-            self.processes['smb_share_manager'] = self.start_service('smb_share_manager', 'smb_share_manager.py')
-            
-            self.logger.info("Services restart completed")
+            with open(self.limits_path, 'r') as f:
+                config = json.load(f)
+            for service_name, overrides in config.items():
+                if service_name in limits:
+                    limits[service_name] = replace(limits[service_name], **overrides)
+        except FileNotFoundError:
+            pass
         except Exception as e:
-            self.logger.error(f"Error during services refresh: {e}")
-            
-    def restart_usb_monitor(self):
-        """Restart the USB monitor service"""
-        self.logger.info("Restarting USB monitor...")
-        self.stop_service('usb_monitor')
-        time.sleep(2)  # Give it time to clean up
-        self.processes['usb_monitor'] = self.start_service('usb_monitor', 'usb_monitor.py')
-        
-    def monitor_service(self, service_name):
-        """Monitor a service and restart it if it crashes"""
-        while self.should_run.is_set():
-            process = self.processes.get(service_name)
-            if process:
-                return_code = process.poll()
-                if return_code is not None:
-                    self.logger.warning(f"{service_name} exited with code {return_code}, restarting...")
-                    self.processes[service_name] = self.start_service(
-                        service_name,
-                        f"{service_name.lower()}.py"
-                    )
-            time.sleep(5)
+            self.logger.error(f"Ignoring invalid {self.limits_path}: {e}")
+        return limits
 
-    def monitor_refresh_signal_file(self):
-        """Monitor for the presence of the signal file. This is sent via the UI"""
-        last_refresh_time = 0
-        
+    def sample_resources(self, service_name, process):
+        """RSS, open FDs, threads and CPU of a service including its own children (gunicorn workers)"""
+        try:
+            root = psutil.Process(process.pid)
+            tree = [root] + root.children(recursive=True)
+        except psutil.NoSuchProcess:
+            return None
+        sample = {'time': time.time(), 'pid': process.pid, 'processes': 0,
+                  'rss_bytes': 0, 'fds': 0, 'threads': 0, 'cpu_seconds': 0.0, 'cpu_percent': None}
+        for proc in tree:
+            try:
+                with proc.oneshot():
+                    sample['rss_bytes'] += proc.memory_info().rss
+                    sample['fds'] += proc.num_fds()
+                    sample['threads'] += proc.num_threads()
+                    cpu_times = proc.cpu_times()
+                    sample['cpu_seconds'] += cpu_times.user + cpu_times.system
+                sample['processes'] += 1
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+
+        samples = self.service_state[service_name].samples
+        previous = samples[-1] if samples else None
+        if previous is not None and previous['pid'] == process.pid:
+            # A gunicorn worker that exited takes its CPU time with it
+            used = max(0.0, sample['cpu_seconds'] - previous['cpu_seconds'])
+            sample['cpu_percent'] = used / max(sample['time'] - previous['time'], 1e-6) * 100
+        samples.append(sample)
+        return sample
+
+    def check_limits(self, service_name, sample):
+        """Reason to recycle a service once a limit was exceeded for sustained_samples in a row"""
+        limits = self.limits[service_name]
+        state = self.service_state[service_name]
+        checks = (
+            ('rss', sample['rss_bytes'] / 2 ** 20, limits.max_rss_mb, 'MB RSS'),
+            ('fds', sample['fds'], limits.max_fds, 'open files'),
+            ('threads', sample['threads'], limits.max_threads, 'threads'),
+            ('cpu', sample['cpu_percent'], limits.max_cpu_percent, '% CPU'),
+        )
+        reasons = []
+        for metric, value, limit, unit in checks:
+            if limit is None or value is None or value <= limit:
+                state.breaches.pop(metric, None)
+                continue
+            state.breaches[metric] = state.breaches.get(metric, 0) + 1
+            if state.breaches[metric] >= limits.sustained_samples:
+                reasons.append(f"{value:.0f} {unit} over {limit}")
+        return ', '.join(reasons) or None
+
+    def monitor_resources(self):
+        """Sample every running service and recycle the ones that stay over their limits"""
         while self.should_run.is_set():
+            time.sleep(self.resource_sample_interval)
+            with self.processes_lock:
+                processes = dict(self.processes)
+            for service_name, process in processes.items():
+                # Threads share this process, their usage can't be told apart
+                if process is None or process.poll() is not None or getattr(process, 'threaded', False):
+                    continue
+                try:
+                    sample = self.sample_resources(service_name, process)
+                    reason = self.check_limits(service_name, sample) if sample else None
+                except Exception as e:
+                    self.logger.error(f"Failed to sample {service_name}: {e}")
+                    continue
+                if reason is None:
+                    continue
+                state = self.service_state[service_name]
+                if state.recycled_at is not None and time.monotonic() - state.recycled_at < self.recycle_cooldown:
+                    continue
+                state.recycled_at = time.monotonic()
+                self.logger.warning(f"Recycling {service_name} (PID: {process.pid}): {reason}")
+                threading.Thread(
+                    target=self.restart_service,
+                    args=(service_name,),
+                    kwargs={'reason': 'resources', 'detail': reason},
+                    daemon=True
+                ).start()
+
+    def service_status(self, services=None, samples=0):
+        """Supervision state and resource usage of every service"""
+        now = time.monotonic()
+        status = {}
+        with self.processes_lock:
+            processes = {name: self.processes[name] for name in (services or self.processes)}
+        for service_name, process in processes.items():
+            state = self.service_state[service_name]
+            running = process is not None and process.poll() is None
+            status[service_name] = {
+                'running': running,
+                'threaded': getattr(process, 'threaded', False),
+                'pid': process.pid if running else None,
+                'ready': running and state.ready_at is not None,
+                'uptime': now - state.started_at if running else None,
+                'restarts': state.restarts,
+                'last_exit_code': state.last_exit_code,
+                'crash_looping': state.crash_looping,
+                'restart_pending_in': max(0, state.restart_due - now) if state.restart_due else None,
+                'restart_latencies_ms': [round(latency * 1000, 1) for latency in state.restart_latencies],
+                'restart_history': list(state.restart_history),
+                'limits': asdict(self.limits[service_name]),
+                'resources': state.samples[-1] if running and state.samples else None
+            }
+            if samples:
+                status[service_name]['samples'] = list(state.samples)[-samples:]
+        return status
+
+    def handle_command(self, request):
+        """Run one control command and return the reply"""
+        command = request.get('command')
+        services = request.get('services') or list(self.processes)
+        unknown = [name for name in services if name not in self.processes]
+        if unknown:
+            return {'status': 'error', 'message': f"Unknown service(s): {', '.join(unknown)}", 'unknown': unknown}
+        wait_ready = request.get('wait', True)
+
+        if command == 'status':
+            return {'status': 'ok', 'services': self.service_status(services, request.get('samples', 0))}
+        if command == 'logs':
+            lines = request.get('lines')
+            return {'status': 'ok', 'logs': {name: self.log_pump.get_recent(name, lines) for name in services}}
+        if command == 'restart':
+            return {'status': 'ok', 'results': self.restart_services(services, wait_ready)}
+        if command == 'start':
+            with ThreadPoolExecutor(max_workers=len(services)) as pool:
+                results = dict(zip(services, pool.map(
+                    lambda name: self.start_named_service(name, wait_ready), services
+                )))
+            return {'status': 'ok', 'results': results}
+        if command == 'stop':
+            results = {}
+            for name in services:
+                with self.service_locks[name]:
+                    results[name] = {'result': 'stopped' if self.stop_service(name) else 'failed'}
+            return {'status': 'ok', 'results': results}
+        return {'status': 'error', 'message': f'Unknown command {command}'}
+
+    class ControlRequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            orchestrator = self.server.orchestrator
             try:
-                if os.path.exists(self.signal_file):
-                    # Read the timestamp from the file
-                    with open(self.signal_file, 'r') as f:
-                        try:
-                            refresh_time = float(f.read().strip())
-                        except ValueError:
-                            refresh_time = time.time()
-                    
-                    # Only refresh if this is a new signal
-                    if refresh_time > last_refresh_time:
-                        self.logger.info("New refresh signal file found, refreshing services...")
-                        self.refresh_services()
-                        last_refresh_time = refresh_time
-                    
-                    # Remove the signal file
-                    try:
-                        os.remove(self.signal_file)
-                    except OSError:
-                        pass
-                        
+                request = json.loads(self.rfile.readline())
+                response = orchestrator.handle_command(request)
             except Exception as e:
-                self.logger.error(f"Error checking signal file: {e}")
-                
-            time.sleep(self.signal_check_interval)
+                orchestrator.logger.error(f"Control command failed: {e}")
+                response = {'status': 'error', 'message': str(e)}
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+
+    def start_control_server(self):
+        """Listen for commands on the control socket and readiness on the notify socket"""
+        os.makedirs(os.path.dirname(self.control_socket_path), mode=0o755, exist_ok=True)
+        for path in (self.control_socket_path, self.notify_socket_path):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+        self.notify_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.notify_socket.bind(self.notify_socket_path)
+        self.notify_socket.setblocking(False)
+
+        server = socketserver.ThreadingUnixStreamServer(self.control_socket_path, self.ControlRequestHandler)
+        server.daemon_threads = True
+        server.orchestrator = self
+        # Only root (the orchestrator and the services it runs) may send commands
+        os.chmod(self.control_socket_path, 0o600)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.control_server = server
+
+    def _handle_notify(self):
+        """Read readiness datagrams and mark the sending service as ready"""
+        while True:
+            try:
+                message = self.notify_socket.recv(4096).decode(errors='replace')
+            except BlockingIOError:
+                return
+            fields = dict(line.split('=', 1) for line in message.splitlines() if '=' in line)
+            if fields.get('READY') != '1':
+                continue
+            try:
+                pid = int(fields.get('MAINPID', 0))
+            except ValueError:
+                continue
+            for service_name, state in self.service_state.items():
+                if state.pid == pid:
+                    self._mark_ready(service_name)
+
+    def _mark_ready(self, service_name):
+        state = self.service_state[service_name]
+        state.ready_at = time.monotonic()
+        self.logger.info(f"{service_name} ready {state.ready_at - state.started_at:.2f}s after start")
+        with self.ready_condition:
+            self.ready_condition.notify_all()
 
-    def refresh_services(self):
-        """Restart USB monitor and SMB share manager services"""
-        self.logger.info("Refreshing services...")
+    def _wake_supervisor(self):
+        """Make the supervisor loop re-read self.processes"""
         try:
-            # Restart USB monitor
-            self.stop_service('usb_monitor')
-            time.sleep(2)  # Give it time to clean up
-            self.processes['usb_monitor'] = self.start_service('usb_monitor', 'usb_monitor.py')
-            
-            # Restart SMB share manager
-            self.stop_service('smb_share_manager')
-            time.sleep(2)  # Give it time to clean up
-            self.processes['smb_share_manager'] = self.start_service('smb_share_manager', 'smb_share_manager.py')
-            
-            self.logger.info("Services refresh completed")
-        except Exception as e:
-            self.logger.error(f"Error during services refresh: {e}")
+            os.write(self._wakeup_w, b'\0')
+        except BlockingIOError:
+            pass  # A wakeup is already pending
+
+    def _restart_delay(self, service_name):
+        """Backoff before restarting a service that just crashed"""
+        state = self.service_state[service_name]
+        now = time.monotonic()
+        if state.started_at and now - state.started_at >= self.stable_after:
+            state.recent_crashes.clear()
+        state.recent_crashes.append(now)
+        crashes = [t for t in state.recent_crashes if now - t <= self.crash_loop_window]
+
+        if len(crashes) >= self.crash_loop_threshold:
+            if not state.crash_looping:
+                self.logger.error(f"{service_name} crashed {len(crashes)} times in "
+                                  f"{self.crash_loop_window}s, backing off to {self.restart_backoff_max}s")
+            state.crash_looping = True
+            return self.restart_backoff_max
+        state.crash_looping = False
+        if len(crashes) <= 1:
+            return 0
+        delay = min(self.restart_backoff_max, self.restart_backoff_base * 2 ** (len(crashes) - 2))
+        return delay * random.uniform(0.5, 1.5)
+
+    def _handle_exit(self, service_name, process):
+        """Reap an exited child and schedule its restart unless it was stopped on purpose"""
+        return_code = process.poll()
+        if return_code is None:
+            return False
+        with self.processes_lock:
+            if self.processes.get(service_name) is not process or service_name in self.stopping:
+                return True
+            state = self.service_state[service_name]
+            state.last_exit_code = return_code
+            state.exited_at = time.monotonic()
+            delay = self._restart_delay(service_name)
+            state.restart_due = state.exited_at + delay
+            self.processes[service_name] = None
+        self._record_restart(service_name, 'crash', f'exit code {return_code}')
+        self.logger.warning(f"{service_name} exited with code {return_code}, restarting in {delay:.2f}s")
+        with self.ready_condition:
+            self.ready_condition.notify_all()
+        return True
+
+    def _restart_due_services(self):
+        now = time.monotonic()
+        for service_name, state in self.service_state.items():
+            if state.restart_due is None or state.restart_due > now:
+                continue
+            with self.processes_lock:
+                state.restart_due = None
+                if self.processes.get(service_name) is not None:
+                    continue
+                process = self.start_service(service_name, self.scripts[service_name], check_config=False)
+                self.processes[service_name] = process
+            if process is None:
+                # Spawning failed, treat it like another crash
+                state.restart_due = time.monotonic() + self._restart_delay(service_name)
+                continue
+            state.restarts += 1
+            if state.exited_at is not None:
+                latency = time.monotonic() - state.exited_at
+                state.restart_latencies.append(latency)
+                self.logger.info(f"Restarted {service_name} {latency * 1000:.1f}ms after it exited")
+
+    def supervise(self):
+        """Wait for children to exit and restart them, without polling.
+
+        Each child gets a pidfd in a selector, which becomes readable the
+        moment it exits. Without pidfd support SIGCHLD wakes the same selector
+        through signal.set_wakeup_fd. The loop only wakes up for an exit, a
+        scheduled restart or a change to self.processes.
+        """
+        selector = selectors.DefaultSelector()
+        selector.register(self._wakeup_r, selectors.EVENT_READ, None)
+        if self.notify_socket is not None:
+            selector.register(self.notify_socket, selectors.EVENT_READ, None)
+        use_sigchld = False
+        watched = {}  # service name -> (process, pidfd or None once it exited)
+
+        def enable_sigchld():
+            # Python < 3.9 or kernel < 5.3
+            signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+            signal.set_wakeup_fd(self._wakeup_w)
+            return True
+
+        def forget_pidfd(service_name):
+            process, pidfd = watched[service_name]
+            if pidfd is not None:
+                selector.unregister(pidfd)
+                os.close(pidfd)
+            watched[service_name] = (process, None)
+
+        if not hasattr(os, 'pidfd_open'):
+            use_sigchld = enable_sigchld()
 
-            
-    def periodic_monitor_restart(self):
-        """Periodically restart the USB monitor"""
         while self.should_run.is_set():
-            time.sleep(self.monitor_restart_interval)
-            if self.should_run.is_set():
-                self.logger.info("Performing periodic USB monitor restart")
-                self.restart_usb_monitor()
-                
+            # Follow processes started or stopped by other threads
+            with self.processes_lock:
+                current = dict(self.processes)
+            for service_name, (process, _) in list(watched.items()):
+                if current.get(service_name) is not process:
+                    forget_pidfd(service_name)
+                    del watched[service_name]
+            for service_name, process in current.items():
+                if process is None or service_name in watched:
+                    continue
+                pidfd = None
+                # Threads of the shared runtime wake the loop themselves when they end
+                if not use_sigchld and not getattr(process, 'threaded', False):
+                    try:
+                        pidfd = os.pidfd_open(process.pid)
+                        selector.register(pidfd, selectors.EVENT_READ, service_name)
+                    except OSError as e:
+                        # ESRCH means it is already gone, the check below handles that
+                        if e.errno == errno.ENOSYS:
+                            use_sigchld = enable_sigchld()
+                watched[service_name] = (process, pidfd)
+                # It may have died before the pidfd existed
+                if self._handle_exit(service_name, process):
+                    forget_pidfd(service_name)
+
+            due = [state.restart_due for state in self.service_state.values() if state.restart_due is not None]
+            timeout = max(0, min(due) - time.monotonic()) if due else None
+            for key, _ in selector.select(timeout):
+                if key.data is not None:
+                    if self._handle_exit(key.data, watched[key.data][0]):
+                        forget_pidfd(key.data)
+                    continue
+                if key.fileobj is self.notify_socket:
+                    self._handle_notify()
+                    continue
+                try:
+                    while os.read(self._wakeup_r, 512):
+                        pass
+                except BlockingIOError:
+                    pass
+                for service_name, (process, _) in watched.items():
+                    if use_sigchld or getattr(process, 'threaded', False):
+                        self._handle_exit(service_name, process)
+            self._restart_due_services()
+
     def signal_handler(self, signum, frame):
         """Handle shutdown signals"""
         self.logger.info(f"Received signal {signum}, shutting down...")
@@ -186,6 +642,7 @@ class ServiceOrchestrator:
         # Stop all services
         for service_name in self.processes.keys():
             self.stop_service(service_name)
+        self.log_pump.stop()
             
         self.logger.info("All services stopped")
         sys.exit(0)
@@ -199,53 +656,48 @@ class ServiceOrchestrator:
         signal.signal(signal.SIGINT, self.signal_handler)
         
         try:
+            # The control socket has to exist before children are given its path
+            self.start_control_server()
+            self.log_pump.start()
+
             # Start all services
             for service_name in self.processes.keys():
                 self.processes[service_name] = self.start_service(
                     service_name,
-                    f"{service_name.lower()}.py"
+                    self.scripts[service_name]
                 )
+                if self.processes[service_name] is None:
+                    self.service_state[service_name].restart_due = (
+                        time.monotonic() + self._restart_delay(service_name)
+                    )
                 
-            # Start service monitoring threads
-            monitor_threads = []
-            for service_name in self.processes.keys():
-                thread = threading.Thread(
-                    target=self.monitor_service,
-                    args=(service_name,),
-                    daemon=True
-                )
-                thread.start()
-                monitor_threads.append(thread)
-                
-            # Start periodic USB monitor restart thread
-            restart_thread = threading.Thread(
-                target=self.periodic_monitor_restart,
+            # Recycle services that leak or spin instead of restarting them blindly
+            resource_thread = threading.Thread(
+                target=self.monitor_resources,
                 daemon=True
             )
-            restart_thread.start()
+            resource_thread.start()
 
-            # Start signal file monitoring thread
-            self.signal_monitor_thread = threading.Thread(
-                target=self.monitor_refresh_signal_file,
-                daemon=True
-            )
-            self.signal_monitor_thread.start()
-            
-            # Keep the main thread alive
-            while self.should_run.is_set():
-                time.sleep(1)
+            # Supervise the children from the main thread until shutdown
+            self.supervise()
                 
         except Exception as e:
             self.logger.error(f"Critical error: {e}")
             self.shutdown()
 
 def main():
+    parser = argparse.ArgumentParser(description='Run and supervise the Necris services')
+    parser.add_argument('--shared-runtime', action='store_true',
+                        default=os.environ.get('NECRIS_SHARED_RUNTIME') == '1',
+                        help='run the USB monitor and SMB share manager as threads of the orchestrator')
+    args = parser.parse_args()
+
     logging.basicConfig(level=logging.DEBUG)
     if os.geteuid() != 0:
         print("This script must be run as root!")
         sys.exit(1)
         
-    orchestrator = ServiceOrchestrator()
+    orchestrator = ServiceOrchestrator(shared_runtime=args.shared_runtime)
     orchestrator.start()
 
 if __name__ == "__main__":
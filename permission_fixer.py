@@ -0,0 +1,275 @@
+import os
+import json
+import stat
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+DIRECTORY_MODE = 0o755
+FILE_MODE = 0o644
+
+
+class FixCancelled(Exception):
+    pass
+
+
+class PermissionFixer:
+    """Hands the files of an ext drive to the necris user in the background.
+
+    A pass checks every entry with fd-relative stats (os.fwalk), so renames
+    elsewhere on the drive can't redirect it, and only chowns or chmods what
+    is not already right. Re-running it on a drive that was fixed before is
+    therefore stat-only. Each top-level directory is a subtree handled by its own
+    worker. Finished subtrees are recorded per filesystem (statvfs f_fsid,
+    which ext derives from its UUID), so a pass interrupted by an unplug or
+    a restart continues with the remaining subtrees on the next mount.
+    Symlinks are left alone, following them could change files outside the
+    drive.
+    """
+
+    PROGRESS_INTERVAL = 5.0
+    # How long cancel() waits for a pass to let go of the drive
+    CANCEL_TIMEOUT = 10.0
+
+    def __init__(self, uid: int, gid: int, state_path: str = '/etc/necris/permission_fixer.json', workers: int = 4):
+        self.logger = logging.getLogger(__name__)
+        self.uid = uid
+        self.gid = gid
+        self.state_path = state_path
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='permission-fixer')
+        self._lock = threading.Lock()
+        self._cancel: Dict[str, threading.Event] = {}
+        self._threads: Dict[str, threading.Thread] = {}
+        self.state = self.load_state(state_path)
+        self._saved_at = 0.0
+        # Passes still marked running were stopped with the previous process
+        stale = [progress for progress in self.state.values() if progress.get('running')]
+        for progress in stale:
+            progress.update(running=False, interrupted=True)
+        if stale:
+            self._save_state()
+
+    @staticmethod
+    def load_state(state_path: str) -> Dict:
+        try:
+            with open(state_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_state(self):
+        with self._lock:
+            data = json.dumps(self.state)
+            self._saved_at = time.monotonic()
+        tmp_path = f'{self.state_path}.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                f.write(data)
+            os.replace(tmp_path, self.state_path)
+        except OSError as e:
+            self.logger.error(f"Failed to save permission fixer state: {e}")
+
+    def _key(self, mount_point: str) -> str:
+        return format(os.statvfs(mount_point).f_fsid, 'x')
+
+    def unfinished(self, mount_point: str) -> bool:
+        """True if a pass over this drive was started and never finished"""
+        try:
+            key = self._key(mount_point)
+        except OSError:
+            return False
+        with self._lock:
+            progress = self.state.get(key)
+            return progress is not None and progress.get('finished_at') is None
+
+    def fix(self, mount_point: str) -> bool:
+        """Start a pass over a freshly mounted drive, False if one is already running for it"""
+        with self._lock:
+            if mount_point in self._cancel:
+                return False
+            self._cancel[mount_point] = threading.Event()
+            thread = threading.Thread(target=self._run, args=(mount_point,), daemon=True,
+                                      name=f'permission-fixer-{os.path.basename(mount_point)}')
+            self._threads[mount_point] = thread
+        thread.start()
+        return True
+
+    def cancel(self, mount_point: str, timeout: Optional[float] = None) -> bool:
+        """Stop the pass over a drive about to be unmounted and wait until it has
+        closed its files there, False if it didn't in time. It resumes on the next mount."""
+        with self._lock:
+            cancelled = self._cancel.get(mount_point)
+            thread = self._threads.get(mount_point)
+        if cancelled is None:
+            return True
+        cancelled.set()
+        if thread is None or thread is threading.current_thread():
+            return True
+        thread.join(self.CANCEL_TIMEOUT if timeout is None else timeout)
+        if thread.is_alive():
+            self.logger.warning(f"Permission pass on {mount_point} still running after cancel")
+            return False
+        return True
+
+    def cancel_all(self):
+        """Stop every running pass, when the USB monitor itself stops"""
+        with self._lock:
+            mount_points = list(self._cancel)
+        for mount_point in mount_points:
+            self.cancel(mount_point)
+
+    def _fix_entry(self, name, st: os.stat_result, mode: int, dir_fd: Optional[int] = None,
+                   fd: Optional[int] = None) -> bool:
+        """chown/chmod one entry if needed, True if anything was changed"""
+        changed = False
+        if st.st_uid != self.uid or st.st_gid != self.gid:
+            if fd is not None:
+                os.fchown(fd, self.uid, self.gid)
+            else:
+                os.chown(name, self.uid, self.gid, dir_fd=dir_fd, follow_symlinks=False)
+            changed = True
+        if stat.S_IMODE(st.st_mode) != mode:
+            if fd is not None:
+                os.fchmod(fd, mode)
+            else:
+                os.chmod(name, mode, dir_fd=dir_fd)
+            changed = True
+        return changed
+
+    def _interrupted(self, mount_point: str) -> bool:
+        """Cancelled, or the drive went away under the pass"""
+        return self._cancel[mount_point].is_set() or not os.path.ismount(mount_point)
+
+    def _fix_subtree(self, mount_point: str, name: str, progress: Dict) -> int:
+        """Walk one top-level directory, returns how many entries failed"""
+        cancelled = self._cancel[mount_point]
+        if cancelled.is_set():
+            raise FixCancelled()
+        checked = fixed = errors = 0
+        total_errors = 0
+        unlisted = []
+        last_report = time.monotonic()
+        # fwalk skips directories it can't list unless told, an unplug looks like that
+        for dirpath, dirnames, filenames, dirfd in os.fwalk(os.path.join(mount_point, name), follow_symlinks=False,
+                                                            onerror=unlisted.append):
+            if cancelled.is_set():
+                raise FixCancelled()
+            try:
+                fixed += self._fix_entry(None, os.fstat(dirfd), DIRECTORY_MODE, fd=dirfd)
+            except OSError as e:
+                errors += 1
+                self.logger.debug(f"Cannot fix {dirpath}: {e}")
+            checked += 1
+            for filename in filenames:
+                if cancelled.is_set():
+                    raise FixCancelled()
+                try:
+                    st = os.stat(filename, dir_fd=dirfd, follow_symlinks=False)
+                    # fwalk lists symlinks (and sockets, fifos) among the files
+                    if stat.S_ISREG(st.st_mode):
+                        fixed += self._fix_entry(filename, st, FILE_MODE, dir_fd=dirfd)
+                except OSError as e:
+                    errors += 1
+                    self.logger.debug(f"Cannot fix {os.path.join(dirpath, filename)}: {e}")
+                checked += 1
+
+            if time.monotonic() - last_report >= self.PROGRESS_INTERVAL:
+                self._add_progress(progress, checked, fixed, errors)
+                total_errors += errors
+                checked = fixed = errors = 0
+                last_report = time.monotonic()
+        for e in unlisted:
+            self.logger.debug(f"Cannot list {e.filename}: {e}")
+        errors += len(unlisted)
+        self._add_progress(progress, checked, fixed, errors)
+        return total_errors + errors
+
+    def _add_progress(self, progress: Dict, checked: int, fixed: int, errors: int):
+        with self._lock:
+            progress['checked'] += checked
+            progress['fixed'] += fixed
+            progress['errors'] += errors
+            progress['updated_at'] = time.time()
+            save = time.monotonic() - self._saved_at >= self.PROGRESS_INTERVAL
+        # Keeps the state file (and /api/permission-fixes) current inside a big subtree
+        if save:
+            self._save_state()
+
+    def _run(self, mount_point: str):
+        try:
+            key = self._key(mount_point)
+            with self._lock:
+                previous = self.state.get(key)
+                # A finished pass is redone in full (stat-only where nothing changed),
+                # an interrupted one keeps its finished subtrees
+                resume = previous is not None and previous.get('finished_at') is None
+                progress = previous if resume else {
+                    'done': [], 'checked': 0, 'fixed': 0, 'errors': 0, 'started_at': time.time()
+                }
+                progress.update(mount_point=mount_point, finished_at=None, running=True, interrupted=False)
+                self.state[key] = progress
+
+            root_fd = os.open(mount_point, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                self._fix_entry(None, os.fstat(root_fd), DIRECTORY_MODE, fd=root_fd)
+                subtrees = []
+                with os.scandir(root_fd) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            subtrees.append(entry.name)
+                        elif entry.is_file(follow_symlinks=False):
+                            self._fix_entry(entry.name, entry.stat(follow_symlinks=False), FILE_MODE, dir_fd=root_fd)
+            finally:
+                os.close(root_fd)
+
+            remaining = [name for name in subtrees if name not in progress['done']]
+            progress['subtrees'] = len(subtrees)
+            if resume:
+                self.logger.info(f"Resuming permission pass on {mount_point}: "
+                                 f"{len(remaining)} of {len(subtrees)} directories left")
+            futures = {name: self._executor.submit(self._fix_subtree, mount_point, name, progress)
+                       for name in remaining}
+            for name, future in futures.items():
+                try:
+                    failed = future.result()
+                except FixCancelled:
+                    continue
+                except OSError as e:
+                    # An unplug shows up as errors too, only a real failure is worth a warning
+                    if not self._interrupted(mount_point):
+                        self.logger.warning(f"Permission pass skipped {os.path.join(mount_point, name)}: {e}")
+                    continue
+                # A walk cut short by an unplug ends normally with errors, only a
+                # clean one counts as done. The others are walked again on resume.
+                if failed or self._interrupted(mount_point):
+                    continue
+                with self._lock:
+                    progress['done'].append(name)
+                self._save_state()
+
+            if self._interrupted(mount_point):
+                progress['interrupted'] = True
+                self.logger.info(f"Permission pass on {mount_point} interrupted, "
+                                 f"{len(progress['done'])} of {len(subtrees)} directories done")
+            else:
+                progress['finished_at'] = time.time()
+                self.logger.info(f"Permission pass on {mount_point} finished in "
+                                 f"{progress['finished_at'] - progress['started_at']:.0f}s: "
+                                 f"{progress['checked']} checked, {progress['fixed']} fixed")
+        except Exception as e:
+            self.logger.error(f"Permission pass on {mount_point} failed: {e}")
+        finally:
+            with self._lock:
+                self._cancel.pop(mount_point, None)
+                self._threads.pop(mount_point, None)
+                for progress in self.state.values():
+                    if progress.get('mount_point') == mount_point:
+                        progress['running'] = False
+            self._save_state()
+
+    def status(self) -> Dict:
+        with self._lock:
+            return json.loads(json.dumps(self.state))
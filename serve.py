@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""Production entry point for the web UI.
+
+Serves server.app with gunicorn's threaded worker when gunicorn is installed
+and falls back to werkzeug's threaded server otherwise. Neither runs the
+debugger or the reloader. Transfers are I/O bound and sendfile releases the
+GIL, so threads are the only knob: upload sessions, job cancellation,
+duplicate scan results, indexing state, disk thresholds and the disk history
+live in the server process, so it always runs as a single worker.
+
+Settings come from the command line or NECRIS_* environment variables.
+`serve.py --check-config` imports the app, validates the settings and exits,
+the orchestrator runs it before every launch.
+"""
+
+import os
+import sys
+import signal
+import logging
+import argparse
+import threading
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:  # Debian's python3-gunicorn, without it werkzeug serves the app
+    BaseApplication = None
+
+from service_control import notify_ready
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the Necris web UI')
+    parser.add_argument('--bind', default=os.environ.get('NECRIS_BIND', '0.0.0.0:80'),
+                        help='host:port to listen on')
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('NECRIS_WORKERS', 1)),
+                        help='worker processes, must be 1')
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('NECRIS_THREADS', 32)),
+                        help='request threads per worker')
+    parser.add_argument('--keepalive', type=int, default=int(os.environ.get('NECRIS_KEEPALIVE', 5)),
+                        help='seconds an idle keep-alive connection is held open')
+    parser.add_argument('--graceful-timeout', type=int, default=int(os.environ.get('NECRIS_GRACEFUL_TIMEOUT', 10)),
+                        help='seconds in-flight requests get to finish on shutdown')
+    parser.add_argument('--check-config', action='store_true',
+                        help='load the app and validate the settings, then exit')
+    return parser.parse_args(argv)
+
+
+def split_bind(bind):
+    host, _, port = bind.rpartition(':')
+    return host or '0.0.0.0', int(port)
+
+
+def check_config(args, load_app=True):
+    """Return a list of problems with the settings (and the app), empty if it can be served"""
+    problems = []
+    try:
+        split_bind(args.bind)
+    except ValueError:
+        problems.append(f'Invalid bind address {args.bind}')
+    if args.threads < 1:
+        problems.append('--threads must be at least 1')
+    if args.workers != 1:
+        problems.append('--workers must be 1: upload sessions, jobs, duplicate scans, disk thresholds and '
+                        'history are kept in the server process, raise --threads instead')
+    if args.keepalive < 0 or args.graceful_timeout < 0:
+        problems.append('Timeouts must not be negative')
+    if not load_app:
+        return problems
+
+    try:
+        import server
+        server.app.jinja_env.get_template('index.html')
+        os.makedirs(server.UPLOAD_FOLDER, exist_ok=True)
+    except Exception as e:
+        problems.append(f'Failed to load the app: {e}')
+    return problems
+
+
+def when_ready(arbiter):
+    # The listening socket is bound, tell the orchestrator the restart is done
+    notify_ready()
+
+
+def post_worker_init(worker):
+    import server
+    server.start_background_services()
+
+
+if BaseApplication is not None:
+    class GunicornApplication(BaseApplication):
+        def __init__(self, options):
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            # Imported here so every worker opens its own databases and watches after the fork
+            import server
+            return server.app
+
+
+def serve_gunicorn(args):
+    GunicornApplication({
+        'bind': args.bind,
+        'workers': args.workers,
+        'worker_class': 'gthread',
+        'threads': args.threads,
+        'keepalive': args.keepalive,
+        'graceful_timeout': args.graceful_timeout,
+        # Long downloads don't count against this, gthread workers heartbeat from their main loop
+        'timeout': 120,
+        'when_ready': when_ready,
+        'post_worker_init': post_worker_init,
+        'accesslog': None,
+        'errorlog': '-',
+    }).run()
+
+
+def serve_werkzeug(args):
+    from werkzeug.serving import make_server, WSGIRequestHandler
+    import server
+
+    class KeepAliveRequestHandler(WSGIRequestHandler):
+        # HTTP/1.0 closes every connection after one response
+        protocol_version = 'HTTP/1.1'
+
+    host, port = split_bind(args.bind)
+    httpd = make_server(host, port, server.app, threaded=True, request_handler=KeepAliveRequestHandler)
+    server.start_background_services()
+    notify_ready()
+
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever to return, so it can't run in the handler's thread
+        threading.Thread(target=httpd.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logging.info(f'Serving on {host}:{port} with werkzeug')
+    httpd.serve_forever()
+    httpd.server_close()
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    args = parse_args(argv)
+
+    # Serving must not import the app here, gunicorn workers import it after forking
+    problems = check_config(args, load_app=args.check_config)
+    if problems:
+        for problem in problems:
+            print(problem, file=sys.stderr)
+        return 1
+    if args.check_config:
+        engine = 'gunicorn' if BaseApplication is not None else 'werkzeug'
+        print(f'Configuration OK: {engine}, {args.threads} threads on {args.bind}')
+        return 0
+
+    if BaseApplication is not None:
+        serve_gunicorn(args)
+    else:
+        serve_werkzeug(args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
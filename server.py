@@ -1,10 +1,27 @@
-from flask import Flask, render_template, request, send_file, redirect, url_for, flash, session
+from flask import Flask, render_template, request, send_file, redirect, url_for, flash, session, Response, stream_with_context
 import os
+import json
 import time
+import queue
+import fcntl
 from werkzeug.utils import secure_filename
 from functools import wraps
 from password_manager import PasswordManager
 from disk_monitor import DiskMonitor
+from listing_cache import ListingCache
+from directory_pager import DirectoryPager, InvalidCursor, SORT_KEYS
+from file_index import FileIndex
+from chunked_upload import ChunkedUploadManager, UploadError
+from download_engine import DownloadEngine
+from zip_stream import ZipStream
+from thumbnailer import ThumbnailCache
+from duplicate_finder import DuplicateFinder
+from job_queue import JobManager, OPERATIONS
+from space_analyzer import SpaceAnalyzer
+from service_control import send_command, ControlError, UnknownService
+from permission_fixer import PermissionFixer
+from mount_table import get_mount_table
+from mount_holders import MountHolders
 
 app = Flask(__name__)
 app.secret_key = os.urandom(24)  # Generate a random secret key for sessions
@@ -13,13 +30,37 @@ app.secret_key = os.urandom(24)  # Generate a random secret key for sessions
 UPLOAD_FOLDER = '/media/necris-user'
 ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'mp4', 'zip'}
 CREDENTIALS_FILE = '/etc/necris/credentials.json'
+# Held by the process that runs indexing and job recovery, so a second server can't run them too
+BACKGROUND_LOCK_FILE = '/tmp/necris_background.lock'
+# Set when a front proxy serves file bodies: 'X-Accel-Redirect' (nginx) or 'X-Sendfile'
+SENDFILE_HEADER = os.environ.get('NECRIS_SENDFILE_HEADER')
+# nginx internal location that aliases UPLOAD_FOLDER, used with X-Accel-Redirect
+ACCEL_REDIRECT_PREFIX = os.environ.get('NECRIS_ACCEL_PREFIX', '/protected/')
+
+# Seconds between keep-alive comments on an idle disk usage event stream
+DISK_STREAM_KEEPALIVE = 15
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+# Large files go through the chunked upload API, so this only bounds a single chunk or form post
+app.config['MAX_CONTENT_LENGTH'] = 64 * 1024 * 1024
 
 # Initialize password manager
 password_manager = PasswordManager()
 disk_monitor = DiskMonitor(UPLOAD_FOLDER)
+listing_cache = ListingCache()
+directory_pager = DirectoryPager(listing_cache)
+file_index = FileIndex(UPLOAD_FOLDER)
+upload_manager = ChunkedUploadManager(max_chunk_size=app.config['MAX_CONTENT_LENGTH'])
+thumbnail_cache = ThumbnailCache()
+duplicate_finder = DuplicateFinder(file_index)
+job_manager = JobManager(UPLOAD_FOLDER, on_change=listing_cache.invalidate)
+space_analyzer = SpaceAnalyzer(UPLOAD_FOLDER)
+download_engine = DownloadEngine(
+    base_path=UPLOAD_FOLDER,
+    sendfile_header=SENDFILE_HEADER,
+    accel_prefix=ACCEL_REDIRECT_PREFIX
+)
+mount_holders = MountHolders()
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -31,6 +72,15 @@ def get_human_readable_size(size):
         size /= 1024
     return f"{size:.1f} TB"
 
+app.jinja_env.filters['human_size'] = get_human_readable_size
+
+def resolve_path(relative_path):
+    """Join a request path onto UPLOAD_FOLDER, returning None if it escapes it"""
+    full_path = os.path.join(UPLOAD_FOLDER, relative_path)
+    if not os.path.realpath(full_path).startswith(os.path.realpath(UPLOAD_FOLDER)):
+        return None
+    return full_path
+
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -85,29 +135,22 @@ def change_password():
 @login_required
 def index():
     current_path = request.args.get('path', '')
-    full_path = os.path.join(UPLOAD_FOLDER, current_path)
+    full_path = resolve_path(current_path)
     
     # Ensure we don't allow directory traversal
-    if not os.path.realpath(full_path).startswith(os.path.realpath(UPLOAD_FOLDER)):
+    if full_path is None:
         return redirect(url_for('index'))
     
-    files = []
-    for item in os.scandir(full_path):
-        item_info = {
-            'name': item.name,
-            'is_dir': item.is_dir(),
-            'size': get_human_readable_size(item.stat().st_size) if not item.is_dir() else '',
-            'modified': os.path.getmtime(item.path)
-        }
-        files.append(item_info)
-    
-    # Sort directories first, then files
-    files.sort(key=lambda x: (not x['is_dir'], x['name'].lower()))
+    try:
+        files = listing_cache.get(full_path).entries
+    except OSError:
+        return redirect(url_for('index'))
     
     return render_template('index.html', 
                          files=files, 
                          current_path=current_path,
-                         parent_path=os.path.dirname(current_path))
+                         parent_path=os.path.dirname(current_path),
+                         thumbnail_extensions=thumbnail_cache.supported_extensions)
 
 @app.route('/upload', methods=['POST'])
 @login_required
@@ -125,14 +168,131 @@ def upload_file():
         filename = secure_filename(file.filename)
         upload_path = os.path.join(UPLOAD_FOLDER, current_path)
         file.save(os.path.join(upload_path, filename))
+        listing_cache.invalidate(upload_path)
     
     return redirect(url_for('index', path=current_path))
 
+# Chunked uploads. The browser creates a session, PUTs chunks (possibly in parallel),
+# polls progress to resume after a failure and finally commits the upload.
+@app.route('/api/uploads', methods=['POST'])
+@login_required
+def create_upload():
+    data = request.json or {}
+    filename = secure_filename(data.get('filename', ''))
+    size = data.get('size')
+    upload_path = resolve_path(data.get('path', ''))
+
+    if not filename or not allowed_file(filename):
+        return {'error': 'File type not allowed'}, 400
+    if not isinstance(size, int) or size < 0:
+        return {'error': 'Invalid file size'}, 400
+    if upload_path is None or not os.path.isdir(upload_path):
+        return {'error': 'Upload directory not found'}, 404
+
+    try:
+        session = upload_manager.create(upload_path, filename, size, data.get('chunk_size'))
+    except UploadError as e:
+        return {'error': str(e)}, 400
+    except OSError as e:
+        return {'error': f'Could not allocate file: {e}'}, 507
+    return upload_manager.status(session.upload_id), 201
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+@login_required
+def upload_status(upload_id):
+    try:
+        return upload_manager.status(upload_id)
+    except KeyError:
+        return {'error': 'Unknown upload'}, 404
+
+@app.route('/api/uploads/<upload_id>/chunks/<int:index>', methods=['PUT'])
+@login_required
+def upload_chunk(upload_id, index):
+    crc32 = request.headers.get('X-Chunk-CRC32')
+    if crc32 is not None:
+        try:
+            if not 0 <= int(crc32, 16) <= 0xffffffff:
+                raise ValueError(crc32)
+        except ValueError:
+            return {'error': 'X-Chunk-CRC32 must be a hexadecimal CRC32'}, 400
+    try:
+        upload_manager.write_chunk(
+            upload_id, index, request.stream,
+            crc32=crc32,
+            sha256=request.headers.get('X-Chunk-SHA256')
+        )
+    except KeyError:
+        return {'error': 'Unknown upload'}, 404
+    except UploadError as e:
+        return {'error': str(e)}, 422
+    except OSError as e:
+        return {'error': str(e)}, 500
+    return {'status': 'success', 'index': index}
+
+@app.route('/api/uploads/<upload_id>/complete', methods=['POST'])
+@login_required
+def complete_upload(upload_id):
+    try:
+        target_path = upload_manager.complete(upload_id)
+    except KeyError:
+        return {'error': 'Unknown upload'}, 404
+    except UploadError as e:
+        return {'error': str(e)}, 409
+    listing_cache.invalidate(os.path.dirname(target_path))
+    return {'status': 'success'}
+
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+@login_required
+def abort_upload(upload_id):
+    try:
+        upload_manager.abort(upload_id)
+    except KeyError:
+        return {'error': 'Unknown upload'}, 404
+    return {'status': 'success'}
+
 @app.route('/download/<path:filepath>')
 @login_required
 def download_file(filepath):
-    full_path = os.path.join(UPLOAD_FOLDER, filepath)
-    return send_file(full_path, as_attachment=True)
+    full_path = resolve_path(filepath)
+    if full_path is None or not os.path.isfile(full_path):
+        return {'error': 'File not found'}, 404
+    # inline=1 streams media for in-browser playback instead of forcing a download
+    return download_engine.serve(full_path, inline=request.args.get('inline') == '1')
+
+@app.route('/download-zip/<path:dirpath>')
+@login_required
+def download_zip(dirpath):
+    full_path = resolve_path(dirpath)
+    if full_path is None or not os.path.isdir(full_path):
+        return {'error': 'Directory not found'}, 404
+
+    name = os.path.basename(os.path.normpath(full_path))
+    # Media is stored as-is, compress=1 additionally deflates text files
+    archive = ZipStream(full_path, name, compress_text=request.args.get('compress') == '1')
+    return Response(
+        stream_with_context(iter(archive)),
+        mimetype='application/zip',
+        headers={'Content-Disposition': DownloadEngine.content_disposition(f'{name}.zip', inline=False)},
+        direct_passthrough=True
+    )
+
+@app.route('/thumb/<path:filepath>')
+@login_required
+def thumbnail(filepath):
+    full_path = resolve_path(filepath)
+    if full_path is None or not os.path.isfile(full_path):
+        return {'error': 'File not found'}, 404
+
+    thumb_path = thumbnail_cache.get(full_path)
+    if thumb_path is None:
+        return {'error': 'No thumbnail available'}, 404
+    try:
+        response = send_file(thumb_path, mimetype='image/jpeg', etag=os.path.basename(thumb_path)[:-4])
+    except OSError:
+        return {'error': 'No thumbnail available'}, 404
+    # The page links thumbnails with the file's size and mtime, so a URL never changes content
+    response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
 
 @app.route('/delete/<path:filepath>')
 @login_required
@@ -140,14 +300,194 @@ def delete_file(filepath):
     full_path = os.path.join(UPLOAD_FOLDER, filepath)
     if os.path.exists(full_path):
         os.remove(full_path)
+        listing_cache.invalidate(os.path.dirname(full_path))
     return redirect(request.referrer)
 
+@app.route('/api/list')
+@login_required
+def list_directory():
+    current_path = request.args.get('path', '')
+    sort = request.args.get('sort', 'name')
+    order = request.args.get('order', 'asc')
+    cursor = request.args.get('cursor')
+    try:
+        limit = min(max(int(request.args.get('limit', 200)), 1), 1000)
+    except ValueError:
+        return {'error': 'Invalid limit'}, 400
+
+    if sort not in SORT_KEYS or order not in ('asc', 'desc'):
+        return {'error': 'Invalid sort order'}, 400
+    full_path = resolve_path(current_path)
+    if full_path is None or not os.path.isdir(full_path):
+        return {'error': 'Directory not found'}, 404
+
+    try:
+        entries, next_cursor = directory_pager.page(full_path, sort, order, cursor, limit)
+    except InvalidCursor as e:
+        return {'error': str(e)}, 400
+    except OSError as e:
+        return {'error': str(e)}, 500
+
+    def generate():
+        yield '{"path":%s,"sort":"%s","order":"%s","entries":[' % (json.dumps(current_path), sort, order)
+        for i, entry in enumerate(entries):
+            yield (',' if i else '') + json.dumps({
+                'name': entry.name,
+                'type': 'dir' if entry.is_dir else 'file',
+                'size': entry.size,
+                'mtime': entry.mtime
+            })
+        yield '],"next_cursor":%s}' % json.dumps(next_cursor)
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+@app.route('/api/search')
+@login_required
+def search_files():
+    args = request.args
+    try:
+        results = file_index.search(
+            contains=args.get('q'),
+            prefix=args.get('prefix'),
+            extensions=[ext for ext in args.get('ext', '').split(',') if ext],
+            min_size=args.get('min_size', type=int),
+            max_size=args.get('max_size', type=int),
+            modified_after=args.get('after', type=float),
+            modified_before=args.get('before', type=float),
+            drive=args.get('drive'),
+            kind=args.get('type'),
+            limit=min(args.get('limit', 100, type=int), 1000)
+        )
+    except Exception as e:
+        return {'error': str(e)}, 500
+    return {'results': results, 'indexing': sorted(file_index.indexing)}
+
+@app.route('/api/duplicates')
+@login_required
+def get_duplicates():
+    return duplicate_finder.status(limit=min(request.args.get('limit', 100, type=int), 1000))
+
+@app.route('/api/duplicates/scan', methods=['POST'])
+@login_required
+def scan_duplicates():
+    if not duplicate_finder.start_scan():
+        return {'status': 'error', 'message': 'A duplicate scan is already running'}, 409
+    return {'status': 'success', 'message': 'Duplicate scan started'}, 202
+
+@app.route('/api/jobs', methods=['POST'])
+@login_required
+def create_job():
+    data = request.get_json(silent=True) or {}
+    op = data.get('op')
+    paths = data.get('paths')
+    if op not in OPERATIONS:
+        return {'error': f"op must be one of {', '.join(OPERATIONS)}"}, 400
+    if not isinstance(paths, list) or not paths or not all(isinstance(p, str) and p for p in paths):
+        return {'error': 'paths must be a non-empty list'}, 400
+
+    full_paths = [resolve_path(p) for p in paths]
+    if None in full_paths or any(os.path.realpath(p) == os.path.realpath(UPLOAD_FOLDER) for p in full_paths):
+        return {'error': 'Invalid path'}, 400
+
+    destination = None
+    if op in ('move', 'copy'):
+        destination = resolve_path(data.get('destination') or '')
+        if destination is None or not os.path.isdir(destination):
+            return {'error': 'Destination directory not found'}, 400
+
+    try:
+        return job_manager.submit(op, full_paths, destination), 202
+    except ValueError as e:
+        return {'error': str(e)}, 400
+
+@app.route('/api/jobs')
+@login_required
+def list_jobs():
+    return {'jobs': job_manager.list(limit=min(request.args.get('limit', 50, type=int), 500))}
+
+@app.route('/api/jobs/<job_id>')
+@login_required
+def job_status(job_id):
+    job = job_manager.get(job_id, include_items=True)
+    if job is None:
+        return {'error': 'Job not found'}, 404
+    return job
+
+@app.route('/api/jobs/<job_id>', methods=['DELETE'])
+@login_required
+def cancel_job(job_id):
+    if not job_manager.cancel(job_id):
+        return {'error': 'Job not found or already finished'}, 404
+    return {'status': 'success', 'message': 'Job cancelled'}
+
 # Disk usage monitoring. These routes are used by the frontend to get disk usage info.
 @app.route('/api/disk-usage')
 @login_required
 def get_disk_usage():
     return disk_monitor.get_all_disk_usage()
 
+@app.route('/api/disk-usage/history')
+@login_required
+def get_disk_usage_history():
+    resolutions = [resolution for resolution, _ in disk_monitor.history.resolutions]
+    resolution = request.args.get('resolution', type=int)
+    if resolution is not None and resolution not in resolutions:
+        return {'error': f"resolution must be one of {', '.join(map(str, resolutions))}"}, 400
+    return disk_monitor.get_history(
+        drive=request.args.get('drive'),
+        since=request.args.get('since', type=float),
+        resolution=resolution,
+        max_points=min(request.args.get('points', 500, type=int), 5000)
+    )
+
+@app.route('/api/disk-usage/stream')
+@login_required
+def stream_disk_usage():
+    """Server-Sent Events: the current snapshot, then 'usage' events on noticeable
+    changes and 'io' events while drives are busy"""
+    def generate():
+        updates = disk_monitor.subscribe()
+        try:
+            yield f"event: usage\ndata: {json.dumps(disk_monitor.get_all_disk_usage())}\n\n"
+            while True:
+                try:
+                    update = updates.get(timeout=DISK_STREAM_KEEPALIVE)
+                except queue.Empty:
+                    # Comment line, keeps proxies from closing an idle stream
+                    yield ': keep-alive\n\n'
+                    continue
+                event, data = update
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        finally:
+            disk_monitor.unsubscribe(updates)
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/api/space')
+@login_required
+def get_space_breakdown():
+    path = request.args.get('path', '').strip('/')
+    drive = path.split('/', 1)[0] if path else request.args.get('drive')
+    return space_analyzer.status(
+        drive=drive,
+        path=path or None,
+        depth=min(request.args.get('depth', 2, type=int), 5),
+        top=min(request.args.get('top', 20, type=int), 100)
+    )
+
+@app.route('/api/space/analyze', methods=['POST'])
+@login_required
+def analyze_space():
+    drive = (request.get_json(silent=True) or {}).get('drive')
+    if drive and drive not in space_analyzer.drives():
+        return {'error': 'Drive not found'}, 404
+    if not space_analyzer.start_analysis(drive):
+        return {'status': 'error', 'message': 'That drive is already being analyzed'}, 409
+    return {'status': 'success', 'message': 'Space analysis started'}, 202
+
 @app.route('/api/disk-thresholds', methods=['POST'])
 @login_required
 def update_thresholds():
@@ -168,16 +508,87 @@ def update_thresholds():
 @login_required
 def refresh_services():
     try:
-        # Create a refresh signal file
-        signal_file = '/tmp/necris_refresh_services'
-        with open(signal_file, 'w') as f:
-            f.write(str(time.time()))  # Write current timestamp
-        return {'status': 'success', 'message': 'Services refresh initiated'}
-    except Exception as e:
-        return {'status': 'error', 'message': str(e)}, 500
+        # Both restart in parallel, the reply comes once each reports ready
+        response = send_command('restart', ['usb_monitor', 'smb_share_manager'])
+    except ControlError as e:
+        return {'status': 'error', 'message': str(e)}, 503
+    results = response['results']
+    not_ready = [name for name, result in results.items() if result['result'] != 'ready']
+    if not_ready:
+        return {'status': 'error', 'message': f"Not ready after restart: {', '.join(not_ready)}",
+                'results': results}, 500
+    return {'status': 'success', 'message': 'Services restarted', 'results': results}
+
+@app.route('/api/permission-fixes')
+@login_required
+def permission_fixes():
+    # Written by the USB monitor as its background pass over ext drives goes along
+    return {'filesystems': PermissionFixer.load_state('/etc/necris/permission_fixer.json')}
+
+@app.route('/api/drives/holders')
+@login_required
+def drive_holders():
+    """Processes keeping drives busy, i.e. what stands in the way of ejecting them"""
+    drive = request.args.get('drive')
+    mounts = get_mount_table().mounts_under(UPLOAD_FOLDER)
+    if drive:
+        mounts = [entry for entry in mounts if os.path.basename(entry.mount_point) == drive]
+        if not mounts:
+            return {'error': 'Drive not found'}, 404
+    holders = mount_holders.scan(mounts)
+    return {'drives': {os.path.basename(mount_point): found for mount_point, found in holders.items()}}
+
+@app.route('/api/services')
+@login_required
+def services_status():
+    samples = request.args.get('samples', 0, type=int)
+    try:
+        response = send_command('status', samples=samples)
+    except ControlError as e:
+        return {'error': str(e)}, 503
+    return {'services': response['services']}
+
+@app.route('/api/services/<name>/logs')
+@login_required
+def service_logs(name):
+    lines = request.args.get('lines', 100, type=int)
+    try:
+        response = send_command('logs', [name], lines=lines)
+    except UnknownService as e:
+        return {'error': str(e)}, 404
+    except ControlError as e:
+        return {'error': str(e)}, 503
+    return {'service': name, 'lines': response['logs'][name]}
+
+_background_lock = None
+
+def start_background_services():
+    """Start the file index and recover unfinished jobs.
+
+    Safe to call more than once and from a second server process: only the
+    first caller to take the lock starts anything, the others return False.
+    """
+    global _background_lock
+    if _background_lock is not None:
+        return False
+    lock = open(BACKGROUND_LOCK_FILE, 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return False
+    _background_lock = lock
 
-if __name__ == '__main__':
-    # Create upload folder if it doesn't exist
     os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    disk_monitor.start()
+    file_index.start()
+    job_manager.start()
+    return True
+
+if __name__ == '__main__':
+    # Development server, production runs through serve.py
+    # The debug reloader runs this block in its watcher process too, only start services in the child
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_services()
     # Run the app on all network interfaces
     app.run(host='0.0.0.0', port=80, debug=True)
\ No newline at end of file
@@ -0,0 +1,56 @@
+import os
+import json
+import socket
+from typing import Dict, List, Optional
+
+# The orchestrator listens for commands here (newline-delimited JSON, one
+# request and one response per connection)
+CONTROL_SOCKET = '/run/necris/orchestrator.sock'
+# Children find the orchestrator's readiness socket in this variable, the same
+# idea as systemd's NOTIFY_SOCKET
+NOTIFY_SOCKET_ENV = 'NECRIS_NOTIFY_SOCKET'
+
+
+class ControlError(Exception):
+    pass
+
+
+class UnknownService(ControlError):
+    """The orchestrator has no service by that name"""
+
+
+def send_command(command: str, services: Optional[List[str]] = None, timeout: float = 30.0,
+                 socket_path: str = CONTROL_SOCKET, **options) -> Dict:
+    """Send one command to the orchestrator and return its reply"""
+    request = dict(options, command=command)
+    if services is not None:
+        request['services'] = services
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(socket_path)
+            sock.sendall(json.dumps(request).encode() + b'\n')
+            with sock.makefile('rb') as reply:
+                line = reply.readline()
+    except OSError as e:
+        raise ControlError(f'Orchestrator is not reachable: {e}') from e
+    if not line:
+        raise ControlError('Orchestrator closed the connection without replying')
+    response = json.loads(line)
+    if response.get('status') == 'error':
+        if response.get('unknown'):
+            raise UnknownService(response['message'])
+        raise ControlError(response.get('message', 'Unknown error'))
+    return response
+
+
+def notify_ready():
+    """Tell the orchestrator this service finished starting. A no-op when not supervised."""
+    path = os.environ.get(NOTIFY_SOCKET_ENV)
+    if not path:
+        return
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto(f'READY=1\nMAINPID={os.getpid()}'.encode(), path)
+    except OSError:
+        pass
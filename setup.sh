@@ -9,11 +9,13 @@ sudo apt update
 # Install required packages
 sudo apt install -y avahi-daemon
 sudo apt install -y python3-flask
+sudo apt install -y python3-gunicorn
 sudo apt install -y python3-werkzeug
 sudo apt install -y python3-watchdog
 sudo apt install -y python3-pyudev
 sudo apt install -y python3-psutil
-sudo apt install -y ntfs-3g exfat-fuse lsof
+sudo apt install -y python3-pil
+sudo apt install -y ntfs-3g exfat-fuse
 sudo apt install -y samba
 sudo apt install -y smbclient
 
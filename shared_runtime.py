@@ -0,0 +1,125 @@
+import os
+import logging
+import threading
+import subprocess
+from typing import Callable, Dict, Optional
+
+
+class ThreadService:
+    """A service running as a thread of the orchestrator, with the parts of
+    the subprocess.Popen interface the orchestrator uses.
+
+    poll() returns None while the thread runs, 0 once it returned after
+    stop() and 1 if it died with an exception. There is no way to kill a
+    thread, so kill() only logs; a service that ignores stop() keeps its
+    thread until the orchestrator exits.
+    """
+
+    threaded = True
+    stdout = None
+    stderr = None
+
+    def __init__(self, service_name: str, factory: Callable, run_method: str,
+                 on_ready: Callable, on_exit: Callable):
+        self.logger = logging.getLogger(__name__)
+        self.service_name = service_name
+        self.pid = os.getpid()
+        self.returncode = None
+        self.instance = None
+        self._factory = factory
+        self._run_method = run_method
+        self._stop_requested = False
+        self._on_ready = on_ready
+        self._on_exit = on_exit
+        self._instance_ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name=service_name)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            self.instance = self._factory()
+            self.instance.on_ready = self._on_ready
+            self._instance_ready.set()
+            if not self._stop_requested:
+                getattr(self.instance, self._run_method)()
+            self.returncode = 0
+        except BaseException as e:
+            # SystemExit included, the services raise it for a missing user
+            self.logger.error(f"{self.service_name} thread failed: {e}")
+            self.returncode = 1
+        finally:
+            self._instance_ready.set()
+            self._on_exit()
+
+    def poll(self) -> Optional[int]:
+        # Set just before on_exit runs, while the thread is still winding down
+        return self.returncode
+
+    def terminate(self):
+        self._stop_requested = True
+        # Construction validates mounts and sets up Samba, stop() needs the instance.
+        # If construction is still going, the flag above keeps it from running.
+        if self._instance_ready.wait(1) and self.instance is not None:
+            self.instance.stop()
+
+    def kill(self):
+        self.logger.error(f"{self.service_name} thread ignored stop(), leaving it behind")
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[int]:
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            raise subprocess.TimeoutExpired(self.service_name, timeout)
+        return self.returncode
+
+
+class SharedRuntime:
+    """Hosts USBMonitor and SMBShareManager as threads of the orchestrator.
+
+    Both share one interpreter (pyudev and the rest are imported once), one
+    PasswordManager and one MountTable. USBMonitor reports mounts and unmounts
+    straight to the current SMBShareManager instead of it following the mount
+    table on its own.
+    """
+
+    services = ('usb_monitor', 'smb_share_manager')
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.instances: Dict[str, ThreadService] = {}
+        self._password_manager = None
+
+    @property
+    def password_manager(self):
+        if self._password_manager is None:
+            from password_manager import PasswordManager
+            self._password_manager = PasswordManager()
+        return self._password_manager
+
+    def _create_usb_monitor(self):
+        from usb_monitor import USBMonitor
+        monitor = USBMonitor()
+        monitor.add_listener(self.mount_event)
+        return monitor
+
+    def _create_smb_share_manager(self):
+        from smb_share_manager import SMBShareManager
+        return SMBShareManager(password_manager=self.password_manager, watch=False)
+
+    def mount_event(self, event, mount_point):
+        """Forward a USBMonitor mount event to whichever SMBShareManager is running now"""
+        service = self.instances.get('smb_share_manager')
+        manager = service.instance if service is not None and service.poll() is None else None
+        if manager is None:
+            # It shares everything that is mounted when it (re)starts
+            self.logger.info(f"SMB share manager not running, {event} {mount_point} picked up on its next start")
+            return
+        manager.handle_mount_event(event, mount_point)
+
+    def spawn(self, service_name: str, on_ready: Callable, on_exit: Callable) -> ThreadService:
+        factory, run_method = {
+            'usb_monitor': (self._create_usb_monitor, 'start_monitoring'),
+            'smb_share_manager': (self._create_smb_share_manager, 'start'),
+        }[service_name]
+        service = ThreadService(service_name, factory, run_method, on_ready, on_exit)
+        self.instances[service_name] = service
+        return service
@@ -3,17 +3,17 @@
 import os
 import subprocess
 import logging
-import time
 import pwd
 import grp
 from pathlib import Path
 import configparser
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+import threading
 from password_manager import PasswordManager
+from service_control import notify_ready
+from mount_table import get_mount_table
 
 class SMBShareManager:
-    def __init__(self):
+    def __init__(self, password_manager=None, watch=True):
         # Setup logging
         logging.basicConfig(
             level=logging.INFO,
@@ -22,8 +22,8 @@ class SMBShareManager:
         )
         self.logger = logging.getLogger(__name__)
         
-        # Initialize password manager
-        self.password_manager = PasswordManager()
+        # Initialize password manager, the shared runtime passes its own
+        self.password_manager = password_manager or PasswordManager()
         
         # Get default credentials
         credentials = self.password_manager.get_credentials()
@@ -42,6 +42,9 @@ class SMBShareManager:
         # Base mount directory
         self.mount_base = Path(f'/media/{self.system_user}')
         
+        # Mounts are looked up here instead of stat'ing each path
+        self.mount_table = get_mount_table()
+        
         # Samba configuration
         self.smb_conf_path = '/etc/samba/smb.conf'
         self.shares_conf_path = '/etc/samba/shares.conf'
@@ -53,9 +56,12 @@ class SMBShareManager:
         self.verify_samba_setup()
         self.validate_existing_shares()
         
-        # Setup filesystem watchdog
-        self.observer = Observer()
-        self.setup_watchdog()
+        # Follow the mount table, unless USBMonitor calls handle_mount_event directly
+        self.watch = watch
+        self.on_ready = notify_ready
+        self._stop = threading.Event()
+        # USBMonitor reports drives from several workers, shares.conf is rewritten whole
+        self._shares_lock = threading.Lock()
 
     def setup_samba_user(self):
         """Create the default Samba user if it doesn't exist"""
@@ -180,7 +186,7 @@ class SMBShareManager:
                 if share_name.startswith('USB_'):
                     share_path = config[share_name].get('path')
                     
-                    if not share_path or not os.path.exists(share_path) or not os.path.ismount(share_path):
+                    if not share_path or not self.mount_table.is_mounted(share_path):
                         shares_to_remove.append(share_name)
                         self.logger.warning(f"Found stale share: {share_name} for path {share_path}")
             
@@ -309,38 +315,24 @@ class SMBShareManager:
             self.logger.error(f"Failed to remove shares {share_names}: {e}")
             return False
 
-    class USBMountHandler(FileSystemEventHandler):
-        def __init__(self, manager):
-            self.manager = manager
-            
-        def on_created(self, event):
-            if event.is_directory and str(event.src_path).startswith(str(self.manager.mount_base)):
-                self.manager.logger.info(f"New mount point detected: {event.src_path}")
-                # Small delay to ensure mount is complete
-                time.sleep(1)
-                if os.path.ismount(event.src_path):
-                    self.manager.create_share(Path(event.src_path))
-                    
-        def on_deleted(self, event):
-            if event.is_directory and str(event.src_path).startswith(str(self.manager.mount_base)):
-                self.manager.logger.info(f"Mount point removed: {event.src_path}")
-                share_name = f"USB_{os.path.basename(event.src_path)}"
-                self.manager.remove_shares([share_name])
-
-    def setup_watchdog(self):
-        """Setup filesystem monitoring for mount points"""
-        event_handler = self.USBMountHandler(self)
-        self.observer.schedule(event_handler, str(self.mount_base), recursive=False)
+    def _on_mounts_changed(self, added, removed):
+        """Mount table listener, shares drives mounted in mount_base and unshares removed ones"""
+        for entry in removed:
+            if os.path.dirname(entry.mount_point) == str(self.mount_base):
+                self.handle_mount_event('unmounted', entry.mount_point)
+        for entry in added:
+            if os.path.dirname(entry.mount_point) == str(self.mount_base):
+                self.handle_mount_event('mounted', entry.mount_point)
 
     def scan_existing_mounts(self):
         """Scan and create shares for existing mounted devices"""
         self.logger.info("Scanning for existing mounted devices...")
         
         try:
-            for item in self.mount_base.iterdir():
-                if item.is_dir() and os.path.ismount(item):
-                    self.logger.info(f"Found existing mount: {item}")
-                    self.create_share(item)
+            for entry in self.mount_table.mounts_under(self.mount_base):
+                self.logger.info(f"Found existing mount: {entry.mount_point}")
+                with self._shares_lock:
+                    self.create_share(Path(entry.mount_point))
                     
         except Exception as e:
             self.logger.error(f"Error scanning existing mounts: {e}")
@@ -349,18 +341,23 @@ class SMBShareManager:
         """Start the SMB share manager"""
         self.logger.info("Starting SMB Share Manager...")
         
-        # First scan for existing mounts
+        # Watch first so nothing mounted during the scan is missed, create_share skips duplicates
+        if self.watch:
+            self.mount_table.add_listener(self._on_mounts_changed)
         self.scan_existing_mounts()
-        
-        # Start watching for new mounts
-        self.observer.start()
+        self.on_ready()
         
         try:
-            while True:
-                time.sleep(1)
+            # Shares are added and removed from listener calls, this only waits for stop()
+            self._stop.wait()
         except KeyboardInterrupt:
-            self.observer.stop()
-        self.observer.join()
+            pass
+        if self.watch:
+            self.mount_table.remove_listener(self._on_mounts_changed)
+
+    def stop(self):
+        """Make start() return, used when running as a thread"""
+        self._stop.set()
 
 def main():
     logging.basicConfig(level=logging.DEBUG)
@@ -0,0 +1,257 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from mount_table import get_mount_table
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    drive TEXT NOT NULL,
+    parent TEXT,
+    mtime_ns INTEGER NOT NULL,
+    scanned_at_ns INTEGER NOT NULL,
+    own_bytes INTEGER NOT NULL,
+    own_files INTEGER NOT NULL,
+    total_bytes INTEGER NOT NULL,
+    total_files INTEGER NOT NULL,
+    subdirs TEXT NOT NULL,
+    scan_id INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS dirs_parent ON dirs(parent, total_bytes);
+CREATE INDEX IF NOT EXISTS dirs_drive ON dirs(drive, scan_id);
+'''
+
+# FAT stores mtimes with 2 second granularity, a directory scanned within that
+# window of its mtime may have changed again without its mtime moving
+MTIME_GRANULARITY_NS = 2_000_000_000
+
+
+class SpaceAnalyzer:
+    """Recursive per-directory disk usage for every drive, for finding space hogs.
+
+    Each top-level directory of a drive is scanned by its own worker. Every
+    directory's own files are cached with its mtime, and a directory whose
+    mtime hasn't moved is not listed again on the next analysis: only its
+    subdirectories are stat'ed to find changed subtrees. Sizes are allocated
+    bytes (st_blocks), like du. Note that appending to an existing file does
+    not change its directory's mtime, so such growth shows up on the next
+    change to that directory.
+    """
+
+    BATCH_SIZE = 2000
+
+    def __init__(self, base_path: str, db_path: str = '/etc/necris/space_cache.db', workers: int = 4):
+        self.logger = logging.getLogger(__name__)
+        self.base_path = base_path
+        self.db_path = db_path
+        self.workers = workers
+
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._write_lock = threading.Lock()
+        self._writer = self._connect()
+        self._writer.executescript(SCHEMA)
+        self._writer.commit()
+        self._local = threading.local()
+
+        self.scanning = set()
+        self.progress = {}
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+        return conn
+
+    def drives(self) -> List[str]:
+        return [os.path.basename(entry.mount_point) for entry in get_mount_table().mounts_under(self.base_path)]
+
+    def start_analysis(self, drive: Optional[str] = None) -> bool:
+        """Analyze one drive (or all of them) in the background, False if already running"""
+        drives = [drive] if drive else self.drives()
+        with self._lock:
+            if any(d in self.scanning for d in drives):
+                return False
+            self.scanning.update(drives)
+        threading.Thread(target=self._run, args=(drives,), daemon=True).start()
+        return True
+
+    def _run(self, drives: List[str]):
+        for drive in drives:
+            try:
+                self.analyze(drive)
+            except Exception as e:
+                self.logger.error(f"Space analysis of {drive} failed: {e}")
+            finally:
+                with self._lock:
+                    self.scanning.discard(drive)
+
+    def _write(self, rows: List[tuple]):
+        if not rows:
+            return
+        with self._write_lock:
+            self._writer.executemany(
+                'INSERT OR REPLACE INTO dirs (path, drive, parent, mtime_ns, scanned_at_ns, own_bytes, own_files, '
+                'total_bytes, total_files, subdirs, scan_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                rows
+            )
+            self._writer.commit()
+        rows.clear()
+
+    def _list(self, path: str, st: os.stat_result, cached: Dict, progress: Dict) -> tuple:
+        """(scanned_at_ns, own_bytes, own_files, subdirs) for one directory, from the cache if still valid"""
+        entry = cached.get(os.path.relpath(path, self.base_path))
+        if entry and entry[0] == st.st_mtime_ns and entry[1] - entry[0] > MTIME_GRANULARITY_NS:
+            progress['reused'] += 1
+            return entry[1], entry[2], entry[3], json.loads(entry[4])
+
+        scanned_at_ns = time.time_ns()
+        own_bytes = own_files = 0
+        subdirs = []
+        try:
+            with os.scandir(path) as it:
+                for item in it:
+                    try:
+                        if item.is_dir(follow_symlinks=False):
+                            subdirs.append(item.name)
+                        else:
+                            own_bytes += item.stat(follow_symlinks=False).st_blocks * 512
+                            own_files += 1
+                    except OSError:
+                        continue
+        except OSError as e:
+            self.logger.debug(f"Skipping unreadable directory {path}: {e}")
+        progress['listed'] += 1
+        return scanned_at_ns, own_bytes, own_files, subdirs
+
+    def _subdirs(self, path: str, names: List[str], root_dev: int) -> List[tuple]:
+        result = []
+        for name in names:
+            child = os.path.join(path, name)
+            try:
+                st = os.stat(child, follow_symlinks=False)
+            except OSError:
+                continue
+            # Something mounted inside the drive is not ours to count
+            if st.st_dev == root_dev:
+                result.append((child, st))
+        return result
+
+    def _scan(self, path: str, st: os.stat_result, scan: Dict, rows: List[tuple]) -> tuple:
+        """Post-order walk of one subtree, returns (total_bytes, total_files)"""
+        scanned_at_ns, own_bytes, own_files, subdirs = self._list(path, st, scan['cached'], scan['progress'])
+        total_bytes, total_files = own_bytes, own_files
+        for child, child_st in self._subdirs(path, subdirs, scan['root_dev']):
+            child_bytes, child_files = self._scan(child, child_st, scan, rows)
+            total_bytes += child_bytes
+            total_files += child_files
+
+        rel = os.path.relpath(path, self.base_path)
+        scan['progress']['directories'] += 1
+        rows.append((rel, scan['drive'], os.path.dirname(rel) or None, st.st_mtime_ns, scanned_at_ns,
+                     own_bytes, own_files, total_bytes, total_files, json.dumps(subdirs), scan['scan_id']))
+        if len(rows) >= self.BATCH_SIZE:
+            self._write(rows)
+        return total_bytes, total_files
+
+    def _scan_subtree(self, path: str, st: os.stat_result, scan: Dict) -> tuple:
+        rows = []
+        totals = self._scan(path, st, scan, rows)
+        self._write(rows)
+        return totals
+
+    def analyze(self, drive: str):
+        """Rescan a drive, reusing cached listings of directories whose mtime hasn't changed"""
+        started = time.time()
+        root = os.path.join(self.base_path, drive)
+        root_st = os.stat(root)
+        scan = {
+            'drive': drive,
+            'scan_id': int(started * 1000),
+            'root_dev': root_st.st_dev,
+            'progress': {'started_at': started, 'directories': 0, 'listed': 0, 'reused': 0},
+            'cached': {
+                row[0]: row[1:]
+                for row in self._reader().execute(
+                    'SELECT path, mtime_ns, scanned_at_ns, own_bytes, own_files, subdirs FROM dirs WHERE drive = ?',
+                    (drive,)
+                )
+            }
+        }
+        self.progress[drive] = scan['progress']
+
+        # One worker per top-level subtree, the drive root is totalled here
+        scanned_at_ns, own_bytes, own_files, subdirs = self._list(root, root_st, scan['cached'], scan['progress'])
+        scan['progress']['directories'] += 1
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='space-analyzer') as pool:
+            futures = [pool.submit(self._scan_subtree, child, st, scan)
+                       for child, st in self._subdirs(root, subdirs, root_st.st_dev)]
+            totals = [future.result() for future in futures]
+        self._write([(drive, drive, None, root_st.st_mtime_ns, scanned_at_ns, own_bytes, own_files,
+                      own_bytes + sum(t[0] for t in totals), own_files + sum(t[1] for t in totals),
+                      json.dumps(subdirs), scan['scan_id'])])
+
+        with self._write_lock:
+            self._writer.execute('DELETE FROM dirs WHERE drive = ? AND scan_id < ?', (drive, scan['scan_id']))
+            self._writer.commit()
+        scan['progress']['finished_at'] = time.time()
+        self.logger.info(f"Analyzed {drive} in {time.time() - started:.1f}s "
+                         f"({scan['progress']['listed']} listed, {scan['progress']['reused']} reused)")
+
+    def tree(self, path: str, depth: int = 2, top: int = 20) -> Optional[Dict]:
+        """Treemap-ready hierarchy below a drive-relative path: the largest `top`
+        children per level down to `depth`, the rest folded into one node"""
+        conn = self._reader()
+        row = conn.execute(
+            'SELECT total_bytes, total_files, own_bytes, own_files, scanned_at_ns FROM dirs WHERE path = ?', (path,)
+        ).fetchone()
+        if row is None:
+            return None
+        total_bytes, total_files, own_bytes, own_files, scanned_at_ns = row
+        node = {
+            'name': os.path.basename(path),
+            'path': path,
+            'size': total_bytes,
+            'files': total_files,
+            'scanned_at': scanned_at_ns / 1e9
+        }
+        if depth <= 0:
+            return node
+
+        children = []
+        rows = conn.execute(
+            'SELECT path, total_bytes, total_files FROM dirs WHERE parent = ? ORDER BY total_bytes DESC', (path,)
+        ).fetchall()
+        for child_path, child_bytes, child_files in rows[:top]:
+            children.append(self.tree(child_path, depth - 1, top) or
+                            {'name': os.path.basename(child_path), 'path': child_path,
+                             'size': child_bytes, 'files': child_files})
+        rest = rows[top:]
+        if rest:
+            children.append({'name': f'{len(rest)} more folders', 'path': None,
+                             'size': sum(r[1] for r in rest), 'files': sum(r[2] for r in rest)})
+        if own_bytes:
+            children.append({'name': f'{own_files} files', 'path': None, 'size': own_bytes, 'files': own_files})
+        node['children'] = children
+        return node
+
+    def status(self, drive: Optional[str] = None, path: Optional[str] = None, depth: int = 2, top: int = 20) -> Dict:
+        drives = [drive] if drive else self.drives()
+        return {
+            'scanning': sorted(self.scanning),
+            'progress': {d: self.progress[d] for d in drives if d in self.progress},
+            'trees': {d: self.tree(path or d, depth, top) for d in drives}
+        }
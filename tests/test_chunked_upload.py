@@ -0,0 +1,56 @@
+import io
+import os
+import zlib
+
+import pytest
+
+from chunked_upload import ChunkedUploadManager, UploadError
+
+
+@pytest.fixture
+def manager(tmp_path):
+    return ChunkedUploadManager(state_dir=str(tmp_path / 'state'), default_chunk_size=4)
+
+
+@pytest.mark.parametrize('chunk_size', ['4', 4.5, True, [4]])
+def test_non_integer_chunk_size_is_rejected(manager, tmp_path, chunk_size):
+    with pytest.raises(UploadError):
+        manager.create(str(tmp_path), 'file.txt', 10, chunk_size)
+
+
+def test_upload_completes_to_target(manager, tmp_path):
+    data = b'0123456789'
+    session = manager.create(str(tmp_path), 'file.txt', len(data))
+    for index in range(session.total_chunks):
+        chunk = data[index * 4:(index + 1) * 4]
+        manager.write_chunk(session.upload_id, index, io.BytesIO(chunk), crc32=format(zlib.crc32(chunk), 'x'))
+
+    target = manager.complete(session.upload_id)
+
+    with open(target, 'rb') as f:
+        assert f.read() == data
+
+
+def test_corrupt_retry_unmarks_a_received_chunk(manager, tmp_path):
+    session = manager.create(str(tmp_path), 'file.txt', 4)
+    manager.write_chunk(session.upload_id, 0, io.BytesIO(b'good'), crc32=format(zlib.crc32(b'good'), 'x'))
+
+    with pytest.raises(UploadError):
+        manager.write_chunk(session.upload_id, 0, io.BytesIO(b'bad!'), crc32=format(zlib.crc32(b'good'), 'x'))
+
+    assert manager.status(session.upload_id)['missing'] == [0]
+    # The persisted state agrees, so a restart doesn't bring the chunk back
+    restarted = ChunkedUploadManager(state_dir=manager.state_dir, default_chunk_size=4)
+    assert restarted.get(session.upload_id).received == []
+    with pytest.raises(UploadError):
+        manager.complete(session.upload_id)
+
+
+def test_abandoned_sessions_are_swept_on_create(manager, tmp_path):
+    old = manager.create(str(tmp_path), 'old.txt', 4)
+    old.updated_at -= manager.expire_after + 1
+
+    manager.create(str(tmp_path), 'new.txt', 4)
+
+    assert old.upload_id not in manager.sessions
+    assert not os.path.exists(old.part_path)
@@ -0,0 +1,92 @@
+import threading
+
+import pytest
+
+from device_dispatcher import DeviceDispatcher
+
+
+class RecordingHandler:
+    """Handler that blocks on a gate, so tests decide when events run"""
+
+    def __init__(self):
+        self.calls = []
+        self.gate = threading.Event()
+        self.started = threading.Semaphore(0)
+
+    def __call__(self, action, device):
+        self.started.release()
+        self.gate.wait(5)
+        self.calls.append((action, device))
+
+
+@pytest.fixture
+def handler():
+    return RecordingHandler()
+
+
+@pytest.fixture
+def dispatcher(handler):
+    dispatcher = DeviceDispatcher(handler)
+    yield dispatcher
+    handler.gate.set()
+    dispatcher.shutdown()
+
+
+def test_events_of_one_device_are_coalesced_and_run_in_order(dispatcher, handler):
+    dispatcher.submit('sdb', 'add', 1)
+    assert handler.started.acquire(timeout=5)
+    # While the first add runs: a flapping device
+    for i in range(2, 8, 2):
+        dispatcher.submit('sdb', 'remove', i)
+        dispatcher.submit('sdb', 'add', i + 1)
+    assert dispatcher.status()['pending'] == {'sdb': ['remove', 'add']}
+
+    handler.gate.set()
+    assert dispatcher.wait_idle(5)
+
+    # The newest device info is what runs
+    assert handler.calls == [('add', 1), ('remove', 6), ('add', 7)]
+    assert dispatcher.coalesced == 4
+
+
+def test_remove_replaces_a_queued_add(dispatcher, handler):
+    dispatcher.submit('sdb', 'remove', 1)
+    assert handler.started.acquire(timeout=5)
+    dispatcher.submit('sdb', 'add', 2)
+    dispatcher.submit('sdb', 'remove', 3)
+
+    handler.gate.set()
+    assert dispatcher.wait_idle(5)
+
+    assert handler.calls == [('remove', 1), ('remove', 3)]
+
+
+def test_devices_run_in_parallel(dispatcher, handler):
+    for key in ('sdb', 'sdc', 'sdd'):
+        dispatcher.submit(key, 'add', key)
+
+    # All three handlers are inside the gate at once
+    for _ in range(3):
+        assert handler.started.acquire(timeout=5)
+    assert sorted(dispatcher.status()['active']) == ['sdb', 'sdc', 'sdd']
+    handler.gate.set()
+    assert dispatcher.wait_idle(5)
+    assert dispatcher.status() == {'active': [], 'pending': {}, 'coalesced': 0}
+
+
+def test_a_failing_handler_does_not_stop_the_queue():
+    calls = []
+
+    def handler(action, device):
+        calls.append(device)
+        if device == 1:
+            raise RuntimeError('mount failed')
+
+    dispatcher = DeviceDispatcher(handler)
+    try:
+        dispatcher.submit('sdb', 'add', 1)
+        dispatcher.submit('sdb', 'remove', 2)
+        assert dispatcher.wait_idle(5)
+        assert calls[-1] == 2
+    finally:
+        dispatcher.shutdown()
@@ -0,0 +1,69 @@
+import json
+import base64
+
+import pytest
+
+from directory_pager import DirectoryPager, InvalidCursor, decode_cursor, encode_cursor, sort_key
+from listing_cache import ListingCache
+
+
+def forge(payload) -> str:
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip('=')
+
+
+@pytest.mark.parametrize('sort', ['name', 'size', 'mtime', 'type'])
+def test_cursor_round_trip(sort):
+    key = sort_key(sort, 'Movie.mkv', False, 1234, 1700000000.5)
+    assert decode_cursor(encode_cursor(sort, 'asc', key), sort, 'asc') == key
+
+
+@pytest.mark.parametrize('cursor', [
+    'not base64 !',
+    forge({'a': 1}),
+    forge(['name', 'asc']),
+    forge(['name', 'asc', 'key']),
+    forge(['name', 'asc', {'a': 1}]),
+    forge(['name', 'asc', [False, 'a']]),
+    forge(['name', 'asc', [False, 'a', 'a', 'a']]),
+    forge(['name', 'asc', [0, 'a', 'a']]),
+    forge(['name', 'asc', [False, ['a'], 'a']]),
+    forge(['name', 'asc', [False, None, 'a']]),
+])
+def test_malformed_cursors_are_rejected(cursor):
+    with pytest.raises(InvalidCursor):
+        decode_cursor(cursor, 'name', 'asc')
+
+
+def test_cursor_types_follow_the_sort():
+    with pytest.raises(InvalidCursor):
+        decode_cursor(forge(['size', 'asc', [True, '12', 'a', 'a']]), 'size', 'asc')
+    with pytest.raises(InvalidCursor):
+        decode_cursor(forge(['size', 'asc', [True, True, 'a', 'a']]), 'size', 'asc')
+    assert decode_cursor(forge(['mtime', 'asc', [True, 17, 'a', 'a']]), 'mtime', 'asc') == (True, 17, 'a', 'a')
+
+
+def test_cursor_for_another_order_is_rejected():
+    cursor = encode_cursor('name', 'asc', sort_key('name', 'a', False))
+    with pytest.raises(InvalidCursor):
+        decode_cursor(cursor, 'name', 'desc')
+
+
+@pytest.mark.parametrize('cached', [False, True])
+def test_pages_cover_the_directory(tmp_path, cached):
+    names = [f'file{i:02}' for i in range(25)]
+    for name in names:
+        (tmp_path / name).write_bytes(b'')
+    cache = ListingCache()
+    try:
+        if cached:
+            cache.get(str(tmp_path))
+        pager = DirectoryPager(cache)
+        seen, cursor = [], None
+        while True:
+            entries, cursor = pager.page(str(tmp_path), cursor=cursor, limit=10)
+            seen.extend(entry.name for entry in entries)
+            if cursor is None:
+                break
+        assert seen == names
+    finally:
+        cache.stop()
@@ -0,0 +1,86 @@
+import time
+
+import pytest
+
+from disk_history import DiskHistory
+
+GB = 1024 ** 3
+
+
+@pytest.fixture
+def history(tmp_path):
+    return DiskHistory(str(tmp_path / 'history.json'))
+
+
+def fill_hourly(history, hours, used_start, rate_per_hour, capacity):
+    last_hour = int(time.time() // 3600 * 3600)
+    for i in range(hours):
+        used = used_start + rate_per_hour * i
+        history.record('sda1', used, capacity - used, timestamp=last_hour - (hours - 1 - i) * 3600)
+    return last_hour
+
+
+def test_projection_from_a_steady_fill_rate(history):
+    capacity = 100 * GB
+    last_hour = fill_hourly(history, 24, 10 * GB, GB, capacity)
+
+    projection = history.projection('sda1', critical_percent=90)
+
+    assert projection['bytes_per_day'] == pytest.approx(24 * GB)
+    assert projection['window_seconds'] == 23 * 3600
+    # 33 GB used at the last point, 67 GB left at 1 GB/h, less the time since that point
+    elapsed = time.time() - last_hour
+    assert projection['seconds_to_full'] == pytest.approx(67 * 3600 - elapsed, abs=2)
+    assert projection['seconds_to_critical'] == pytest.approx(57 * 3600 - elapsed, abs=2)
+
+
+def test_projection_past_critical_and_for_a_shrinking_drive(history):
+    fill_hourly(history, 5, 95 * GB, GB // 10, 100 * GB)
+    assert history.projection('sda1', critical_percent=90)['seconds_to_critical'] == 0.0
+
+    shrinking = DiskHistory(history.path + '.2')
+    fill_hourly(shrinking, 5, 50 * GB, -GB, 100 * GB)
+    projection = shrinking.projection('sda1', critical_percent=90)
+    assert projection['bytes_per_day'] < 0
+    assert projection['seconds_to_full'] is None and projection['seconds_to_critical'] is None
+
+
+def test_projection_needs_a_few_points(history):
+    assert history.projection('sda1', 90) is None
+    now = time.time()
+    history.record('sda1', GB, GB, timestamp=now - 60)
+    history.record('sda1', GB, GB, timestamp=now)
+    assert history.projection('sda1', 90) is None
+
+
+def test_young_history_projects_from_minutes(history):
+    start = int(time.time() // 3600 * 3600)
+    for i in range(10):
+        history.record('sda1', GB + i * 1024 * 1024, 10 * GB, timestamp=start + i * 60)
+
+    projection = history.projection('sda1', 90)
+
+    assert projection['window_seconds'] == 9 * 60
+    assert projection['bytes_per_day'] == pytest.approx(1024 * 1024 * 24 * 60)
+
+
+def test_last_sample_in_a_bucket_wins_and_survives_a_reload(history):
+    history.record('sda1', 1, 9, timestamp=120)
+    history.record('sda1', 2, 8, timestamp=150)
+    history.record('sda1', 3, 7, timestamp=180)
+    history.save()
+
+    reloaded = DiskHistory(history.path)
+    assert reloaded.series('sda1', 60) == [[120, 2, 8], [180, 3, 7]]
+    assert reloaded.series('sda1', 3600) == [[0, 3, 7]]
+
+
+def test_downsampled_series_keeps_the_newest_point(history):
+    for i in range(100):
+        history.record('sda1', i, 100 - i, timestamp=i * 60)
+
+    points = history.series('sda1', 60, max_points=10)
+
+    assert len(points) == 10
+    assert points[0] == [0, 0, 100]
+    assert points[-1] == [99 * 60, 99, 1]
@@ -0,0 +1,81 @@
+import pytest
+from flask import Flask
+
+from download_engine import DownloadEngine
+
+DATA = bytes(range(256)) * 40
+
+
+@pytest.fixture
+def client(tmp_path):
+    path = tmp_path / 'video.mp4'
+    path.write_bytes(DATA)
+    app = Flask(__name__)
+    engine = DownloadEngine(block_size=1000)
+
+    @app.route('/download')
+    def download():
+        return engine.serve(str(path))
+
+    return app.test_client()
+
+
+def test_full_download(client):
+    response = client.get('/download')
+
+    assert response.status_code == 200
+    assert response.data == DATA
+    assert response.headers['Content-Length'] == str(len(DATA))
+    assert response.headers['Accept-Ranges'] == 'bytes'
+
+
+def test_single_and_suffix_ranges(client):
+    response = client.get('/download', headers={'Range': 'bytes=100-199'})
+    assert response.status_code == 206
+    assert response.data == DATA[100:200]
+    assert response.headers['Content-Range'] == f'bytes 100-199/{len(DATA)}'
+
+    response = client.get('/download', headers={'Range': 'bytes=-10'})
+    assert response.data == DATA[-10:]
+
+    # Past the end is cut to the file, not an error
+    response = client.get('/download', headers={'Range': f'bytes={len(DATA) - 5}-{len(DATA) + 100}'})
+    assert response.data == DATA[-5:]
+
+
+def test_adjacent_ranges_are_merged_and_the_rest_sent_as_multipart(client):
+    response = client.get('/download', headers={'Range': 'bytes=0-9,10-19,1000-1009'})
+
+    assert response.status_code == 206
+    assert response.mimetype == 'multipart/byteranges'
+    body = response.data
+    assert int(response.headers['Content-Length']) == len(body)
+    assert body.count(b'Content-Range') == 2
+    assert f'Content-Range: bytes 0-19/{len(DATA)}'.encode() in body
+    assert f'Content-Range: bytes 1000-1009/{len(DATA)}'.encode() in body
+    assert DATA[0:20] in body and DATA[1000:1010] in body
+
+
+def test_unsatisfiable_range(client):
+    response = client.get('/download', headers={'Range': f'bytes={len(DATA)}-'})
+
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == f'bytes */{len(DATA)}'
+
+
+def test_conditional_requests(client):
+    etag = client.get('/download').headers['ETag']
+
+    assert client.get('/download', headers={'If-None-Match': etag}).status_code == 304
+    assert client.get('/download', headers={'If-None-Match': '"other"'}).status_code == 200
+
+    # A stale If-Range gets the whole file instead of a range of the new one
+    response = client.get('/download', headers={'Range': 'bytes=0-9', 'If-Range': '"other"'})
+    assert (response.status_code, response.data) == (200, DATA)
+    response = client.get('/download', headers={'Range': 'bytes=0-9', 'If-Range': etag})
+    assert (response.status_code, response.data) == (206, DATA[:10])
+
+
+def test_non_ascii_filenames_use_rfc_5987():
+    assert DownloadEngine.content_disposition('film.mp4', False) == 'attachment; filename="film.mp4"'
+    assert DownloadEngine.content_disposition('été.mp4', True) == "inline; filename*=UTF-8''%C3%A9t%C3%A9.mp4"
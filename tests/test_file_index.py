@@ -0,0 +1,64 @@
+import os
+
+import pytest
+
+from file_index import FileIndex
+
+
+@pytest.fixture
+def index(tmp_path):
+    base = tmp_path / 'media'
+    drive = base / 'drive1'
+    (drive / 'Photos').mkdir(parents=True)
+    for name in ('Holiday_2023.JPG', 'holiday-notes.txt', 'budget.xlsx', 'ab.txt', '100%_done.txt'):
+        (drive / 'Photos' / name).write_bytes(b'x')
+    index = FileIndex(str(base), db_path=str(tmp_path / 'index.db'))
+    index.index_drive(str(drive))
+    yield index
+    index.executor.shutdown(wait=True)
+
+
+def names(results):
+    return sorted(result['name'] for result in results)
+
+
+def test_substring_search_uses_trigram_index(index):
+    assert index.trigram_search
+    assert names(index.search(contains='OLIDAY')) == ['Holiday_2023.JPG', 'holiday-notes.txt']
+    assert names(index.search(contains='%_d')) == ['100%_done.txt']
+
+
+def test_short_substrings_still_match(index):
+    assert names(index.search(contains='ab')) == ['ab.txt']
+
+
+def test_index_follows_renames(index, tmp_path):
+    photos = tmp_path / 'media' / 'drive1' / 'Photos'
+    os.rename(photos / 'budget.xlsx', photos / 'forecast.xlsx')
+    index._delete_path(str(photos / 'budget.xlsx'))
+    index.update_path(str(photos / 'forecast.xlsx'))
+    # Re-indexing updates rows in place
+    index.index_drive(str(tmp_path / 'media' / 'drive1'))
+
+    assert index.search(contains='budget') == []
+    assert names(index.search(contains='forecast')) == ['forecast.xlsx']
+
+
+def test_deleting_a_directory_drops_only_its_subtree(index, tmp_path):
+    drive = tmp_path / 'media' / 'drive1'
+    for sibling in ('Photos-old', 'Photos.bak', 'Photos0'):
+        (drive / sibling).mkdir()
+        (drive / sibling / 'keep.txt').write_bytes(b'x')
+    index.index_drive(str(drive))
+
+    index._delete_path(str(drive / 'Photos'))
+
+    assert sorted(result['path'] for result in index.search(drive='drive1')) == [
+        'drive1/Photos-old', 'drive1/Photos-old/keep.txt',
+        'drive1/Photos.bak', 'drive1/Photos.bak/keep.txt',
+        'drive1/Photos0', 'drive1/Photos0/keep.txt',
+    ]
+    plan = index._writer.execute(
+        'EXPLAIN QUERY PLAN DELETE FROM files WHERE path = ? OR (path >= ? AND path < ?)', ('a', 'a/', 'a0')
+    ).fetchall()
+    assert not any(row[-1].startswith('SCAN') for row in plan)
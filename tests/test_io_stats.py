@@ -0,0 +1,81 @@
+import pytest
+
+from io_stats import FIELDS, IOStats, SECTOR_SIZE, read_diskstats
+
+DEVICE = (8, 1)
+
+
+def counters(**values):
+    return tuple(values.get(field, 0) for field in FIELDS)
+
+
+def stats_with_samples(samples, windows=(10, 60, 300)):
+    """samples: (monotonic time, counters) pairs for DEVICE"""
+    stats = IOStats(windows=windows)
+    for t, values in samples:
+        stats._samples.append((t, {DEVICE: ('sda1', values)}))
+    return stats
+
+
+def test_read_diskstats(tmp_path):
+    path = tmp_path / 'diskstats'
+    path.write_text(
+        '   8       0 sda 10 0 80 5 20 0 160 40 0 30 45\n'
+        '   8       1 sda1 4 1 32 2 6 2 48 12 1 9 14 0 0 0 0 0 0\n'
+        ' 253       0 short 1 2\n'
+    )
+
+    stats = read_diskstats(str(path))
+
+    assert set(stats) == {(8, 0), (8, 1)}
+    assert stats[(8, 1)] == ('sda1', (4, 1, 32, 2, 6, 2, 48, 12, 1, 9, 14))
+
+
+def test_rates_over_each_window():
+    # A sample every 5 s for a minute, 1 MiB read and 10 reads taking 20 ms per second
+    samples = [(float(t), counters(reads=10 * t, sectors_read=2048 * t, read_ms=20 * t,
+                                   busy_ms=500 * t, weighted_ms=1500 * t, in_flight=3))
+               for t in range(0, 61, 5)]
+
+    metrics = stats_with_samples(samples).metrics(DEVICE)
+
+    assert metrics['device'] == 'sda1'
+    assert metrics['in_flight'] == 3
+    ten, minute, five_minutes = (metrics['windows'][w] for w in ('10', '60', '300'))
+    assert ten['seconds'] == 10
+    # Five minutes of history don't exist yet, the window covers what there is
+    assert minute['seconds'] == five_minutes['seconds'] == 60
+    for window in (ten, minute):
+        assert window['read_bytes_per_second'] == pytest.approx(2048 * SECTOR_SIZE)
+        assert window['read_iops'] == pytest.approx(10)
+        assert window['read_latency_ms'] == pytest.approx(2)
+        assert window['write_latency_ms'] is None
+        assert window['utilization'] == pytest.approx(0.5)
+        assert window['queue_depth'] == pytest.approx(1.5)
+
+
+def test_window_shorter_than_the_sample_interval_uses_the_previous_sample():
+    samples = [(0.0, counters()), (30.0, counters(writes=60, sectors_written=600, busy_ms=60000))]
+
+    window = stats_with_samples(samples, windows=(10,)).metrics(DEVICE)['windows']['10']
+
+    assert window['seconds'] == 30
+    assert window['write_iops'] == pytest.approx(2)
+    assert window['write_bytes_per_second'] == pytest.approx(20 * SECTOR_SIZE)
+    # busy_ms can run ahead of the clock between two reads of /proc/diskstats
+    assert window['utilization'] == 1.0
+
+
+def test_no_metrics_without_two_samples_or_for_unknown_devices():
+    assert stats_with_samples([(0.0, counters())]).metrics(DEVICE) is None
+    stats = stats_with_samples([(0.0, counters()), (5.0, counters())])
+    assert stats.metrics((8, 2)) is None
+
+
+def test_device_that_appeared_later_skips_older_windows():
+    stats = IOStats(windows=(10, 60))
+    stats._samples.append((0.0, {}))
+    stats._samples.append((55.0, {DEVICE: ('sda1', counters())}))
+    stats._samples.append((60.0, {DEVICE: ('sda1', counters(reads=5))}))
+
+    assert list(stats.metrics(DEVICE)['windows']) == ['10']
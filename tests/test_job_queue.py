@@ -0,0 +1,68 @@
+import os
+import time
+
+import pytest
+
+from job_queue import JobManager
+
+
+@pytest.fixture
+def jobs(tmp_path):
+    base = tmp_path / 'media'
+    base.mkdir()
+    manager = JobManager(str(base), db_path=str(tmp_path / 'jobs.db'))
+    yield manager
+    manager.executor.shutdown(wait=True)
+
+
+def wait(jobs, job):
+    deadline = time.monotonic() + 10
+    while jobs.get(job['id'])['status'] in ('queued', 'running'):
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+    return jobs.get(job['id'])
+
+
+@pytest.mark.parametrize('op', ['copy', 'move'])
+def test_directory_into_its_own_subtree_is_rejected(jobs, tmp_path, op):
+    source = tmp_path / 'media' / 'a'
+    (source / 'sub').mkdir(parents=True)
+
+    for destination in (source, source / 'sub'):
+        with pytest.raises(ValueError):
+            jobs.submit(op, [str(source)], str(destination))
+
+
+def test_copy_keeps_symlinks_as_links(jobs, tmp_path):
+    outside = tmp_path / 'outside.txt'
+    outside.write_bytes(b'secret')
+    source = tmp_path / 'media' / 'a'
+    source.mkdir()
+    (source / 'file.txt').write_bytes(b'data')
+    os.symlink(outside, source / 'link.txt')
+    os.symlink(tmp_path, source / 'linkdir')
+    destination = tmp_path / 'media' / 'b'
+    destination.mkdir()
+
+    job = wait(jobs, jobs.submit('copy', [str(source)], str(destination)))
+
+    assert job['status'] == 'done'
+    copied = destination / 'a'
+    assert (copied / 'file.txt').read_bytes() == b'data'
+    assert os.readlink(copied / 'link.txt') == str(outside)
+    assert os.readlink(copied / 'linkdir') == str(tmp_path)
+
+
+def test_short_copy_fails_the_item(jobs, tmp_path, monkeypatch):
+    source = tmp_path / 'media' / 'a.bin'
+    source.write_bytes(b'x' * 1024)
+    destination = tmp_path / 'media' / 'b'
+    destination.mkdir()
+    # What both calls return once the source has been truncated under the copy
+    monkeypatch.setattr(os, 'copy_file_range', lambda *args: 0, raising=False)
+    monkeypatch.setattr(os, 'sendfile', lambda *args: 0)
+
+    job = wait(jobs, jobs.submit('copy', [str(source)], str(destination)))
+
+    assert job['status'] == 'failed'
+    assert jobs.get(job['id'], include_items=True)['items'][0]['error'] == 'short copy at 0/1024'
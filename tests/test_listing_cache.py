@@ -0,0 +1,74 @@
+import os
+import time
+
+import pytest
+from watchdog.events import FileClosedEvent, FileOpenedEvent
+
+from listing_cache import ListingCache
+
+
+def wait_until(condition, timeout=5.0):
+    # inotify events reach the watchdog thread asynchronously
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@pytest.fixture
+def cache():
+    cache = ListingCache()
+    yield cache
+    cache.stop()
+
+
+@pytest.fixture
+def directory(tmp_path):
+    (tmp_path / 'file.txt').write_bytes(b'contents')
+    # Out of the FAT mtime granularity window, so freshness depends on events alone
+    past = time.time() - 60
+    os.utime(tmp_path, (past, past))
+    return tmp_path
+
+
+def test_reading_a_file_keeps_the_listing_cached(cache, directory):
+    listing = cache.get(str(directory))
+    assert listing.watch is not None
+
+    handler = ListingCache.DirectoryChangeHandler(cache, listing.key)
+    path = str(directory / 'file.txt')
+    handler.on_any_event(FileOpenedEvent(path))
+    handler.on_any_event(FileClosedEvent(path))
+
+    assert cache.peek(str(directory)) is listing
+
+
+def test_writing_a_file_invalidates_the_listing(cache, directory):
+    cache.get(str(directory))
+
+    with open(directory / 'file.txt', 'ab') as f:
+        f.write(b' more')
+
+    assert wait_until(lambda: cache.peek(str(directory)) is None)
+
+
+def test_watches_are_capped(tmp_path):
+    cache = ListingCache(max_watches=2)
+    try:
+        listings = []
+        for name in 'abc':
+            (tmp_path / name).mkdir()
+            listings.append(cache.get(str(tmp_path / name)))
+        assert [listing.watch is not None for listing in listings] == [True, True, False]
+
+        # Evicting the watched directories frees their watches for the next ones
+        cache.max_directories = 1
+        (tmp_path / 'd').mkdir()
+        cache.get(str(tmp_path / 'd'))
+        assert cache._watches == 0
+        (tmp_path / 'e').mkdir()
+        assert cache.get(str(tmp_path / 'e')).watch is not None
+    finally:
+        cache.stop()
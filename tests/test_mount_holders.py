@@ -0,0 +1,38 @@
+import os
+import mmap
+
+from mount_holders import MAX_PATHS, MountHolders, describe
+from mount_table import MountEntry
+
+
+def entry_for(path, mount_point):
+    st_dev = os.stat(path).st_dev
+    return MountEntry(1, 0, (os.major(st_dev), os.minor(st_dev)), '/', mount_point, 'rw', 'ext4', '/dev/x')
+
+
+def test_open_files_and_mappings_hold_the_mount(tmp_path):
+    held = tmp_path / 'held.bin'
+    held.write_bytes(b'\0' * mmap.PAGESIZE)
+    # Neither a real mount point nor a device number anything else here uses
+    free = MountEntry(2, 0, (4095, 1048575), '/', '/media/u/free', 'rw', 'ext4', '/dev/y')
+
+    with open(held, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ):
+        holders = MountHolders().scan([entry_for(held, '/media/u/held'), free])
+
+    assert holders['/media/u/free'] == []
+    mine = [holder for holder in holders['/media/u/held'] if holder['pid'] == os.getpid()]
+    assert len(mine) == 1
+    assert mine[0]['self'] is True
+    assert {'file', 'mmap'} <= set(mine[0]['uses'])
+    # /tmp can share the root filesystem with everything else this process has open
+    assert 0 < len(mine[0]['paths']) <= MAX_PATHS
+
+
+def test_no_mounts_asked_about():
+    assert MountHolders().scan([]) == {}
+
+
+def test_describe():
+    holders = [{'command': 'smbd', 'pid': 812, 'uses': ['file']},
+               {'command': 'bash', 'pid': 1020, 'uses': ['cwd', 'file']}]
+    assert describe(holders) == 'smbd[812] (file), bash[1020] (cwd, file)'
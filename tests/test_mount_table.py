@@ -0,0 +1,66 @@
+from mount_table import MountTable, parse_mountinfo
+
+ROOT = '22 1 259:2 / / rw,relatime shared:1 - ext4 /dev/nvme0n1p2 rw\n'
+SDB1 = '95 22 8:17 / /media/necris-user/sdb1 rw,nosuid,nodev shared:52 master:3 - ext4 /dev/sdb1 rw\n'
+# ntfs-3g: anonymous device number, the block device is only in the source field
+SDC1 = ('97 22 0:51 / /media/necris-user/My\\040Passport rw,relatime shared:54 - fuseblk /dev/sdc1 '
+        'rw,user_id=0,group_id=0,allow_other\n')
+
+
+def test_parse_mountinfo():
+    root, sdb1, sdc1 = parse_mountinfo(ROOT + SDB1 + SDC1)
+
+    assert (root.mount_id, root.parent_id, root.device) == (22, 1, (259, 2))
+    # Optional fields of any number sit before the separator
+    assert (sdb1.fs_type, sdb1.source, sdb1.options) == ('ext4', '/dev/sdb1', 'rw,nosuid,nodev')
+    assert sdc1.mount_point == '/media/necris-user/My Passport'
+    assert (sdc1.device, sdc1.fs_type, sdc1.source) == ((0, 51), 'fuseblk', '/dev/sdc1')
+
+
+def test_malformed_lines_are_skipped():
+    entries = parse_mountinfo(
+        '\n'
+        'garbage\n'
+        '23 22 8:1 / /boot rw\n'
+        'x 22 8:1 / /a rw - ext4 /dev/a rw\n'
+        + SDB1
+    )
+    assert [entry.mount_id for entry in entries] == [95]
+
+
+def write(path, text):
+    path.write_text(text)
+
+
+def test_table_indexes_and_listeners(tmp_path):
+    mountinfo = tmp_path / 'mountinfo'
+    write(mountinfo, ROOT + SDB1)
+    table = MountTable(str(mountinfo))
+    changes = []
+    table.add_listener(lambda added, removed: changes.append(
+        ([e.mount_point for e in added], [e.mount_point for e in removed])))
+
+    assert table.is_mounted('/media/necris-user/sdb1/')
+    assert table.by_source('/dev/sdb1').mount_id == 95
+    assert table.by_device((8, 17)).mount_point == '/media/necris-user/sdb1'
+
+    write(mountinfo, ROOT + SDC1)
+    table.refresh()
+    assert changes == [(['/media/necris-user/My Passport'], ['/media/necris-user/sdb1'])]
+    assert not table.is_mounted('/media/necris-user/sdb1')
+    assert [e.source for e in table.mounts_under('/media/necris-user')] == ['/dev/sdc1']
+
+    # Re-reading an unchanged table tells nobody
+    table.refresh()
+    assert len(changes) == 1
+
+
+def test_later_mount_covers_the_earlier_one(tmp_path):
+    mountinfo = tmp_path / 'mountinfo'
+    over = '96 95 8:33 / /media/necris-user/sdb1 rw - vfat /dev/sdc1 rw\n'
+    write(mountinfo, ROOT + SDB1 + over)
+
+    table = MountTable(str(mountinfo))
+
+    assert table.by_mount_point('/media/necris-user/sdb1').source == '/dev/sdc1'
+    assert [e.mount_id for e in table.mounts_under('/media/necris-user')] == [96]
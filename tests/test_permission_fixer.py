@@ -0,0 +1,38 @@
+import os
+import json
+
+from permission_fixer import PermissionFixer
+
+
+def write_state(path, state):
+    with open(path, 'w') as f:
+        json.dump(state, f)
+
+
+def test_passes_left_running_are_marked_interrupted(tmp_path):
+    state_path = tmp_path / 'state.json'
+    write_state(state_path, {
+        'a1': {'mount_point': '/media/u/sdb1', 'done': ['x'], 'finished_at': None, 'running': True},
+        'b2': {'mount_point': '/media/u/sdc1', 'done': [], 'finished_at': 1.0, 'running': False},
+    })
+
+    fixer = PermissionFixer(os.getuid(), os.getgid(), state_path=str(state_path))
+
+    saved = PermissionFixer.load_state(str(state_path))
+    assert saved['a1']['running'] is False and saved['a1']['interrupted'] is True
+    assert saved['a1']['done'] == ['x']
+    assert 'interrupted' not in saved['b2']
+    assert fixer.status() == saved
+
+
+def test_unfinished_follows_the_filesystem_state(tmp_path):
+    state_path = tmp_path / 'state.json'
+    key = format(os.statvfs(tmp_path).f_fsid, 'x')
+
+    write_state(state_path, {key: {'mount_point': str(tmp_path), 'done': [], 'finished_at': None}})
+    assert PermissionFixer(0, 0, state_path=str(state_path)).unfinished(str(tmp_path))
+
+    write_state(state_path, {key: {'mount_point': str(tmp_path), 'done': [], 'finished_at': 1.0}})
+    assert not PermissionFixer(0, 0, state_path=str(state_path)).unfinished(str(tmp_path))
+
+    assert not PermissionFixer(0, 0, state_path=str(state_path)).unfinished(str(tmp_path / 'missing'))
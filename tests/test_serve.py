@@ -0,0 +1,28 @@
+import pytest
+
+from serve import check_config, parse_args, split_bind
+
+
+def test_defaults_are_valid():
+    assert check_config(parse_args([]), load_app=False) == []
+
+
+@pytest.mark.parametrize('argv, problem', [
+    (['--workers', '2'], '--workers must be 1'),
+    (['--threads', '0'], '--threads must be at least 1'),
+    (['--bind', 'localhost:http'], 'Invalid bind address'),
+    (['--keepalive', '-1'], 'Timeouts must not be negative'),
+])
+def test_invalid_settings_are_reported(argv, problem):
+    problems = check_config(parse_args(argv), load_app=False)
+    assert len(problems) == 1 and problems[0].startswith(problem)
+
+
+def test_settings_come_from_the_environment(monkeypatch):
+    monkeypatch.setenv('NECRIS_THREADS', '8')
+    assert parse_args([]).threads == 8
+
+
+def test_split_bind():
+    assert split_bind('127.0.0.1:8080') == ('127.0.0.1', 8080)
+    assert split_bind(':80') == ('0.0.0.0', 80)
@@ -0,0 +1,63 @@
+import os
+import time
+
+import pytest
+
+from space_analyzer import SpaceAnalyzer
+
+
+def allocated(*paths):
+    return sum(os.stat(path).st_blocks * 512 for path in paths)
+
+
+@pytest.fixture
+def drive(tmp_path):
+    root = tmp_path / 'media' / 'drive1'
+    (root / 'Videos' / '2023').mkdir(parents=True)
+    (root / 'Photos').mkdir()
+    (root / 'Videos' / '2023' / 'trip.mp4').write_bytes(os.urandom(64 * 1024))
+    (root / 'Photos' / 'a.jpg').write_bytes(os.urandom(8 * 1024))
+    (root / 'notes.txt').write_bytes(b'x')
+    # Old enough that an unchanged mtime is trusted on the next analysis
+    past = time.time() - 60
+    for path in (root, root / 'Videos', root / 'Videos' / '2023', root / 'Photos'):
+        os.utime(path, (past, past))
+    return root
+
+
+@pytest.fixture
+def analyzer(tmp_path):
+    return SpaceAnalyzer(str(tmp_path / 'media'), db_path=str(tmp_path / 'space.db'))
+
+
+def test_totals_roll_up_to_the_drive(analyzer, drive):
+    analyzer.analyze('drive1')
+
+    tree = analyzer.tree('drive1', depth=2)
+    files = [drive / 'Videos' / '2023' / 'trip.mp4', drive / 'Photos' / 'a.jpg', drive / 'notes.txt']
+    assert (tree['size'], tree['files']) == (allocated(*files), 3)
+    children = {child['name']: child for child in tree['children']}
+    # Largest first, the drive's own files folded into one node
+    assert [child['name'] for child in tree['children']] == ['Videos', 'Photos', '1 files']
+    assert children['Videos']['children'][0]['path'] == os.path.join('drive1', 'Videos', '2023')
+
+
+def test_unchanged_directories_are_not_listed_again(analyzer, drive):
+    analyzer.analyze('drive1')
+    (drive / 'Photos' / 'b.jpg').write_bytes(os.urandom(4096))
+
+    analyzer.analyze('drive1')
+
+    progress = analyzer.progress['drive1']
+    assert progress['listed'] == 1
+    assert progress['reused'] == progress['directories'] - 1
+    assert analyzer.tree('drive1', depth=0)['files'] == 4
+
+
+def test_small_children_are_folded(analyzer, drive):
+    analyzer.analyze('drive1')
+
+    children = analyzer.tree('drive1', depth=1, top=1)['children']
+
+    assert [child['name'] for child in children] == ['Videos', '1 more folders', '1 files']
+    assert children[1]['path'] is None
@@ -0,0 +1,76 @@
+import io
+import os
+import struct
+import zipfile
+
+from zip_stream import ZipStream
+
+
+def archive(root):
+    return zipfile.ZipFile(io.BytesIO(b''.join(ZipStream(str(root), 'share'))))
+
+
+def test_archive_contains_tree(tmp_path):
+    (tmp_path / 'docs').mkdir()
+    (tmp_path / 'docs' / 'a.txt').write_bytes(b'alpha')
+    (tmp_path / 'b.bin').write_bytes(b'\0' * 1000)
+
+    with archive(tmp_path) as zf:
+        assert zf.testzip() is None
+        assert zf.read('share/docs/a.txt') == b'alpha'
+        assert zf.read('share/b.bin') == b'\0' * 1000
+
+
+def test_symlinks_out_of_the_root_are_not_archived(tmp_path):
+    root = tmp_path / 'root'
+    outside = tmp_path / 'outside'
+    root.mkdir()
+    outside.mkdir()
+    (outside / 'secret.txt').write_bytes(b'secret')
+    (root / 'kept.txt').write_bytes(b'kept')
+    os.symlink(outside / 'secret.txt', root / 'link.txt')
+    os.symlink(outside, root / 'linkdir')
+
+    with archive(root) as zf:
+        names = zf.namelist()
+        assert 'share/kept.txt' in names
+        assert not any('link' in name or 'secret' in name for name in names)
+        assert all(zf.read(name) != b'secret' for name in names if not name.endswith('/'))
+
+
+def test_zip64_for_entries_past_4_gib(tmp_path):
+    root = tmp_path / 'root'
+    root.mkdir()
+    big_size = 0xFFFFFFFF + 64 * 1024 * 1024
+    # Sparse, and the archive below is written sparse too, so this costs no disk
+    with open(root / 'a.bin', 'wb') as f:
+        f.truncate(big_size)
+    (root / 'b.txt').write_bytes(b'after the big one')
+
+    stream = ZipStream(str(root), 'share', block_size=16 * 1024 * 1024)
+    output = tmp_path / 'out.zip'
+    with open(output, 'wb') as f:
+        for chunk in stream:
+            if chunk.count(0) == len(chunk):
+                f.seek(len(chunk), os.SEEK_CUR)
+            else:
+                f.write(chunk)
+        f.truncate()
+
+    with zipfile.ZipFile(output) as zf:
+        big = zf.getinfo('share/a.bin')
+        assert big.file_size == big.compress_size == big_size
+        small = zf.getinfo('share/b.txt')
+        assert small.header_offset > 0xFFFFFFFF
+
+        with open(output, 'rb') as f:
+            f.seek(big.header_offset)
+            local_header = f.read(30 + len('share/a.bin') + 20)
+            f.seek(big_size, os.SEEK_CUR)
+            descriptor = struct.unpack('<IIQQ', f.read(24))
+        version, = struct.unpack_from('<H', local_header, 4)
+        compressed_size, size = struct.unpack_from('<II', local_header, 18)
+        extra_id, = struct.unpack_from('<H', local_header, 30 + len('share/a.bin'))
+        assert (version, compressed_size, size, extra_id) == (45, 0xFFFFFFFF, 0xFFFFFFFF, 0x0001)
+        assert descriptor == (0x08074b50, big.CRC, big_size, big_size)
+        assert zf.read('share/b.txt') == b'after the big one'
@@ -0,0 +1,177 @@
+import os
+import shutil
+import hashlib
+import logging
+import threading
+import subprocess
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional, without it only video posters are generated
+    Image = None
+
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+VIDEO_EXTENSIONS = {'mp4'}
+
+
+class ThumbnailCache:
+    """Generates thumbnails in a worker pool and keeps them in a byte-bounded LRU disk cache.
+
+    Cache entries are keyed by (path, size, mtime, thumbnail size), so a
+    changed file simply gets a new entry and the stale one ages out. Recency is
+    kept in memory and mirrored to the entry's mtime, which lets the LRU order
+    survive restarts.
+    """
+
+    def __init__(self, cache_dir: str = '/var/cache/necris/thumbnails', max_bytes: int = 256 * 1024 * 1024,
+                 size: int = 256, workers: int = 2, ffmpeg_timeout: int = 30):
+        self.logger = logging.getLogger(__name__)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.size = size
+        self.ffmpeg_timeout = ffmpeg_timeout
+        self.ffmpeg = shutil.which('ffmpeg')
+
+        self.supported_extensions = set()
+        if Image is not None:
+            self.supported_extensions |= IMAGE_EXTENSIONS
+        if self.ffmpeg:
+            self.supported_extensions |= VIDEO_EXTENSIONS
+
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='thumbnailer')
+        self._lock = threading.RLock()  # done-callbacks may run while it is held
+        self._entries: 'OrderedDict[str, int]' = OrderedDict()
+        self._total_bytes = 0
+        self._in_flight = {}
+        self._failed = OrderedDict()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        found = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                if name.endswith('.tmp'):
+                    os.remove(path)
+                    continue
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                found.append((st.st_mtime, name[:-4], st.st_size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._total_bytes += size
+        self._evict()
+
+    def _cache_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f'{key}.jpg')
+
+    def cache_key(self, path: str, st: os.stat_result) -> str:
+        return hashlib.sha1(f'{path}\0{st.st_size}\0{st.st_mtime_ns}\0{self.size}'.encode()).hexdigest()
+
+    def is_supported(self, filename: str) -> bool:
+        return '.' in filename and filename.rsplit('.', 1)[1].lower() in self.supported_extensions
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(self._cache_path(key))
+            except OSError:
+                pass
+
+    def _touch(self, key: str) -> bool:
+        with self._lock:
+            if key not in self._entries:
+                return False
+            self._entries.move_to_end(key)
+        try:
+            os.utime(self._cache_path(key))
+        except OSError:
+            # Evicted or removed behind our back
+            with self._lock:
+                self._total_bytes -= self._entries.pop(key, 0)
+            return False
+        return True
+
+    def _render_image(self, path: str, out_path: str):
+        with Image.open(path) as img:
+            # Let the JPEG decoder downscale while decoding instead of decoding full size
+            img.draft('RGB', (self.size, self.size))
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((self.size, self.size))
+            img.convert('RGB').save(out_path, 'JPEG', quality=80, optimize=True)
+
+    def _render_video(self, path: str, out_path: str):
+        subprocess.run(
+            [self.ffmpeg, '-nostdin', '-loglevel', 'error', '-ss', '1', '-i', path,
+             '-frames:v', '1', '-vf', f'scale={self.size}:-2', '-f', 'image2', '-y', out_path],
+            check=True, capture_output=True, timeout=self.ffmpeg_timeout
+        )
+
+    def _generate(self, path: str, key: str) -> Optional[str]:
+        cache_path = self._cache_path(key)
+        tmp_path = f'{cache_path}.{threading.get_ident()}.tmp'
+        extension = path.rsplit('.', 1)[1].lower()
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            if extension in VIDEO_EXTENSIONS:
+                self._render_video(path, tmp_path)
+            else:
+                self._render_image(path, tmp_path)
+            os.replace(tmp_path, cache_path)
+            size = os.path.getsize(cache_path)
+        except Exception as e:
+            self.logger.warning(f"Failed to generate thumbnail for {path}: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            with self._lock:
+                self._failed[key] = True
+                while len(self._failed) > 1024:
+                    self._failed.popitem(last=False)
+            return None
+
+        with self._lock:
+            self._total_bytes += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            self._evict()
+        return cache_path
+
+    def get(self, path: str, timeout: float = 15.0) -> Optional[str]:
+        """Return the cached thumbnail for a file, generating it if needed.
+
+        Returns None for unsupported or undecodable files and when generation
+        takes longer than the timeout (it keeps running for the next request).
+        """
+        if not self.is_supported(path):
+            return None
+        st = os.stat(path)
+        key = self.cache_key(path, st)
+        if self._touch(key):
+            return self._cache_path(key)
+
+        with self._lock:
+            if key in self._failed:
+                return None
+            future = self._in_flight.get(key)
+            if future is None:
+                future = self.executor.submit(self._generate, path, key)
+                self._in_flight[key] = future
+                future.add_done_callback(lambda _: self._forget_in_flight(key))
+        try:
+            return future.result(timeout=timeout)
+        except Exception:
+            return None
+
+    def _forget_in_flight(self, key: str):
+        with self._lock:
+            self._in_flight.pop(key, None)
@@ -8,9 +8,42 @@ from pathlib import Path
 import time
 import pwd
 import grp
-import psutil
+import threading
+import selectors
+from collections import deque
+
+from service_control import notify_ready
+from permission_fixer import PermissionFixer
+from device_dispatcher import DeviceDispatcher
+from mount_table import get_mount_table
+from mount_holders import MountHolders, describe
+
+class StageTimer:
+    """Wall time of the consecutive stages of one mount"""
+    def __init__(self):
+        self.started = time.monotonic()
+        self._last = self.started
+        self.stages = {}
+
+    def mark(self, stage):
+        now = time.monotonic()
+        self.stages[stage] = self.stages.get(stage, 0) + now - self._last
+        self._last = now
+
+    def add(self, stage, seconds):
+        self.stages[stage] = seconds
+
+    def total(self):
+        # Includes stages added from elsewhere, like udev's processing before the event
+        return sum(self.stages.values())
+
+    def summary(self):
+        return ', '.join(f"{stage} {seconds * 1000:.0f}ms" for stage, seconds in self.stages.items())
 
 class USBMonitor:
+    # Seconds to wait for udev to finish probing a device before asking blkid
+    UDEV_SETTLE_TIMEOUT = 5
+
     def __init__(self):
         # Setup logging
         logging.basicConfig(
@@ -38,34 +71,63 @@ class USBMonitor:
         self.mount_base = Path(f'/media/{self.user}')
         self.setup_mount_directory()
         
+        # Ownership and modes of ext drives are fixed in the background after mounting
+        self.permission_fixer = PermissionFixer(self.uid, self.gid)
+
+        # Events are handled in order per device, different devices in parallel
+        self.dispatcher = DeviceDispatcher(self.device_handler)
+
+        # Per-stage timings of recent mounts, newest last
+        self.mount_timings = deque(maxlen=50)
+
         # Keep track of mounted devices
+        self.mount_table = get_mount_table()
+        # Decides between a normal and a lazy unmount from what holds the drive
+        self.mount_holders = MountHolders()
         self.mounted_devices = set()
         self.validate_existing_mounts()
 
+        # Called with ('mounted' | 'unmounted', mount point) when running in the
+        # orchestrator's shared runtime, instead of others watching /media
+        self.listeners = []
+        self.on_ready = notify_ready
+        # stop() writes here to wake the event loop
+        self._stop_r, self._stop_w = os.pipe()
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def _notify_listeners(self, event, mount_point):
+        for callback in self.listeners:
+            try:
+                callback(event, Path(mount_point))
+            except Exception as e:
+                self.logger.error(f"Mount listener failed for {event} {mount_point}: {e}")
+
     def validate_existing_mounts(self):
         """Validate existing mounts and clean up stale ones"""
         self.logger.info("Validating existing mounts...")
-        partitions = psutil.disk_partitions(all=True)
-        
-        for partition in partitions:
-            device_path = partition.device
-            mount_point = partition.mountpoint
-            
-            # Check if this is one of our managed mount points
-            if not str(mount_point).startswith(str(self.mount_base)):
-                continue
+        # Only our managed mount points
+        entries = self.mount_table.mounts_under(self.mount_base)
+        stale = [entry for entry in entries if not os.path.exists(entry.source)]
+        # One pass over /proc for every stale mount
+        holders = self.mount_holders.scan(stale) if stale else {}
+
+        for entry in entries:
+            device_path = entry.source
+            mount_point = entry.mount_point
                 
             try:
                 # Check if the device actually exists
-                if not os.path.exists(device_path):
+                if entry in stale:
                     self.logger.warning(f"Found stale mount for missing device {device_path}")
                     try:
                         # Check if the mount point is actually mounted
-                        if os.path.ismount(mount_point):
+                        if self.mount_table.is_mounted(mount_point):
                             # Check if mount point is busy
-                            lsof_check = subprocess.run(['lsof', mount_point], capture_output=True)
-                            if lsof_check.returncode == 0:
-                                self.logger.warning(f"Mount point {mount_point} is busy. Attempting lazy unmount...")
+                            if holders.get(mount_point):
+                                self.logger.warning(f"Mount point {mount_point} is busy ({describe(holders[mount_point])}). "
+                                                    f"Attempting lazy unmount...")
                                 # Try lazy unmount
                                 subprocess.run(['umount', '-l', mount_point], check=True, capture_output=True)
                             else:
@@ -109,7 +171,8 @@ class USBMonitor:
 
         try:
             # First check if it's actually mounted
-            if not os.path.ismount(str(mount_point)):
+            entry = self.mount_table.by_mount_point(mount_point)
+            if entry is None:
                 self.logger.info(f"Device {device_path} is not mounted at {mount_point}")
                 # Clean up mount point if it exists but isn't mounted
                 if mount_point.exists():
@@ -117,12 +180,17 @@ class USBMonitor:
                         mount_point.rmdir()
                 return True
 
+            # The permission pass holds directories open, stop it before unmounting
+            self.permission_fixer.cancel(str(mount_point))
+
             # Check if mount point is busy
-            lsof_check = subprocess.run(['lsof', str(mount_point)], capture_output=True)
+            started = time.monotonic()
+            holders = self.mount_holders.scan([entry])[entry.mount_point]
+            self.logger.debug(f"Busy check of {mount_point} took {(time.monotonic() - started) * 1000:.0f}ms")
             
-            if lsof_check.returncode == 0:
+            if holders:
                 # Mount point is busy, try lazy unmount
-                self.logger.warning(f"Mount point {mount_point} is busy, attempting lazy unmount")
+                self.logger.warning(f"Mount point {mount_point} is busy ({describe(holders)}), attempting lazy unmount")
                 subprocess.run(['umount', '-l', str(mount_point)], check=True)
             else:
                 # Try regular unmount first
@@ -144,6 +212,7 @@ class USBMonitor:
                     self.logger.warning(f"Mount point directory {mount_point} not empty, skipping removal")
                     
             self.logger.info(f"Successfully unmounted {device_path}")
+            self._notify_listeners('unmounted', mount_point)
             return True
 
         except subprocess.CalledProcessError as e:
@@ -156,11 +225,9 @@ class USBMonitor:
     def update_mounted_devices(self):
         """Update the set of currently mounted devices, verifying they still exist"""
         self.mounted_devices.clear()
-        partitions = psutil.disk_partitions(all=True)
-        for partition in partitions:
-            device_path = partition.device
-            if (os.path.exists(device_path) and  # Verify device still exists
-                str(partition.mountpoint).startswith(str(self.mount_base))):  # Our mount
+        for entry in self.mount_table.mounts_under(self.mount_base):
+            device_path = entry.source
+            if os.path.exists(device_path):  # Verify device still exists
                 self.mounted_devices.add(device_path)
                 self.logger.debug(f"Found mounted device: {device_path}")
 
@@ -187,39 +254,19 @@ class USBMonitor:
             self.logger.error(f"Failed to setup mount directory: {e}")
             raise
 
-    def set_permissions(self, path, is_directory=True):
-        """Set appropriate permissions for mounted files and directories"""
-        try:
-            os.chown(path, self.uid, self.gid)
-            if is_directory:
-                # rwxr-xr-x for directories
-                os.chmod(path, 0o755)
-            else:
-                # rw-r--r-- for files
-                os.chmod(path, 0o644)
-            return True
-        except Exception as e:
-            self.logger.error(f"Failed to set permissions for {path}: {e}")
-            return False
-
-    def recursively_set_permissions(self, path):
-        """Recursively set permissions on a directory"""
-        try:
-            for root, dirs, files in os.walk(path):
-                # Set directory permissions
-                self.set_permissions(root, True)
-                # Set file permissions
-                for file in files:
-                    self.set_permissions(os.path.join(root, file), False)
-            return True
-        except Exception as e:
-            self.logger.error(f"Failed to recursively set permissions: {e}")
-            return False
+    def resume_permission_passes(self):
+        """Continue the passes a restart or SIGTERM cut short on drives that stayed mounted"""
+        self.mount_table.refresh()
+        for entry in self.mount_table.mounts_under(self.mount_base):
+            if entry.fs_type in ['ext4', 'ext3', 'ext2'] and self.permission_fixer.unfinished(entry.mount_point):
+                self.logger.info(f"Resuming background permission pass on {entry.mount_point}")
+                self.permission_fixer.fix(entry.mount_point)
 
     def scan_existing_devices(self):
         """Scan and mount already connected USB devices"""
         # First validate existing mounts
         self.validate_existing_mounts()
+        self.resume_permission_passes()
         
         self.logger.info("Scanning for existing USB devices...")
         
@@ -238,41 +285,60 @@ class USBMonitor:
                     continue
                 
                 self.logger.info(f"Found existing USB device: {device_path}")
-                fs_type = self.get_filesystem_type(device_path)
-                
-                if fs_type:
-                    self.logger.info(f"Mounting existing device {device_path} with filesystem {fs_type}")
-                    self.mount_device(device_path, fs_type)
+                self.dispatcher.submit(device_path, 'add', device)
                     
             except Exception as e:
                 self.logger.error(f"Error processing existing device {device.device_node}: {e}")
 
-    def get_filesystem_type(self, device_path):
-        """Detect filesystem type using blkid"""
-        try:
-            self.logger.debug(f"Attempting to detect filesystem type for {device_path}")
-            for attempt in range(3):
-                self.logger.debug(f"Attempt {attempt + 1} to detect filesystem type")
-                result = subprocess.run(
-                    ['blkid', '-o', 'value', '-s', 'TYPE', device_path],
-                    capture_output=True,
-                    text=True
-                )
-                self.logger.debug(f"blkid output: '{result.stdout.strip()}', stderr: '{result.stderr.strip()}'")
-                if result.stdout.strip():
-                    fs_type = result.stdout.strip()
-                    self.logger.debug(f"Detected filesystem type: {fs_type}")
+        # Existing drives are mounted in parallel, ready means all of them are
+        self.dispatcher.wait_idle()
+
+    def wait_for_udev(self, device):
+        """Return the device once udev has processed it (and run its blkid probe)"""
+        if device.is_initialized:
+            return device
+        # Only devices found by scanning can be uninitialized, events arrive after processing
+        self.logger.debug(f"Waiting for udev to finish probing {device.device_node}")
+        subprocess.run(['udevadm', 'settle', f'--timeout={self.UDEV_SETTLE_TIMEOUT}'], capture_output=True)
+        return pyudev.Devices.from_device_file(self.context, device.device_node)
+
+    def get_filesystem_type(self, device_path, device=None):
+        """Filesystem type from udev's probe, falling back to blkid when udev has none"""
+        if device is not None:
+            try:
+                device = self.wait_for_udev(device)
+                properties = device.properties
+                fs_type = properties.get('ID_FS_TYPE')
+                if fs_type:
+                    self.logger.debug(f"udev reports {device_path} as {fs_type} "
+                                      f"(UUID {properties.get('ID_FS_UUID', 'unknown')})")
                     return fs_type
-                time.sleep(1)
-            self.logger.warning(f"Failed to detect filesystem type after 3 attempts for {device_path}")
+                if device.is_initialized:
+                    # Probed and nothing found, blkid below is a last low-level try
+                    self.logger.debug(f"udev found no filesystem on {device_path}")
+            except Exception as e:
+                self.logger.warning(f"Could not read udev properties of {device_path}: {e}")
+
+        try:
+            self.logger.debug(f"Detecting filesystem type of {device_path} with blkid")
+            # -p probes the device itself instead of trusting blkid's cache
+            result = subprocess.run(
+                ['blkid', '-p', '-o', 'value', '-s', 'TYPE', device_path],
+                capture_output=True,
+                text=True
+            )
+            self.logger.debug(f"blkid output: '{result.stdout.strip()}', stderr: '{result.stderr.strip()}'")
+            if result.stdout.strip():
+                return result.stdout.strip()
+            self.logger.warning(f"Failed to detect filesystem type for {device_path}")
             return None
-        except subprocess.CalledProcessError as e:
+        except (subprocess.CalledProcessError, OSError) as e:
             self.logger.error(f"Failed to detect filesystem type: {e}")
             return None
 
-
-    def mount_device(self, device_path, filesystem_type):
+    def mount_device(self, device_path, filesystem_type, timer=None):
         """Mount the device with appropriate filesystem type and permissions"""
+        timer = timer or StageTimer()
         self.logger.debug(f"Attempting to mount {device_path} with filesystem type {filesystem_type}")
         
         # Skip if already mounted
@@ -347,21 +413,34 @@ class USBMonitor:
                     # Update mounted devices list
                     self.mounted_devices.add(device_path)
                     
-                    # For ext filesystems, we need to set permissions after mounting
-                    if filesystem_type in ['ext4', 'ext3', 'ext2']:
-                        self.logger.debug("Setting permissions for ext filesystem...")
-                        self.recursively_set_permissions(str(mount_point))
-                    
-                    # Verify mount was successful
-                    if not os.path.ismount(str(mount_point)):
+                    # Verify mount was successful, without waiting for the table's watch thread
+                    self.mount_table.refresh()
+                    if not self.mount_table.is_mounted(mount_point):
                         raise Exception("Mount point verification failed")
+                    timer.mark('mount')
+
+                    # ext filesystems keep their own owners, hand them to the user in the
+                    # background so the drive is usable right away
+                    if filesystem_type in ['ext4', 'ext3', 'ext2']:
+                        self.logger.debug("Starting background permission pass for ext filesystem...")
+                        self.permission_fixer.fix(str(mount_point))
                     
+                    self._notify_listeners('mounted', mount_point)
+                    timer.mark('share')
+                    self.mount_timings.append({
+                        'device': device_path, 'filesystem': filesystem_type,
+                        'time': time.time(), 'total': timer.total(), 'stages': dict(timer.stages)
+                    })
+                    self.logger.info(f"{device_path} ready at {mount_point} in {timer.total() * 1000:.0f}ms "
+                                     f"({timer.summary()})")
                     return True
                 except subprocess.CalledProcessError as e:
                     self.logger.error(f"Mount attempt {attempt + 1} failed: stdout='{e.stdout}', stderr='{e.stderr}'")
                     if attempt == 2:  # Last attempt
                         raise
-                    time.sleep(1)
+                    # Short backoff, a failure is rarely fixed by waiting long
+                    time.sleep(0.25 * 2 ** attempt)
+                    timer.mark('mount_retry')
             return False
         except Exception as e:
             self.logger.error(f"Failed to mount {device_path}: {str(e)}")
@@ -371,20 +450,26 @@ class USBMonitor:
                 pass
             return False
 
-    def device_handler(self, device):
-        """Handle device events"""
-        if device.action == 'add':
+    def device_handler(self, action, device):
+        """Handle one device event, called by the dispatcher"""
+        if action == 'add':
             self.logger.info(f"New device detected: {device.device_node}")
-            self.logger.debug(f"Device properties: {dict(device)}")
-            time.sleep(1)  # Small delay to let system initialize device
-            fs_type = self.get_filesystem_type(device.device_node)
+            self.logger.debug(f"Device properties: {dict(device.properties)}")
+            timer = StageTimer()
+            # Devices from the startup scan carry no action and were initialized long ago
+            if device.action == 'add' and device.is_initialized:
+                # udev's own processing (rules, blkid probe) before the event reached us
+                timer.add('udev', device.time_since_initialized.total_seconds())
+            # Events from the udev netlink source arrive after probing, no need to wait
+            fs_type = self.get_filesystem_type(device.device_node, device)
+            timer.mark('probe')
             self.logger.debug(f"Filesystem type detection returned: {fs_type}")
             if fs_type:
                 self.logger.info(f"Detected filesystem: {fs_type}")
-                self.mount_device(device.device_node, fs_type)
+                self.mount_device(device.device_node, fs_type, timer)
             else:
                 self.logger.warning(f"No filesystem type detected for {device.device_node}")
-        elif device.action == 'remove':
+        elif action == 'remove':
             self.logger.info(f"Device removed: {device.device_node}")
             self.unmount_device(device.device_node)
 
@@ -398,12 +483,31 @@ class USBMonitor:
         # Then start monitoring for new events
         self.logger.info("Starting monitoring for new USB events...")
         self.monitor.start()
-        for device in iter(self.monitor.poll, None):
-            try:
-                self.device_handler(device)
-            except Exception as e:
-                self.logger.error(f"Error handling device: {e}")
-                continue
+        self.on_ready()
+        # Sleeps until udev sends an event or stop() is called
+        selector = selectors.DefaultSelector()
+        selector.register(self.monitor, selectors.EVENT_READ)
+        selector.register(self._stop_r, selectors.EVENT_READ)
+        try:
+            while True:
+                ready = [key.fileobj for key, _ in selector.select()]
+                if self._stop_r in ready:
+                    break
+                while True:
+                    device = self.monitor.poll(timeout=0)
+                    if device is None:
+                        break
+                    if device.action in ('add', 'remove'):
+                        self.dispatcher.submit(device.device_node, device.action, device)
+        finally:
+            selector.close()
+            self.dispatcher.shutdown()
+
+    def stop(self):
+        """Make start_monitoring return and end permission passes, used when running as a thread"""
+        os.write(self._stop_w, b'\0')
+        # A restarted monitor gets its own fixer, it couldn't cancel these passes
+        self.permission_fixer.cancel_all()
 
 def main():
     logging.basicConfig(level=logging.DEBUG)
@@ -0,0 +1,201 @@
+import os
+import time
+import zlib
+import struct
+import logging
+from typing import Iterator, List, NamedTuple
+
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_FILECOUNT_LIMIT = 0xFFFF
+ZIP64_MARKER = 0xFFFFFFFF
+
+# Extensions that are worth deflating when compression is requested. Media and
+# archives are already compressed and always go in stored.
+COMPRESSIBLE_EXTENSIONS = {
+    'txt', 'csv', 'tsv', 'json', 'xml', 'html', 'htm', 'css', 'js', 'md',
+    'log', 'ini', 'cfg', 'conf', 'yaml', 'yml', 'svg', 'py', 'sh'
+}
+
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+METHOD_STORED = 0
+METHOD_DEFLATED = 8
+
+
+class CentralEntry(NamedTuple):
+    """What the central directory needs to remember about a written entry"""
+    name: bytes
+    method: int
+    dos_time: int
+    dos_date: int
+    crc: int
+    compressed_size: int
+    size: int
+    offset: int
+    external_attr: int
+    zip64: bool
+
+
+def _dos_datetime(mtime: float):
+    t = time.localtime(max(mtime, 315532800))  # ZIP can't represent dates before 1980
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_time, dos_date
+
+
+class ZipStream:
+    """Streams a directory tree as a ZIP64 archive while walking it.
+
+    Nothing is buffered beyond one read block: every entry is written with a
+    data descriptor so its CRC-32 can be computed incrementally as the file is
+    read, and ZIP64 records are used only where sizes, offsets or the entry
+    count need them. The only state that grows with the archive is one small
+    tuple per entry for the central directory.
+    """
+
+    def __init__(self, root: str, arcname_root: str, compress_text: bool = False,
+                 block_size: int = 1024 * 1024):
+        self.logger = logging.getLogger(__name__)
+        self.root = root
+        self.arcname_root = arcname_root.strip('/')
+        self.compress_text = compress_text
+        self.block_size = block_size
+        self.offset = 0
+        self.entries: List[CentralEntry] = []
+
+    def _emit(self, data: bytes) -> bytes:
+        self.offset += len(data)
+        return data
+
+    def _walk(self):
+        """Yield (arcname, path, stat, is_dir) in depth-first order. Symlinks are
+        left out, they could point anywhere the server can read"""
+        stack = [(self.root, self.arcname_root)]
+        while stack:
+            directory, arc_dir = stack.pop()
+            try:
+                with os.scandir(directory) as it:
+                    items = sorted(it, key=lambda e: e.name)
+            except OSError as e:
+                self.logger.warning(f"Skipping unreadable directory {directory}: {e}")
+                continue
+
+            try:
+                yield arc_dir + '/', directory, os.stat(directory), True
+            except OSError:
+                continue
+            subdirs = []
+            for item in items:
+                try:
+                    if item.is_dir(follow_symlinks=False):
+                        subdirs.append((item.path, f'{arc_dir}/{item.name}'))
+                    elif item.is_file(follow_symlinks=False):
+                        yield f'{arc_dir}/{item.name}', item.path, item.stat(follow_symlinks=False), False
+                except OSError as e:
+                    self.logger.warning(f"Skipping {item.path}: {e}")
+            stack.extend(reversed(subdirs))
+
+    def _local_header(self, name: bytes, method: int, dos_time: int, dos_date: int, zip64: bool) -> bytes:
+        extra = struct.pack('<HHQQ', 0x0001, 16, 0, 0) if zip64 else b''
+        sizes = ZIP64_MARKER if zip64 else 0
+        return struct.pack(
+            '<IHHHHHIIIHH',
+            0x04034b50, 45 if zip64 else 20, FLAG_DATA_DESCRIPTOR | FLAG_UTF8, method,
+            dos_time, dos_date, 0, sizes, sizes, len(name), len(extra)
+        ) + name + extra
+
+    def _entry(self, arcname: str, path: str, st, is_dir: bool) -> Iterator[bytes]:
+        name = arcname.encode('utf-8')
+        dos_time, dos_date = _dos_datetime(st.st_mtime)
+        extension = arcname.rsplit('.', 1)[-1].lower() if '.' in arcname else ''
+        method = METHOD_DEFLATED if (self.compress_text and not is_dir
+                                     and extension in COMPRESSIBLE_EXTENSIONS) else METHOD_STORED
+        expected_size = 0 if is_dir else st.st_size
+        zip64 = expected_size * 1.05 >= ZIP64_LIMIT
+        offset = self.offset
+
+        f = None
+        if not is_dir:
+            try:
+                # O_NOFOLLOW in case the file was swapped for a symlink since the walk saw it
+                f = os.fdopen(os.open(path, os.O_RDONLY | os.O_NOFOLLOW), 'rb')
+            except OSError as e:
+                self.logger.warning(f"Skipping unreadable file {path}: {e}")
+                return
+
+        yield self._emit(self._local_header(name, method, dos_time, dos_date, zip64))
+
+        crc = 0
+        size = 0
+        compressed_size = 0
+        if f:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -15) if method == METHOD_DEFLATED else None
+            with f:
+                while size < expected_size:
+                    block = f.read(min(self.block_size, expected_size - size))
+                    if not block:
+                        break
+                    size += len(block)
+                    crc = zlib.crc32(block, crc)
+                    if compressor:
+                        block = compressor.compress(block)
+                    if block:
+                        compressed_size += len(block)
+                        yield self._emit(block)
+            if compressor:
+                tail = compressor.flush()
+                compressed_size += len(tail)
+                yield self._emit(tail)
+
+        if zip64:
+            descriptor = struct.pack('<IIQQ', 0x08074b50, crc, compressed_size, size)
+        else:
+            descriptor = struct.pack('<IIII', 0x08074b50, crc, compressed_size, size)
+        yield self._emit(descriptor)
+
+        external_attr = ((st.st_mode & 0xFFFF) << 16) | (0x10 if is_dir else 0)
+        self.entries.append(CentralEntry(name, method, dos_time, dos_date, crc,
+                                         compressed_size, size, offset, external_attr, zip64))
+
+    def _central_directory(self) -> Iterator[bytes]:
+        start = self.offset
+        for e in self.entries:
+            zip64_fields = []
+            size = e.size
+            compressed_size = e.compressed_size
+            offset = e.offset
+            if e.zip64 or e.size >= ZIP64_LIMIT or e.compressed_size >= ZIP64_LIMIT:
+                zip64_fields += [e.size, e.compressed_size]
+                size = compressed_size = ZIP64_MARKER
+            if e.offset >= ZIP64_LIMIT:
+                zip64_fields.append(e.offset)
+                offset = ZIP64_MARKER
+            extra = b''
+            if zip64_fields:
+                extra = struct.pack(f'<HH{len(zip64_fields)}Q', 0x0001, 8 * len(zip64_fields), *zip64_fields)
+            version = 45 if zip64_fields else 20
+            yield self._emit(struct.pack(
+                '<IHHHHHHIIIHHHHHII',
+                0x02014b50, (3 << 8) | version, version, FLAG_DATA_DESCRIPTOR | FLAG_UTF8, e.method,
+                e.dos_time, e.dos_date, e.crc, compressed_size, size,
+                len(e.name), len(extra), 0, 0, 0, e.external_attr, offset
+            ) + e.name + extra)
+
+        cd_size = self.offset - start
+        count = len(self.entries)
+        if count >= ZIP_FILECOUNT_LIMIT or start >= ZIP64_LIMIT or cd_size >= ZIP64_LIMIT:
+            zip64_end = self.offset
+            yield self._emit(struct.pack(
+                '<IQHHIIQQQQ', 0x06064b50, 44, (3 << 8) | 45, 45, 0, 0, count, count, cd_size, start
+            ))
+            yield self._emit(struct.pack('<IIQI', 0x07064b50, 0, zip64_end, 1))
+            yield self._emit(struct.pack(
+                '<IHHHHIIH', 0x06054b50, 0, 0, 0xFFFF, 0xFFFF, ZIP64_MARKER, ZIP64_MARKER, 0
+            ))
+        else:
+            yield self._emit(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count, cd_size, start, 0))
+
+    def __iter__(self) -> Iterator[bytes]:
+        for arcname, path, st, is_dir in self._walk():
+            yield from self._entry(arcname, path, st, is_dir)
+        yield from self._central_directory()